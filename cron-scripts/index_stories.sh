@@ -0,0 +1,4 @@
+#!/bin/bash
+source /home/scrumdo/.pyenv/versions/scrumdo/bin/activate
+# Only one may run at a time, so skip this minute if the last run is still going.
+flock -n /tmp/scrumdo_index_stories.lock python /home/scrumdo/Sites/ScrumDo/scrumdo-web/manage.py index_stories
@@ -0,0 +1,3 @@
+#!/bin/bash
+source /home/scrumdo/.pyenv/versions/scrumdo/bin/activate
+python /home/scrumdo/Sites/ScrumDo/scrumdo-web/manage.py run_jobs
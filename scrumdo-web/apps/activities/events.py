@@ -0,0 +1,237 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# The news feed pipeline.  The signal handlers call queueEvent with a small snapshot of the
+# story / task / iteration, which is one insert.  The render_activities command calls
+# processEvents, which moves a batch of events into NewsItems with one statement.  A NewsItem
+# keeps the event type and payload, and renderNewsItems turns it into html when it's read,
+# with the compiled templates and the rendered fragments cached.
+#
+# The snapshots use the same attribute names as the models, so the templates can't tell
+# they're getting dicts.  Anything that can be worked out again at render time, like urls
+# and status names, is left out to keep the rows small.
+
+import json
+import zlib
+import base64
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.template import Context
+from django.template.loader import get_template
+
+from activities.models import ActivityEvent, NewsItem
+from activities.templatetags.activity_tags import absolute_url
+from projects.models import Project, STATUS_CHOICES
+
+import sys
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rendered news items are cached under this version, bump it after changing the templates.
+NEWS_TEMPLATE_VERSION = getattr(settings, "NEWS_TEMPLATE_VERSION", 1)
+NEWS_CACHE_SECONDS = getattr(settings, "NEWS_CACHE_SECONDS", 7 * 24 * 60 * 60)
+
+# event type -> (icon, template)
+EVENT_TEMPLATES = {
+    ActivityEvent.STORY_CREATED: ("script_add", "new_story.txt"),
+    ActivityEvent.STORY_UPDATED: ("script_edit", "edited_story.txt"),
+    ActivityEvent.STORY_STATUS_CHANGED: ("script_code", "status_change_story.txt"),
+    ActivityEvent.STORY_DELETED: ("script_delete", "delete_story.txt"),
+    ActivityEvent.TASK_CREATED: ("drive_add", "new_task.txt"),
+    ActivityEvent.TASK_UPDATED: ("drive_edit", "edited_task.txt"),
+    ActivityEvent.TASK_STATUS_CHANGED: ("drive_go", "status_change_task.txt"),
+    ActivityEvent.TASK_DELETED: ("drive_delete", "delete_task.txt"),
+    ActivityEvent.ITERATION_CREATED: ("calendar_add", "new_iteration.html"),
+    ActivityEvent.ITERATION_DELETED: ("calendar_delete", "delete_iteration.html"),
+    ActivityEvent.SCRUM_LOG_POSTED: ("group", "scrumLog.txt"),
+    ActivityEvent.STORY_COMMENTED: ("comment_add", "comment_on_story.txt"),
+}
+
+# Only these templates show a story's detail.
+DETAIL_EVENTS = (ActivityEvent.STORY_CREATED, ActivityEvent.STORY_DELETED)
+
+
+def queueEvent(event_type, user, project, **payload):
+    ActivityEvent(event_type=event_type, user=user, project=project, payload=json.dumps(payload)).save()
+
+
+def storySnapshot(story, detail=False):
+    snapshot = {
+        "id": story.id,
+        "local_id": story.local_id,
+        "summary": story.summary,
+        "status": story.status,
+        "iteration": {"id": story.iteration_id, "name": story.iteration.name},
+    }
+    if story.assignee_id:
+        snapshot["assignee"] = unicode(story.assignee)
+    if detail and story.detail:
+        snapshot["detail"] = story.detail
+    return snapshot
+
+
+def taskSnapshot(task):
+    snapshot = {
+        "id": task.id,
+        "summary": task.summary,
+        "complete": task.complete,
+        "story": storySnapshot(task.story),
+    }
+    if task.assignee_id:
+        snapshot["assignee"] = unicode(task.assignee)
+    return snapshot
+
+
+def iterationSnapshot(iteration):
+    return {"id": iteration.id, "name": iteration.name}
+
+
+def _expand(snapshot, project):
+    "Puts back what the snapshots leave out: the real project, which the link_stories filter needs, and story urls."
+    if snapshot is None:
+        return None
+    snapshot["project"] = project
+    if "iteration" in snapshot:
+        snapshot["iteration"]["project"] = project
+    if "story" in snapshot:
+        _expand(snapshot["story"], project)
+    if "local_id" in snapshot:
+        # Events queued before the snapshots were trimmed still carry these.
+        if "get_absolute_url" not in snapshot:
+            snapshot["get_absolute_url"] = reverse("story_permalink", args=[str(snapshot["id"])])
+        if "statusText" not in snapshot and "status" in snapshot:
+            snapshot["statusText"] = STATUS_CHOICES[snapshot["status"] - 1][1]
+    return snapshot
+
+
+_templates = {}
+
+
+def _template(event_type):
+    "The compiled template for an event type, so each one is only loaded and parsed once per process."
+    template = _templates.get(event_type)
+    if template is None:
+        template = get_template("activities/%s" % EVENT_TEMPLATES[event_type][1])
+        _templates[event_type] = template
+    return template
+
+
+def eventIcon(event_type, payload):
+    return payload.get("icon", EVENT_TEMPLATES[event_type][0])
+
+
+def renderEvent(event_type, payload, project):
+    "Renders an event from its type and decoded payload."
+    context = {"diffs": payload.get("diffs", {})}
+    for name in ("story", "task", "iteration", "item"):
+        if name in payload:
+            context[name] = _expand(payload[name], project)
+    return _template(event_type).render(Context(context))
+
+
+def compressText(text):
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9))
+
+
+def _renderItem(item, project):
+    if item.event_type is None:
+        return item.text
+    if item.event_type == NewsItem.LEGACY_TEXT:
+        return zlib.decompress(base64.b64decode(item.payload)).decode("utf-8")
+    return renderEvent(item.event_type, json.loads(item.payload), project)
+
+
+def _fragmentKey(item_id, absolute):
+    return "newsitem_%d_%d%s" % (NEWS_TEMPLATE_VERSION, item_id, "_abs" if absolute else "")
+
+
+def renderNewsItems(items, absolute=False):
+    """ Returns a dict of NewsItem id -> html.  A news item never changes once it's written, so the
+        html is cached by id, and the whole list is looked up with one get_many.  With absolute, links
+        include the domain. """
+    keys = dict((_fragmentKey(item.id, absolute), item) for item in items)
+    cached = cache.get_many(keys.keys())
+    html = {}
+    missing = []
+    for key, item in keys.iteritems():
+        if key in cached:
+            html[item.id] = cached[key]
+        else:
+            missing.append(item)
+    if len(missing) == 0:
+        return html
+
+    # item.project would be a query per item.
+    projects = Project.objects.in_bulk(set([item.project_id for item in missing if item.project_id is not None]))
+    rendered = {}
+    for item in missing:
+        try:
+            text = _renderItem(item, projects.get(item.project_id))
+        except:
+            logger.error("Could not render news item %d" % item.id)
+            traceback.print_exc(file=sys.stdout)
+            html[item.id] = ""
+            continue
+        if absolute:
+            text = absolute_url(text)
+        html[item.id] = text
+        rendered[_fragmentKey(item.id, absolute)] = text
+    cache.set_many(rendered, NEWS_CACHE_SECONDS)
+    return html
+
+
+def _insertNewsItems(rows):
+    "Inserts (created, user_id, project_id, icon, event_type, payload) rows with one statement."
+    qn = connection.ops.quote_name
+    columns = ("created", "user_id", "project_id", "icon", "event_type", "payload", "text")
+    sql = "INSERT INTO %s (%s) VALUES %s" % (
+        qn(NewsItem._meta.db_table), ", ".join([qn(column) for column in columns]),
+        ", ".join(["(%s, %s, %s, %s, %s, %s, '')"] * len(rows)))
+    params = []
+    for row in rows:
+        params.extend(row)
+    connection.cursor().execute(sql, params)
+
+
+@transaction.commit_on_success
+def processEvents(batch_size=500):
+    """ Moves the oldest batch of queued events into NewsItems.  Returns how many events were handled.
+        Only run one of these at a time. """
+    events = list(ActivityEvent.objects.order_by("id")[:batch_size])
+    if len(events) == 0:
+        return 0
+    rows = []
+    for event in events:
+        if event.project_id is None:
+            # Nobody would see this.
+            continue
+        try:
+            icon = eventIcon(event.event_type, json.loads(event.payload))
+        except:
+            logger.error("Could not create news item for activity event %d" % event.id)
+            traceback.print_exc(file=sys.stdout)
+            continue
+        rows.append((event.created, event.user_id, event.project_id, icon, event.event_type, event.payload))
+    if len(rows) > 0:
+        _insertNewsItems(rows)
+    ActivityEvent.objects.filter(id__in=[event.id for event in events]).delete()
+    return len(events)
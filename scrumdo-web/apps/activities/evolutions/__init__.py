@@ -1 +1 @@
-SEQUENCE = ['remove_activitiy_tables']
+SEQUENCE = ['remove_activitiy_tables', 'structured_news_items', 'newsitem_project_created_index']
@@ -0,0 +1,11 @@
+from django_evolution.mutations import *
+from django.db import models
+
+# The daily digest and the project feeds read a project's news items by date.  Django can't
+# declare an index on two columns, so new databases get it from sql/newsitem.sql.
+
+MUTATIONS = [
+    SQLMutation("newsitem_project_created_index", [
+        "CREATE INDEX activities_newsitem_project_created ON activities_newsitem (project_id, created);",
+    ]),
+]
@@ -0,0 +1,9 @@
+from django_evolution.mutations import *
+from django.db import models
+
+# News items store their event type and payload and are rendered when read, instead of storing html.
+
+MUTATIONS = [
+    AddField('NewsItem', 'event_type', models.PositiveSmallIntegerField, null=True),
+    AddField('NewsItem', 'payload', models.TextField, initial=''),
+]
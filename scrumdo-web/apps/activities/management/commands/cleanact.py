@@ -1,14 +1,24 @@
-
 from optparse import make_option
-import datetime
 from  django.core.management.base import BaseCommand
-from activities.models import NewsItem
+from activities.retention import purgeNewsItems, NEWS_RETENTION_DAYS
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option(
             '--purge', action='store_true', dest='purge', default=False,
-            help='Generate evolutions to delete stale applications.'),
+            help='Ignored, purging always runs.  Kept for old cron entries.'),
+        make_option(
+            '--days', action='store', type='int', dest='days', default=NEWS_RETENTION_DAYS,
+            help='Delete news items older than this many days.'),
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=5000,
+            help='How many ids to delete per transaction.'),
+        make_option(
+            '--pause', action='store', type='float', dest='pause', default=0.5,
+            help='Seconds to wait between batches.'),
+        make_option(
+            '--archive-dir', action='store', dest='archive_dir', default=None,
+            help='Write the deleted news items to a gzipped JSON-lines file in this directory first.'),
     )
 
 
@@ -19,4 +29,8 @@ class Command(BaseCommand):
 
     def purge(self, *app_labels, **options):
         print 'Purging Activities'
-        NewsItem.purgeOld(365)
+        deleted, seconds = purgeNewsItems(days=options.get("days", NEWS_RETENTION_DAYS),
+                                          batch_size=max(1, options.get("batch_size", 5000)),
+                                          pause=options.get("pause", 0.5),
+                                          archive_dir=options.get("archive_dir"))
+        print 'Deleted %d news items in %.1fs, %.0f rows/sec' % (deleted, seconds, deleted / max(seconds, 0.001))
@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from activities.models import NewsItem
+from activities.events import compressText
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=1000,
+            help='How many news items to convert per transaction.'),
+    )
+
+    help = """Converts news items from before structured storage.  Their html can't be turned back into
+events, so it's compressed into payload instead, for items where that's smaller.  Safe to run more than once."""
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options.get("batch_size", 1000))
+        self.before = self.after = self.converted = 0
+        last_id = 0
+        while True:
+            ids = list(NewsItem.objects.filter(event_type__isnull=True, id__gt=last_id)
+                                       .order_by("id").values_list("id", flat=True)[:batch_size])
+            if len(ids) == 0:
+                break
+            self.convert(ids)
+            last_id = ids[-1]
+        print "Converted %d news items, %d bytes of text down to %d." % (self.converted, self.before, self.after)
+
+    @transaction.commit_on_success
+    def convert(self, ids):
+        for item_id, text in NewsItem.objects.filter(id__in=ids).values_list("id", "text"):
+            payload = compressText(text)
+            if len(payload) >= len(text):
+                continue
+            NewsItem.objects.filter(id=item_id).update(event_type=NewsItem.LEGACY_TEXT, payload=payload, text="")
+            self.before += len(text)
+            self.after += len(payload)
+            self.converted += 1
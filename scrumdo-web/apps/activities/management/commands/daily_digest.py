@@ -1,60 +1,143 @@
 import datetime
+import threading
+from optparse import make_option
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
 from django.template import loader, Context
 from django.conf import settings
-from activities.models import NewsItem
+from django.db import connection
+from activities.models import NewsItem, ProjectEmailSubscription
 
-from mailer import send_mail
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 
+import sys
+import traceback
 import logging
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
-    def handle(self, *app_labels, **options):
-        for user in User.objects.all():
-            if user.email_subscriptions.count() > 0:
+# Messages sent per SMTP connection.
+SEND_BATCH_SIZE = 100
+
+
+def _inThreads(func, items, workers):
+    """ Calls func on each item using a few threads.  Returns a dict of item -> result, leaving out
+        the items that raised an exception. """
+    items = list(items)
+    results = {}
+    lock = threading.Lock()
+
+    def work():
+        try:
+            while True:
+                with lock:
+                    if len(items) == 0:
+                        return
+                    item = items.pop()
                 try:
-                    self.dailyDigest( user )
+                    result = func(item)
                 except:
-                    logger.error("Could not send daily digest to %s" % user)
+                    logger.error("Daily digest failed for %s" % (item,))
+                    traceback.print_exc(file=sys.stdout)
+                    continue
+                with lock:
+                    results[item] = result
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
 
-    def dailyDigest( self, user ):
-        logger.debug( "Sending daily digest to %s" % user )
+    threads = [threading.Thread(target=work) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
 
-        template = loader.get_template('activities/digest_header.html')
-        context = Context( {"user":user, "site_name":settings.SITE_NAME } )
-        body = template.render(context)
-        domain = settings.BASE_URL
 
-        email_address = user.email
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=4,
+            help='How many threads render the project sections and put the emails together.'),
+    )
 
-        for sub in user.email_subscriptions.all():
-            if not sub.project.active:
-                continue
-            logger.debug(sub)
-            today = datetime.date.today()
-            mdiff = datetime.timedelta(hours=-24)
-            daterange = today + mdiff
-            stories = {}
-            news_items = NewsItem.objects.filter( project=sub.project, created__gte=daterange).order_by("-created")
+    help = "Emails each subscriber the last day's activity in their projects."
 
-            template = loader.get_template('activities/digest_project.html')
-            context = Context( {"project":sub.project , "news_items":news_items, "domain":domain, 'email_address':email_address,"support_email":settings.CONTACT_EMAIL} )
-            body = "%s %s" % (body, template.render(context))
+    def handle(self, *app_labels, **options):
+        workers = options.get("workers", 4)
+        self.domain = settings.BASE_URL
+        self.header = loader.get_template('activities/digest_header.html')
+        self.project_template = loader.get_template('activities/digest_project.html')
+        self.footer = loader.get_template('activities/digest_footer.html')
+
+        subscriptions = ProjectEmailSubscription.objects.filter(project__active=True) \
+                                                        .select_related("user", "project").order_by("user", "id")
+        projects = {}
+        users = {}
+        for sub in subscriptions:
+            projects[sub.project_id] = sub.project
+            users.setdefault(sub.user_id, (sub.user, []))[1].append(sub.project_id)
+
+        # A project's section is the same for everyone subscribed to it, so it's only rendered once.
+        news_items = self.newsItems(projects.keys())
+        fragments = _inThreads(lambda project_id: self.projectFragment(projects[project_id], news_items.get(project_id, [])),
+                               projects.keys(), workers)
+        messages = _inThreads(lambda user_id: self.dailyDigest(users[user_id][0], users[user_id][1], fragments),
+                              users.keys(), workers)
+        sent = self.send(messages.values())
+        logger.info("Sent %d of %d daily digests covering %d projects." % (sent, len(messages), len(fragments)))
+
+    def newsItems(self, project_ids):
+        "The last day's news items for all the projects in one query, as a dict of project id -> items."
+        today = datetime.date.today()
+        mdiff = datetime.timedelta(hours=-24)
+        daterange = today + mdiff
+        result = {}
+        if len(project_ids) == 0:
+            return result
+        for item in NewsItem.objects.filter(project__in=project_ids, created__gte=daterange) \
+                                    .select_related("user").order_by("-created"):
+            result.setdefault(item.project_id, []).append(item)
+        return result
 
-        template = loader.get_template('activities/digest_footer.html')
-        context = Context( {"user":user , "domain":domain, 'email_address':email_address,"support_email":settings.CONTACT_EMAIL} )
-        body = "%s %s" % (body, template.render(context))
+    def projectFragment(self, project, news_items):
+        context = Context( {"project":project , "news_items":news_items, "domain":self.domain, "support_email":settings.CONTACT_EMAIL} )
+        return self.project_template.render(context)
+
+    def dailyDigest( self, user, project_ids, fragments ):
+        logger.debug( "Building daily digest for %s" % user )
+        email_address = user.email
+        context = Context( {"user":user, "site_name":settings.SITE_NAME } )
+        body = [self.header.render(context)]
+        for project_id in project_ids:
+            if project_id in fragments:
+                body.append(fragments[project_id])
+        context = Context( {"user":user , "domain":self.domain, 'email_address':email_address,"support_email":settings.CONTACT_EMAIL} )
+        body.append(self.footer.render(context))
 
         subject, from_email, to = 'ScrumDo Daily Digest', 'noreply@scrumdo.com', email_address
         text_content = 'See html email...'
-        html_content = body
+        html_content = " ".join(body)
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
-
+        return msg
 
-        # logger.debug(body)
+    def send(self, messages):
+        """ Sends the digests in batches, each over one connection.  Each message is sent on its own, so
+            a refused address only loses that user's digest.  Returns how many were sent. """
+        sent = 0
+        for start in range(0, len(messages), SEND_BATCH_SIZE):
+            # Errors come back as a count of 0 instead of an exception.
+            connection = get_connection(fail_silently=True)
+            try:
+                for message in messages[start:start + SEND_BATCH_SIZE]:
+                    # Does nothing if the connection is already open.
+                    connection.open()
+                    if connection.send_messages([message]):
+                        sent += 1
+                    else:
+                        logger.error("Could not send the daily digest to %s" % ", ".join(message.to))
+                        # The SMTP session may not be usable after an error, the next message opens a new one.
+                        connection.close()
+            finally:
+                connection.close()
+        return sent
@@ -0,0 +1,38 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from activities.events import processEvents
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=500,
+            help='How many events to move per transaction.'),
+        make_option(
+            '--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, waiting for new events.'),
+        make_option(
+            '--sleep', action='store', type='int', dest='sleep', default=5,
+            help='With --loop, seconds to wait when there are no events.'),
+    )
+
+    help = "Moves queued activity events into news items.  Run it from cron, or with --loop.  Only run one at a time."
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options.get("batch_size", 500))
+        total = 0
+        while True:
+            count = processEvents(batch_size)
+            total += count
+            if count < batch_size:
+                if not options.get("loop"):
+                    break
+                time.sleep(options.get("sleep", 5))
+        print "Moved %d activity events." % total
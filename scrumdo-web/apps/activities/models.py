@@ -22,18 +22,49 @@ class ProjectEmailSubscription(models.Model):
         return "Subscription: %s %s" % (self.user, self.project)
 
 class NewsItem(models.Model):
+    """ One entry in a project's news feed.  New items store the ActivityEvent type and its JSON payload,
+        and are rendered when they're read, see render() and activities.events.renderNewsItems.  Items from
+        before that have the rendered html in text and no event_type, or LEGACY_TEXT with the html
+        compressed into payload by the compress_news command. """
+    LEGACY_TEXT = 0
+
     created = models.DateTimeField(_('created'), default=datetime.datetime.now)
     user = models.ForeignKey(User,related_name="newsItems", null=True, blank=True)
     project = models.ForeignKey("projects.Project", related_name="newsItems", null=True, blank=True)
-    text = models.TextField()
+    text = models.TextField(blank=True)
     icon = models.CharField(max_length=24)
     feed_url = models.CharField(max_length=75, null=True, blank=True)
-    @staticmethod
-    def purgeOld(days=365):
-        today = datetime.date.today()
-        mdiff = datetime.timedelta(days=-days)
-        date_30days_Agoago = today + mdiff
-        NewsItem.objects.filter(created__lte=date_30days_Agoago).delete()
-        
+    event_type = models.PositiveSmallIntegerField(null=True, blank=True)
+    payload = models.TextField(blank=True, default="")
+
+    def render(self, absolute=False):
+        "Returns the html for this item.  With absolute, links include the domain, for emails and the api."
+        from activities.events import renderNewsItems
+        return renderNewsItems([self], absolute)[self.id]
+
     class Meta:
-        ordering = [ '-created' ]
\ No newline at end of file
+        ordering = [ '-created' ]
+
+class ActivityEvent(models.Model):
+    """ Something happened that should show up in the news feed.  The signal handlers queue these instead
+        of writing a NewsItem during the request, and the render_activities command moves them into
+        NewsItems in batches.  payload is JSON with a small snapshot of whatever the template needs, since
+        the story or task may have changed or be gone by the time it's rendered. """
+    STORY_CREATED = 1
+    STORY_UPDATED = 2
+    STORY_STATUS_CHANGED = 3
+    STORY_DELETED = 4
+    TASK_CREATED = 5
+    TASK_UPDATED = 6
+    TASK_STATUS_CHANGED = 7
+    TASK_DELETED = 8
+    ITERATION_CREATED = 9
+    ITERATION_DELETED = 10
+    SCRUM_LOG_POSTED = 11
+    STORY_COMMENTED = 12
+
+    event_type = models.PositiveSmallIntegerField()
+    created = models.DateTimeField(default=datetime.datetime.now)
+    user = models.ForeignKey(User, null=True, blank=True)
+    project = models.ForeignKey("projects.Project", null=True, blank=True)
+    payload = models.TextField()
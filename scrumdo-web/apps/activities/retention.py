@@ -0,0 +1,113 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Deletes old NewsItems for the cleanact command.
+#
+# One big delete on this table holds its locks for minutes, so this walks the table in id
+# ranges, oldest first, and deletes each range in its own short transaction with a pause in
+# between.  Ids and created dates go up together, so it stops at the first range that has
+# nothing old enough.  The deleted rows can be written to a gzipped JSON-lines file first.
+
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+
+from activities.models import NewsItem
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+NEWS_RETENTION_DAYS = getattr(settings, "NEWS_RETENTION_DAYS", 365)
+
+ARCHIVE_FIELDS = ("id", "created", "user_id", "project_id", "text", "icon", "feed_url", "event_type", "payload")
+
+
+class NewsArchive(object):
+    "Appends NewsItem rows to a gzipped JSON-lines file, one object per line."
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, "newsitems-%s.jsonl.gz" % datetime.now().strftime("%Y%m%d-%H%M%S"))
+        self.file = gzip.open(self.path, "ab")
+
+    def write(self, rows):
+        for row in rows:
+            row = dict(row)
+            row["created"] = row["created"].isoformat()
+            self.file.write(json.dumps(row) + "\n")
+        # Everything written so far is readable even if a later batch fails.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+@transaction.commit_on_success
+def _deleteRange(start, end, cutoff, archive=None):
+    "Deletes the items older than cutoff with start <= id < end.  Returns how many were deleted."
+    if archive is not None:
+        rows = list(NewsItem.objects.filter(id__gte=start, id__lt=end, created__lte=cutoff)
+                                    .order_by("id").values(*ARCHIVE_FIELDS))
+        if len(rows) == 0:
+            return 0
+        archive.write(rows)
+        # Only what was archived, nothing that turned up in between.
+        NewsItem.objects.filter(id__in=[row["id"] for row in rows]).delete()
+        return len(rows)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s >= %%s AND %s < %%s AND %s <= %%s" % (
+        qn(NewsItem._meta.db_table), qn("id"), qn("id"), qn("created")), [start, end, cutoff])
+    # A raw query doesn't mark the transaction dirty, and commit_on_success only commits a dirty one.
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+def purgeNewsItems(days=NEWS_RETENTION_DAYS, batch_size=5000, pause=0.5, archive_dir=None):
+    """ Deletes news items older than the given number of days, batch_size ids at a time, sleeping pause
+        seconds between batches.  With archive_dir, the rows are written there first.
+        Returns (rows deleted, seconds taken). """
+    cutoff = datetime.now() - timedelta(days=days)
+    archive = NewsArchive(archive_dir) if archive_dir else None
+    start_time = time.time()
+    deleted = 0
+    try:
+        start = NewsItem.objects.aggregate(Min("id"))["id__min"]
+        while start is not None:
+            end = start + batch_size
+            oldest = NewsItem.objects.filter(id__gte=start, id__lt=end).aggregate(Min("created"))["created__min"]
+            if oldest is not None and oldest > cutoff:
+                break
+            if oldest is not None:
+                deleted += _deleteRange(start, end, cutoff, archive)
+                logger.info("Deleted %d news items, %.0f rows/sec" % (deleted, deleted / max(time.time() - start_time, 0.001)))
+                time.sleep(pause)
+            # Skip over any gap in the ids.
+            start = NewsItem.objects.filter(id__gte=end).aggregate(Min("id"))["id__min"]
+    finally:
+        if archive is not None:
+            archive.close()
+            logger.info("Archived news items to %s" % archive.path)
+    return deleted, time.time() - start_time
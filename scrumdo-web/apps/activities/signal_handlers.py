@@ -13,6 +13,7 @@ from scrumdo_model_utils.models import InheritanceCastModel
 from scrum_log.models import ScrumLog
 
 from activities.models import *
+from activities.events import queueEvent, storySnapshot, taskSnapshot, iterationSnapshot, DETAIL_EVENTS
 import projects.signals as signals
 
 import datetime
@@ -46,7 +47,6 @@ def _translate_diffs(diffs, project):
         return {}
     tdiffs = {}
     for k, v in diffs.iteritems():
-        logger.debug("Translate diffs %s %s" % (k, v))
         if k in mappers:
             newval = mappers[k](v)
             if newval:
@@ -55,109 +55,91 @@ def _translate_diffs(diffs, project):
     return tdiffs
 
 
-def _createStoryNewsItem(icon, template, **kwargs):
+def _queueStoryEvent(event_type, **kwargs):
     try:
         story = kwargs["story"]
-        user = kwargs["user"]
-        diffs = kwargs.get("diffs", None)
-
-        diffs = _translate_diffs(diffs, story.project)
-
-        item = NewsItem(user=user, project=story.iteration.project, icon=icon)
-        item.text = render_to_string("activities/%s" %
-                                     template, {'user': user, 'story': story, 'diffs': diffs})
-        item.save()
+        diffs = _translate_diffs(kwargs.get("diffs", None), story.project)
+        queueEvent(event_type, kwargs["user"], story.iteration.project, story=storySnapshot(story, event_type in DETAIL_EVENTS), diffs=diffs)
     except:
         logger.error("Could not create news item")
         traceback.print_exc(file=sys.stdout)
 
 
-def _createIterationNewsItem(icon, template, **kwargs):
+def _queueIterationEvent(event_type, **kwargs):
     try:
         iteration = kwargs["iteration"]
-        user = kwargs["user"]
-        item = NewsItem(user=user, project=iteration.project, icon=icon)
-        item.text = render_to_string("activities/%s" %
-                                     template, {'user': user, 'iteration': iteration})
-        item.save()
+        queueEvent(event_type, kwargs["user"], iteration.project, iteration=iterationSnapshot(iteration))
     except:
         logger.error("Could not create news item")
         traceback.print_exc(file=sys.stdout)
 
 
-def _createTaskNewsItem(icon, template, **kwargs):
+def _queueTaskEvent(event_type, **kwargs):
     try:
         task = kwargs["task"]
-        user = kwargs["user"]
-        diffs = kwargs.get("diffs", None)
-        item = NewsItem(
-            user=user, project=task.story.iteration.project, icon=icon)
-        item.text = render_to_string("activities/%s" %
-                                     template, {'user': user, 'task': task, 'diffs': diffs})
-        item.save()
+        queueEvent(event_type, kwargs["user"], task.story.iteration.project, task=taskSnapshot(task))
     except:
         logger.error("Could not create news item")
         traceback.print_exc(file=sys.stdout)
 
 
 def onStoryCreated(sender, **kwargs):
-    _createStoryNewsItem("script_add", "new_story.txt", **kwargs)
+    _queueStoryEvent(ActivityEvent.STORY_CREATED, **kwargs)
 signals.story_created.connect(
     onStoryCreated, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onStoryUpdated(sender, **kwargs):
-    _createStoryNewsItem("script_edit", "edited_story.txt", **kwargs)
+    _queueStoryEvent(ActivityEvent.STORY_UPDATED, **kwargs)
 signals.story_updated.connect(
     onStoryUpdated, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onStoryStatusChanged(sender, **kwargs):
-    _createStoryNewsItem("script_code", "status_change_story.txt", **kwargs)
+    _queueStoryEvent(ActivityEvent.STORY_STATUS_CHANGED, **kwargs)
 signals.story_status_changed.connect(
     onStoryStatusChanged, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onStoryDeleted(sender, **kwargs):
-    _createStoryNewsItem("script_delete", "delete_story.txt", **kwargs)
+    _queueStoryEvent(ActivityEvent.STORY_DELETED, **kwargs)
 
 signals.story_deleted.connect(
     onStoryDeleted, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onTaskCreated(sender, **kwargs):
-    _createTaskNewsItem('drive_add', 'new_task.txt', **kwargs)
+    _queueTaskEvent(ActivityEvent.TASK_CREATED, **kwargs)
 signals.task_created.connect(
     onTaskCreated, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onTaskStatusChange(sender, **kwargs):
-    _createTaskNewsItem('drive_go', 'status_change_task.txt', **kwargs)
+    _queueTaskEvent(ActivityEvent.TASK_STATUS_CHANGED, **kwargs)
 signals.task_status_changed.connect(
     onTaskStatusChange, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onTaskUpdated(sender, **kwargs):
-    _createTaskNewsItem('drive_edit', 'edited_task.txt', **kwargs)
+    _queueTaskEvent(ActivityEvent.TASK_UPDATED, **kwargs)
 signals.task_updated.connect(
     onTaskUpdated, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onTaskDeleted(sender, **kwargs):
-    _createTaskNewsItem('drive_delete', 'delete_task.txt', **kwargs)
+    _queueTaskEvent(ActivityEvent.TASK_DELETED, **kwargs)
 signals.task_deleted.connect(
     onTaskDeleted, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onIterationCreated(sender, **kwargs):
-    _createIterationNewsItem("calendar_add", "new_iteration.html", **kwargs)
+    _queueIterationEvent(ActivityEvent.ITERATION_CREATED, **kwargs)
 signals.iteration_created.connect(
     onIterationCreated, dispatch_uid="newsfeed_signal_hookup")
 
 
 def onIterationDeleted(sender, **kwargs):
-    _createIterationNewsItem(
-        "calendar_delete", "delete_iteration.html", **kwargs)
+    _queueIterationEvent(ActivityEvent.ITERATION_DELETED, **kwargs)
 signals.iteration_deleted.connect(
     onIterationDeleted, dispatch_uid="newsfeed_signal_hookup")
 
@@ -167,11 +149,8 @@ def onScrumLogPosted(sender, instance, signal, *args, **kwargs):
         icon = "group"
         if instance.flagged:
             icon = "flag_red"
-        item = NewsItem(
-            user=instance.creator, project=instance.project, icon=icon)
-        item.text = render_to_string(
-            "activities/scrumLog.txt", {'item': instance})
-        item.save()
+        queueEvent(ActivityEvent.SCRUM_LOG_POSTED, instance.creator, instance.project,
+                   item={"message": instance.message}, icon=icon)
     except:
         logger.error("Could not create news item")
         traceback.print_exc(file=sys.stdout)
@@ -186,11 +165,8 @@ def onCommentPosted(sender, **kwargs):
     if t_comment.content_type.id == ContentType.objects.get_for_model(Story).id and kwargs['created']:
         try:
             story = Story.objects.get(id=t_comment.object_id)
-            item = NewsItem(
-                user=t_comment.user, project=story.iteration.project, icon="comment_add")
-            item.text = render_to_string(
-                "activities/comment_on_story.txt", {'story': story, 'item': t_comment})
-            item.save()
+            queueEvent(ActivityEvent.STORY_COMMENTED, t_comment.user, story.iteration.project,
+                       story=storySnapshot(story), item={"comment": t_comment.comment})
         except:
             logger.error("Could not create news item")
             traceback.print_exc(file=sys.stdout)
@@ -0,0 +1,3 @@
+-- The daily digest and the project feeds read a project's news items by date.  Existing
+-- databases get this from the newsitem_project_created_index evolution.
+CREATE INDEX activities_newsitem_project_created ON activities_newsitem (project_id, created);
@@ -35,8 +35,9 @@ def news_feed(context):
             news_items = NewsItem.objects.filter(project=project)
         else:
             news_items = []
-        
-    return {'newsitems':news_items,"request":request}
+            return {'newsitems':news_items,"request":request}
+
+    return {'newsitems':news_items.select_related("user"),"request":request}
     
 
 
@@ -71,6 +72,17 @@ def smart_truncate(content, length=100, suffix='...'):
 def absolute_url(value):    
     return string.replace(value,'href="/','href="http://www.scrumdo.com/')
 
+@register.filter
+def rendered_news(news_items, absolute=False):
+    """ Renders a page of news items with one cache lookup, and returns them as a list with their html
+        in rendered_text.  Loop over the result, looping over the queryset again would run it twice. """
+    from activities.events import renderNewsItems
+    news_items = list(news_items)
+    html = renderNewsItems(news_items, bool(absolute))
+    for item in news_items:
+        item.rendered_text = html[item.id]
+    return news_items
+
 @register.filter
 def subscription_checkbox(project , subscription_list):
     try:
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from django.test import TransactionTestCase
+
+from activities.models import NewsItem
+from activities.retention import purgeNewsItems
+
+
+class PurgeNewsItemsTest(TransactionTestCase):
+    "Old news items are deleted in batches, each committed on its own."
+
+    def addItem(self, days_old):
+        item = NewsItem(text="item", icon="script")
+        item.save()
+        # created has a default, so set it after the insert.
+        NewsItem.objects.filter(id=item.id).update(created=datetime.now() - timedelta(days=days_old))
+        return item
+
+    def test_purge_deletes_old_items(self):
+        old = [self.addItem(100) for i in range(5)]
+        new = [self.addItem(1) for i in range(2)]
+        deleted, seconds = purgeNewsItems(days=30, batch_size=2, pause=0)
+        self.assertEqual(deleted, 5)
+        self.assertEqual(NewsItem.objects.filter(id__in=[item.id for item in old]).count(), 0)
+        self.assertEqual(set(NewsItem.objects.values_list("id", flat=True)), set(item.id for item in new))
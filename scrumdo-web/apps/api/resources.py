@@ -14,8 +14,8 @@ from django.core.urlresolvers import reverse
 
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
-from activities.templatetags.activity_tags import absolute_url
 from activities.models import NewsItem
+from activities.events import renderNewsItems
 from projects.models import Project,ProjectMember,Story,Iteration,Epic,Task
 from organizations.models import Organization, Team
 from threadedcomments.models import ThreadedComment
@@ -234,9 +234,20 @@ class NewsItemResource(ModelResource):
     user = fields.CharField(attribute='user')
     def obj_get_list(self, request=None, **kwargs):
         """ overriding """
-        return NewsItem.objects.filter(project__teams__members=request.user)
-    def dehydrate_text(self, bundle):        
-        return absolute_url(bundle.obj.text)[1:]
+        return NewsItem.objects.filter(project__teams__members=request.user).select_related("user")
+    def dehydrate_text(self, bundle):
+        # Filled in for the whole page at once by _renderText, so it's one cache lookup per page.
+        return None
+    def _renderText(self, bundles):
+        html = renderNewsItems([bundle.obj for bundle in bundles], absolute=True)
+        for bundle in bundles:
+            bundle.data["text"] = html[bundle.obj.id][1:]
+    def alter_list_data_to_serialize(self, request, data):
+        self._renderText(data["objects"])
+        return data
+    def alter_detail_data_to_serialize(self, request, bundle):
+        self._renderText([bundle])
+        return bundle
     def dehydrate_user(self, bundle):
         return str(bundle.obj.user)
     def dehydrate_icon(self, bundle):
@@ -81,3 +81,21 @@ class Avatar(models.Model):
     def avatar_name(self, size):
         return os.path.join(AVATAR_STORAGE_DIR, self.user.username,
             'resized', str(size), self.avatar.name)
+
+
+def prefetch_avatars(users):
+    """ Looks up the avatars for a list of users in one query, and puts each one on its user as
+        _prefetched_avatar (None if they have none) for the avatar template tag to use. """
+    users = dict((user.id, user) for user in users)
+    found = {}
+    for avatar in Avatar.objects.filter(user__in=users.keys()).order_by('-date_uploaded'):
+        current = found.get(avatar.user_id)
+        # Same choice as avatar_url: the primary one, or else the newest.
+        if current is None or (avatar.primary and not current.primary):
+            found[avatar.user_id] = avatar
+    for user_id, user in users.iteritems():
+        avatar = found.get(user_id)
+        if avatar is not None:
+            # avatar_name needs the username.
+            avatar._user_cache = user
+        user._prefetched_avatar = avatar
@@ -25,6 +25,11 @@ def avatar_url(user, size=80):
         avatar = avatars[0]
     else:
         avatar = None
+    return _url_for(user, avatar, size)
+register.simple_tag(avatar_url)
+
+
+def _url_for(user, avatar, size):
     if avatar is not None:
         if not avatar.thumbnail_exists(size):
             avatar.create_thumbnail(size)
@@ -39,10 +44,13 @@ def avatar_url(user, size=80):
                 urllib.urlencode(params))
         else:
             return AVATAR_DEFAULT_URL
-register.simple_tag(avatar_url)
 
 
 def avatar(user, size=80):
+    if hasattr(user, "_prefetched_avatar"):
+        # Set by avatar.models.prefetch_avatars for a whole list of users at once.
+        url = _url_for(user, user._prefetched_avatar, size)
+        return """<img src="%s" alt="%s" width="%s" height="%s" />""" % (url, unicode(user), size, size)
     return real_avatar(user, size)
 
 @cache(120)
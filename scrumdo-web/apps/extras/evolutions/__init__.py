@@ -0,0 +1 @@
+SEQUENCE = ['sync_retries', 'sync_deleted_id']
@@ -0,0 +1,8 @@
+from django_evolution.mutations import *
+from django.db import models
+
+# Deletes that arrive while the item's create is running are queued by story or task id.
+
+MUTATIONS = [
+    AddField('SyncronizationQueue', 'deleted_id', models.IntegerField, null=True),
+]
@@ -0,0 +1,10 @@
+from django_evolution.mutations import *
+from django.db import models
+
+# Failed sync actions are retried with a backoff instead of being dropped.
+# SyncronizationClaim and SyncronizationDeadLetter are new tables and come from syncdb.
+
+MUTATIONS = [
+    AddField('SyncronizationQueue', 'attempts', models.IntegerField, initial=0),
+    AddField('SyncronizationQueue', 'next_attempt', models.DateTimeField, null=True, db_index=True),
+]
@@ -1,4 +1,5 @@
 from django.conf import settings
+from datetime import datetime
 import logging
 import sys, traceback
 
@@ -6,10 +7,22 @@ import projects.signals as project_signals
 import projects.limits as project_limits
 import extras.signals as extras_signals
 
-from models import ProjectExtraMapping, ExtraConfiguration, SyncronizationQueue , ExternalStoryMapping, StoryQueue, ExternalTaskMapping
+from models import ProjectExtraMapping, ExtraConfiguration, SyncronizationQueue , ExternalStoryMapping, StoryQueue, ExternalTaskMapping, \
+    SyncronizationClaim
 
 logger = logging.getLogger(__name__)
 
+# Which pending actions a new action can be folded into.  Anything not listed only folds into
+# a pending copy of itself.  A pending create sends the story or task as it is when it runs,
+# so it covers any edits made before then.
+MERGES_INTO = {
+    SyncronizationQueue.ACTION_STORY_UPDATED: (SyncronizationQueue.ACTION_STORY_UPDATED, SyncronizationQueue.ACTION_STORY_CREATED),
+    SyncronizationQueue.ACTION_TASK_UPDATED: (SyncronizationQueue.ACTION_TASK_UPDATED, SyncronizationQueue.ACTION_TASK_CREATED),
+}
+
+DELETE_ACTIONS = (SyncronizationQueue.ACTION_STORY_DELETED, SyncronizationQueue.ACTION_TASK_DELETED)
+CREATE_ACTIONS = (SyncronizationQueue.ACTION_STORY_CREATED, SyncronizationQueue.ACTION_TASK_CREATED)
+
 class ExtrasManager:
     """
       Class to manage our list of extras.
@@ -22,28 +35,54 @@ class ExtrasManager:
         return self.extras[ slug ]
 
     def queueSyncAction( self, extra_slug, project, action, **kwargs):
+        """ Queues an action, collapsing it into what's already pending for the same story or task.  A story
+            that's created and then edited a few times is one create, a string of edits is one update, and
+            an edit followed by a delete is just the delete. """
         logger.debug("Queuing a syncronization action %d, %s, %s" % (action,project.slug,extra_slug))
+        story = kwargs.get("story",None)
+        task = kwargs.get("task",None)
+        pending = SyncronizationQueue.objects.filter(project=project, extra_slug=extra_slug, story=story, task=task)
+
+        if action in DELETE_ACTIONS:
+            self._queueDelete( extra_slug, project, action, pending, story, task )
+            return
 
-        existing = SyncronizationQueue.objects.filter(project=project, extra_slug=extra_slug, action=action, story=kwargs.get("story",None), task=kwargs.get("task",None))
-        if existing.count() > 0:
-            logger.debug("Skipping this duplicate sync action")
+        # Touching queue_date on a pending row tells a worker that's running it right now to run it again,
+        # see extras.sync.  That's the whole write when something is already queued.
+        if pending.filter(action__in=MERGES_INTO.get(action, (action,))).update(queue_date=datetime.now()) > 0:
+            logger.debug("Merged into a pending sync action")
             return
 
-        queueObject = SyncronizationQueue( project=project, extra_slug=extra_slug, action=action)
-        queueObject.story = kwargs.get("story",None)
-        queueObject.task = kwargs.get("task",None)
-        if queueObject.task is None:
-            try:
-                mapping = ExternalStoryMapping.objects.get(story=queueObject.story,extra_slug=extra_slug)
-                queueObject.external_id = mapping.external_id
-            except:
-                pass
+        queueObject = SyncronizationQueue( project=project, extra_slug=extra_slug, action=action, story=story, task=task)
+        queueObject.save()
+
+    def _queueDelete( self, extra_slug, project, action, pending, story, task ):
+        # A worker that holds the project's claim may be running a pending create right now.
+        claimed = SyncronizationClaim.objects.filter(project=project).exists()
+        creating = claimed and pending.filter(action__in=CREATE_ACTIONS).exists()
+        # Whatever else was pending doesn't matter any more.
+        if claimed:
+            pending.exclude(action__in=CREATE_ACTIONS).delete()
         else:
-            try:
-                mapping = ExternalTaskMapping.objects.get(task=queueObject.task,extra_slug=extra_slug)
-                queueObject.external_id = mapping.external_id
-            except:
-                pass
+            pending.delete()
+        if task is None:
+            mappings = ExternalStoryMapping.objects.filter(story=story,extra_slug=extra_slug)
+        else:
+            mappings = ExternalTaskMapping.objects.filter(task=task,extra_slug=extra_slug)
+        external_ids = list(mappings.values_list("external_id", flat=True)[:1])
+        if len(external_ids) == 0:
+            if creating:
+                # The external id doesn't exist yet.  The worker fills it in once the create is done,
+                # see extras.sync.
+                deleted_id = story.id if task is None else task.id
+                SyncronizationQueue( project=project, extra_slug=extra_slug, action=action, deleted_id=deleted_id).save()
+                return
+            # It never made it to the other side, so there's nothing to delete there.
+            logger.debug("Skipping delete of an item that was never synced")
+            return
+        # The story or task is about to be deleted, and a foreign key to it would take this row with it.
+        # The external id is all the extra needs.
+        queueObject = SyncronizationQueue( project=project, extra_slug=extra_slug, action=action, external_id=external_ids[0])
         queueObject.save()
 
     def queueSyncActions(self, project, action, **kwargs):
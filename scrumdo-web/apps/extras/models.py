@@ -4,6 +4,7 @@ import time
 
 from django.core.urlresolvers import reverse
 from projects.models import Project, Iteration, Story, Task, STATUS_CHOICES
+from projects.fragments import invalidateStories
 
 import json
 
@@ -75,6 +76,35 @@ class SyncronizationQueue( models.Model ):
     action = models.IntegerField( max_length=2, choices=ACTION_CHOICES )
     queue_date = models.DateTimeField( default=datetime.now)
     external_id = models.CharField( max_length=40 , null=True)
+    # Set when an action failed and is waiting to be retried.
+    attempts = models.IntegerField( default=0 )
+    next_attempt = models.DateTimeField( null=True, db_index=True )
+    # A delete queued while the story or task's create may have been running has no external id yet,
+    # just the id of the story or task.  The worker fills in the external id once the create is done.
+    deleted_id = models.IntegerField( null=True )
+
+
+class SyncronizationClaim( models.Model ):
+    """ A sync worker holds one of these while it runs a project's queue.  project is unique, so only one
+        worker can work on a project at a time, which keeps that project's actions in order. """
+    project = models.ForeignKey(Project, unique=True, related_name="sync_claim")
+    token = models.CharField( max_length=32 )
+    claimed = models.DateTimeField( default=datetime.now )
+
+
+class SyncronizationDeadLetter( models.Model ):
+    """ A queue item that kept failing.  It's kept here so it can be looked at, and requeued with
+        extras_sync --retry-dead, instead of being lost. """
+    project = models.ForeignKey(Project, related_name="sync_dead_letters")
+    story = models.ForeignKey(Story, null=True, related_name="sync_dead_letters", on_delete=models.SET_NULL)
+    task = models.ForeignKey(Task, null=True, related_name="sync_dead_letters", on_delete=models.SET_NULL)
+    extra_slug = models.CharField(  max_length=25)
+    action = models.IntegerField( max_length=2, choices=SyncronizationQueue.ACTION_CHOICES )
+    queue_date = models.DateTimeField( )
+    external_id = models.CharField( max_length=40 , null=True)
+    attempts = models.IntegerField( default=0 )
+    failed_date = models.DateTimeField( default=datetime.now)
+    error = models.TextField( blank=True )
 
 
 class ExternalStoryMapping( models.Model ):
@@ -100,3 +130,15 @@ class ExtraConfiguration( models.Model ):
     extra_slug = models.CharField( "extra_slug" , max_length=25)
     project_slug = models.CharField( "project_slug" , max_length=55)
     configuration_pickle = models.TextField( blank=True )
+
+
+# The story snippets show the external links, see projects/fragments.py.
+def onExternalLinkChanged(sender, instance, **kwargs):
+    if sender is ExternalTaskMapping:
+        story_ids = Task.objects.filter(id=instance.task_id).values_list("story_id", flat=True)
+    else:
+        story_ids = [instance.story_id]
+    invalidateStories(story_ids)
+for mapping in (ExternalStoryMapping, ExternalTaskMapping):
+    models.signals.post_save.connect(onExternalLinkChanged, sender=mapping, dispatch_uid="story_fragment_hookup")
+    models.signals.post_delete.connect(onExternalLinkChanged, sender=mapping, dispatch_uid="story_fragment_hookup")
@@ -8,7 +8,7 @@ from extras.plugins.github_issues.github2.commits import Commits
 class Github(object):
 
     def __init__(self, username=None, api_token=None, debug=False,
-        requests_per_second=None, access_token=None):
+        requests_per_second=None, access_token=None, url_prefix=None):
         """
         An interface to GitHub's API:
             http://develop.github.com/
@@ -28,13 +28,19 @@ class Github(object):
                 or None to disable delays.
 
                 The default is to disable delays (for backwards compatibility).
+                Requests for the same account share one rate limit, across
+                all the ``Github`` objects in the process.
+
+            `url_prefix` overrides the API's base URL, to point it at a
+                test server.
         """
 
         self.debug = debug
         self.request = GithubRequest(username=username, api_token=api_token,
                                      debug=self.debug,
                                      requests_per_second=requests_per_second,
-                                     access_token=access_token)
+                                     access_token=access_token,
+                                     url_prefix=url_prefix)
         self.issues = Issues(self.request)
         self.users = Users(self.request)
         self.repos = Repositories(self.request)
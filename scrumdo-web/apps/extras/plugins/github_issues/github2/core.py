@@ -39,7 +39,8 @@ class GithubCommand(object):
             response = self.request.post(self.domain, command, *args,
                                          **post_data)
         else:
-            response = self.request.get(self.domain, command, *args)
+            response = self.request.get(self.domain, command, *args,
+                conditional=kwargs.get("conditional", False))
         if filter:
             return response[filter]
         return response
@@ -52,9 +52,12 @@ class Issues(GithubCommand):
         ``project`` is a string with the project owner username and repository
         name separated by ``/`` (e.g. ``ask/pygithub2``).
         ``state`` can be either ``open`` or ``closed``.
+
+        This is a conditional request, so if nothing changed since the last
+        call GitHub answers with a 304 and the last list is reused.
         """
         return self.get_values("list", project, state, filter="issues",
-                               datatype=Issue)
+                               datatype=Issue, conditional=True)
 
     def show(self, project, number):
         """Get all the data for issue by issue-number."""
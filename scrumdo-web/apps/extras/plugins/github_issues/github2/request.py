@@ -1,7 +1,8 @@
-import datetime
 import sys
 import time
 import httplib
+import socket
+import threading
 try:
     import json as simplejson  # For Python 2.6
 except ImportError:
@@ -22,6 +23,136 @@ class GithubError(Exception):
     """An error occured when making a request to the Github API."""
 
 
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections per host, so a run of API calls
+    doesn't open a new connection (and do a new TLS handshake) for each one.
+
+    Connections are checked out by one thread at a time, so one pool can be
+    shared by all the sync workers.
+    """
+    connector_for_scheme = {
+        "http": httplib.HTTPConnection,
+        "https": httplib.HTTPSConnection,
+    }
+
+    def __init__(self, max_idle=4, timeout=60):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, netloc):
+        """Returns ``(connection, reused)``."""
+        self.lock.acquire()
+        try:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        finally:
+            self.lock.release()
+        connector = self.connector_for_scheme[scheme]
+        return connector(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, connection):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def close_all(self):
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+class TokenBucket(object):
+    """Allows ``rate`` requests a second on average, with bursts of up to
+    ``capacity``.  ``acquire`` blocks until a request is allowed."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return 0
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(account, rate):
+    """The rate limit is per account, so every request made for the same
+    account in this process shares one bucket."""
+    _buckets_lock.acquire()
+    try:
+        key = (account, rate)
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(rate)
+        return _buckets[key]
+    finally:
+        _buckets_lock.release()
+
+
+class ResponseCache(object):
+    """Remembers the ETag, Last-Modified and body of GET responses, so the
+    next request for the same URL can be conditional.  A 304 answer then
+    costs no rate limit on GitHub's side and no parsing on ours."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, url):
+        self.lock.acquire()
+        try:
+            return self.entries.get(url)
+        finally:
+            self.lock.release()
+
+    def set(self, url, etag, last_modified, json):
+        if not (etag or last_modified):
+            return
+        self.lock.acquire()
+        try:
+            if len(self.entries) >= self.max_entries and url not in self.entries:
+                self.entries.clear()
+            self.entries[url] = (etag, last_modified, json)
+        finally:
+            self.lock.release()
+
+
+default_pool = ConnectionPool()
+default_response_cache = ResponseCache()
+
+
 class GithubRequest(object):
     github_url = GITHUB_URL
     url_format = "%(github_url)s/api/%(api_version)s/%(api_format)s"
@@ -29,13 +160,9 @@ class GithubRequest(object):
     api_format = "json"
     GithubError = GithubError
 
-    connector_for_scheme = {
-        "http": httplib.HTTPConnection,
-        "https": httplib.HTTPSConnection,
-    }
-
     def __init__(self, username=None, api_token=None, url_prefix=None,
-            debug=False, requests_per_second=None, access_token=None):
+            debug=False, requests_per_second=None, access_token=None,
+            pool=None, response_cache=None):
         """
         Make an API request.
         """
@@ -44,11 +171,12 @@ class GithubRequest(object):
         self.access_token = access_token
         self.url_prefix = url_prefix
         self.debug = debug
+        self.pool = pool or default_pool
+        self.response_cache = response_cache or default_response_cache
         if requests_per_second is None:
-            self.delay = 0
+            self.bucket = None
         else:
-            self.delay = 1.0 / requests_per_second
-        self.last_request = datetime.datetime(1900, 1, 1)
+            self.bucket = bucket_for(username or access_token, requests_per_second)
         if not self.url_prefix:
             self.url_prefix = self.url_format % {
                 "github_url": self.github_url,
@@ -67,36 +195,31 @@ class GithubRequest(object):
         post_data.update(extra_post_data)
         return urlencode(dict([k, v.encode('utf-8')] for k, v in post_data.items()))
 
-    def get(self, *path_components):
+    def get(self, *path_components, **kwargs):
         path_components = filter(None, path_components)
-        return self.make_request("/".join(path_components))
+        return self.make_request("/".join(path_components),
+            conditional=kwargs.get("conditional", False))
 
     def post(self, *path_components, **extra_post_data):
         path_components = filter(None, path_components)
         return self.make_request("/".join(path_components), extra_post_data,
             method="POST")
 
-    def make_request(self, path, extra_post_data=None, method="GET"):
-        if self.delay:
-            since_last = (datetime.datetime.now() - self.last_request)
-            since_last_in_seconds = (since_last.days * 24 * 60 * 60) + since_last.seconds + (since_last.microseconds/1000000.0)
-            if since_last_in_seconds < self.delay:
-                duration = self.delay - since_last_in_seconds
-                if self.debug:
-                    sys.stderr.write("delaying API call %s\n" % duration)
-                time.sleep(duration)
+    def make_request(self, path, extra_post_data=None, method="GET",
+            conditional=False):
+        if self.bucket is not None:
+            self.bucket.acquire()
 
         extra_post_data = extra_post_data or {}
         url = "/".join([self.url_prefix, path])
-        result = self.raw_request(url, extra_post_data, method=method)
-
-        if self.delay:
-            self.last_request = datetime.datetime.now()
-        return result
+        return self.raw_request(url, extra_post_data, method=method,
+                                conditional=conditional)
 
-    def raw_request(self, url, extra_post_data, method="GET"):
+    def raw_request(self, url, extra_post_data, method="GET",
+            conditional=False):
+        """``conditional`` GETs send the ETag / Last-Modified from the last
+        response for the same URL, and reuse its body on a 304."""
         scheme, netloc, path, params, query, fragment = urlparse(url)
-        hostname = netloc.split(':')[0]
         post_data = None
         headers = self.http_headers
         headers["Accept"] = "text/html"
@@ -105,17 +228,25 @@ class GithubRequest(object):
             post_data = self.encode_authentication_data(extra_post_data)
             headers["Content-Length"] = str(len(post_data))
         else:
-            path = urlunparse((scheme, netloc, path, params,
+            path = urlunparse(("", "", path, params,
                 self.encode_authentication_data(parse_qs(query)),
                 fragment))
-        connector = self.connector_for_scheme[scheme]
-        connection = connector(hostname)
-        connection.request(method, path, post_data, headers)
-        response = connection.getresponse()
-        response_text = response.read()
+        cached = None
+        if conditional and method == "GET":
+            cached = self.response_cache.get(url)
+            if cached is not None:
+                etag, last_modified, json = cached
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+        response, response_text = self._send(scheme, netloc, method, path,
+                                             post_data, headers)
         if self.debug:
             sys.stderr.write("URL:[%s] POST_DATA:%s RESPONSE_TEXT: [%s]\n" % (
                                 path, post_data, response_text))
+        if response.status == 304 and cached is not None:
+            return cached[2]
         if response.status >= 400:
             raise RuntimeError("unexpected response from github.com %d: %r" % (
                                response.status, response_text))
@@ -123,8 +254,34 @@ class GithubRequest(object):
         if json.get("error"):
             raise self.GithubError(json["error"][0]["error"])
 
+        if conditional and method == "GET":
+            self.response_cache.set(url, response.getheader("ETag"),
+                                    response.getheader("Last-Modified"), json)
         return json
 
+    def _send(self, scheme, netloc, method, path, body, headers):
+        """Sends a request on a pooled connection.  If a reused connection
+        turns out to have been closed by the server while it sat idle, the
+        request is sent once more on a new one."""
+        while True:
+            connection, reused = self.pool.get(scheme, netloc)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response_text = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                # Only retry when the request can't have been acted on twice.
+                if reused and (method == "GET" or
+                               isinstance(e, httplib.BadStatusLine)):
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(scheme, netloc, connection)
+            return response, response_text
+
     @property
     def http_headers(self):
         return {"User-Agent": "pygithub2 v1",
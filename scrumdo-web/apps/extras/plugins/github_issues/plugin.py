@@ -19,6 +19,9 @@ from projects.models import Story
 
 logger = logging.getLogger(__name__)
 
+# How many issues to match up against stories per query.
+PULL_CHUNK_SIZE = 500
+
 class Plugin( ScrumdoProjectExtra ):
     """ This Extra allows you to syncronize your GitHub issues with your ScrumDo stories. """
 
@@ -146,24 +149,24 @@ class Plugin( ScrumdoProjectExtra ):
 
         logging.debug("Retrieved %d GitHub issues" % len(issues) )
 
-        queue_stories = StoryQueue.objects.filter( project=project, extra_slug=self.getSlug() )
-        logging.debug("%d stories already sitting in the story queue" % len(queue_stories) )
-        project_stories = self._getStoriesInProjectAssociatedWithExtra( project )
-        logging.debug("%d stories in the project associated with GitHub issues" % len(project_stories) )
-
-        for issue in issues:
-            story = self._getStory( issue.number, queue_stories, project_stories)
-            if story is None:
-                self._createStoryForIssue( issue, project , configuration.get('repository'))
-            else:
-                if story.summary != issue.title or story.detail != issue.body :
-                    logging.debug("Updating story %d." % story.id )
-                    story.summary=issue.title
-                    story.detail=issue.body
-                    story.save()
-
-
-
+        # Only issues changed since the last pull need looking at.  The API doesn't take a since
+        # parameter, but issues.list is a conditional request, so when nothing changed at all
+        # GitHub doesn't send the list again.  The cursor is GitHub's own updated_at, so our clock
+        # doesn't matter.  Saving the configuration form starts a new dict, so that does a full pull.
+        # GitHub's timestamps are whole seconds, so issues updated in the same second as the cursor are
+        # looked at again, in case they changed after the last pull.  Unchanged stories aren't saved.
+        since = configuration.get("since")
+        if since is not None:
+            issues = [issue for issue in issues if issue.updated_at is None or issue.updated_at >= since]
+        logging.debug("%d GitHub issues changed since %s" % (len(issues), since) )
+
+        for start in range(0, len(issues), PULL_CHUNK_SIZE):
+            self._pullIssues( issues[start:start + PULL_CHUNK_SIZE], project, configuration.get('repository') )
+            for issue in issues[start:start + PULL_CHUNK_SIZE]:
+                if issue.updated_at is not None and (since is None or issue.updated_at > since):
+                    since = issue.updated_at
+
+        configuration["since"] = since
         configuration["status"] = "Synchronized with GitHub on " + str( datetime.date.today()  )
         logging.debug("pullProject complete, saving configuration.")
         self.saveConfiguration( project.slug, configuration )
@@ -235,37 +238,35 @@ class Plugin( ScrumdoProjectExtra ):
 
 
 
+    def _pullIssues( self, issues, project, repository ):
+        """ Creates or updates the queued or project story for each issue.  Stories are found with one query
+            each for the queue and the mappings, and only the ones that changed are saved. """
+        external_ids = [str(issue.number) for issue in issues]
+        queue_stories = dict( (str(queue_story.external_id), queue_story) for queue_story in
+                              StoryQueue.objects.filter( project=project, extra_slug=self.getSlug(), external_id__in=external_ids ) )
+        project_stories = dict( (str(link.external_id), link.story) for link in
+                                ExternalStoryMapping.objects.filter( story__project=project, extra_slug=self.getSlug(),
+                                                                     external_id__in=external_ids ).select_related("story") )
+        for issue in issues:
+            story = queue_stories.get( str(issue.number), project_stories.get( str(issue.number) ) )
+            if story is None:
+                self._createStoryForIssue( issue, project , repository )
+            elif story.summary != issue.title or story.detail != issue.body :
+                logging.debug("Updating story %d." % story.id )
+                story.summary=issue.title
+                story.detail=issue.body
+                story.save()
+
     def _createStoryForIssue( self, issue, project , repository):
         logging.debug("Attempting to create new StoryQueue object for issue %d" % issue.number )
-        try:
-            story = StoryQueue.objects.get( project=project, external_id=issue.number)
-            # Odd, it already exists!
-            story.summary=issue.title
-            story.detail=issue.body
-        except StoryQueue.DoesNotExist:
-            story = StoryQueue(project=project,
-                             extra_slug=self.getSlug(),
-                             external_id=issue.number,
-                             external_url="https://github.com/%s/issues/#issue/%d" % (repository, issue.number),
-                             summary=issue.title,
-                             detail=issue.body )
+        story = StoryQueue(project=project,
+                         extra_slug=self.getSlug(),
+                         external_id=issue.number,
+                         external_url="https://github.com/%s/issues/#issue/%d" % (repository, issue.number),
+                         summary=issue.title,
+                         detail=issue.body )
         story.save()
 
-    def _getStoriesInProjectAssociatedWithExtra(self, project):
-        rv = []
-        for story in project.stories.all():
-            if self._getExternalLink( story ) is not None:
-                rv.append( story )
-
-        return rv
-
-    def _getStory( self, external_id, queue_stories, project_stories ):
-        """ Pass in an external id, list of stories in the queue, and a list of stories in the project, and will return the story if the it exists in either list. """
-        story = self._getStoryFromQueue( external_id, queue_stories)
-        if story is not None:
-            return story
-        return self._getStoryFromProject( external_id, project_stories )
-
     def _initialUpload(self, project, configuration):
         configuration = self.getConfiguration( project.slug )
         github = Github(username=configuration.get('username'), api_token=configuration.get('password'),requests_per_second=1)
@@ -280,18 +281,3 @@ class Plugin( ScrumdoProjectExtra ):
             if link.extra_slug == self.getSlug():
                 return link
         return None
-
-    def _getStoryFromProject(self, external_id, project_stories ):
-        """ Returns the story from the list with the given external ID for this extra. """
-        for project_story in project_stories:
-            for link in project_story.external_links.all():
-                if link.extra_slug == self.getSlug() and str(link.external_id)==str(external_id):
-                    return project_story
-        return None
-
-    def _getStoryFromQueue(self, external_id, queue_stories ):
-        """ Returns the story from the list of StoryQueue objects with the given external id. """
-        for queue_story in queue_stories:
-            if queue_story.extra_slug == self.getSlug() and int(queue_story.external_id)==external_id:
-                return queue_story
-        return None
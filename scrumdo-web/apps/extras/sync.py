@@ -0,0 +1,320 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Runs the SyncronizationQueue for the extras_sync command.
+#
+# Several worker threads run at once.  A worker claims a whole project by inserting its
+# SyncronizationClaim row, runs that project's queue in order, and lets it go.  The claim's
+# project column is unique, so a slow remote service only holds up the project it's working
+# on.  An action that fails is retried later with a growing delay, and the actions queued
+# after it for the same story wait for it.  After EXTRAS_SYNC_MAX_ATTEMPTS failures the item
+# is moved to SyncronizationDeadLetter.
+#
+# A story or task deleted while its create is running is queued for deletion by id, since
+# there's no external id yet.  The worker fills that in once the create is done.
+
+from datetime import datetime, timedelta
+import random
+import threading
+import time
+import uuid
+import urllib2
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+
+from extras.models import SyncronizationQueue, SyncronizationClaim, SyncronizationDeadLetter, ExternalStoryMapping, \
+    ExternalTaskMapping
+from extras.manager import manager
+
+import sys
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+
+SYNC_WORKERS = getattr(settings, "EXTRAS_SYNC_WORKERS", 4)
+MAX_ATTEMPTS = getattr(settings, "EXTRAS_SYNC_MAX_ATTEMPTS", 6)
+RETRY_SECONDS = getattr(settings, "EXTRAS_SYNC_RETRY_SECONDS", 60)
+MAX_RETRY_SECONDS = 6 * 60 * 60
+
+# A claim that hasn't been touched in this long belongs to a worker that died, and can be taken over.
+CLAIM_TIMEOUT = timedelta(seconds=getattr(settings, "EXTRAS_SYNC_CLAIM_TIMEOUT", 60 * 60))
+
+
+def runAction(queueItem):
+    "Calls the extra for one queue item.  Exceptions are left for the caller."
+    project = queueItem.project
+    story = queueItem.story
+    task = queueItem.task
+    action = queueItem.action
+    external_id = queueItem.external_id
+
+    extra = manager.getExtra( queueItem.extra_slug )
+
+    if action == SyncronizationQueue.ACTION_SYNC_REMOTE:
+        extra.pullProject(project)
+    elif action == SyncronizationQueue.ACTION_STORY_UPDATED:
+        extra.storyUpdated(project,story)
+    elif action == SyncronizationQueue.ACTION_STORY_DELETED:
+        extra.storyDeleted(project,external_id)
+    elif action == SyncronizationQueue.ACTION_STORY_CREATED:
+        extra.storyCreated(project,story)
+    elif action == SyncronizationQueue.ACTION_STORY_STATUS_CHANGED:
+        extra.storyStatusChange(project, story)
+    elif action == SyncronizationQueue.ACTION_INITIAL_SYNC:
+        extra.initialSync( project )
+    elif action == SyncronizationQueue.ACTION_TASK_UPDATED:
+        extra.taskUpdated(project, task)
+    elif action == SyncronizationQueue.ACTION_TASK_DELETED:
+        extra.taskDeleted(project, external_id)
+    elif action == SyncronizationQueue.ACTION_TASK_CREATED:
+        extra.taskCreated(project, task)
+    elif action == SyncronizationQueue.ACTION_TASK_STATUS_CHANGED:
+        extra.taskStatusChange(project, task)
+    elif action == SyncronizationQueue.ACTION_STORY_IMPORTED:
+        extra.storyImported(project, story)
+
+
+def retryDelay(attempts):
+    "Doubles with every failure, with some jitter so a service that was down doesn't get everything at once."
+    delay = min(RETRY_SECONDS * (2 ** (attempts - 1)), MAX_RETRY_SECONDS)
+    return timedelta(seconds=delay + random.uniform(0, delay / 4.0))
+
+
+def claimProject(token):
+    "Claims a project with queue items that are due.  Returns the project id, or None if there's nothing to do."
+    now = datetime.now()
+    SyncronizationClaim.objects.filter(claimed__lt=now - CLAIM_TIMEOUT).delete()
+    claimed = list(SyncronizationClaim.objects.values_list("project_id", flat=True))
+    due = SyncronizationQueue.objects.filter(Q(next_attempt__isnull=True) | Q(next_attempt__lte=now)) \
+                                     .exclude(project__in=claimed)
+    project_ids = list(set(due.values_list("project_id", flat=True)[:200]))
+    # Keeps the workers from all going for the same project.
+    random.shuffle(project_ids)
+    for project_id in project_ids:
+        try:
+            SyncronizationClaim(project_id=project_id, token=token).save()
+            return project_id
+        except IntegrityError:
+            # Another worker got there first.
+            transaction.rollback_unless_managed()
+    return None
+
+
+def releaseProject(project_id, token):
+    SyncronizationClaim.objects.filter(project=project_id, token=token).delete()
+
+
+# After a create runs, any edits that were folded into it while it ran still need sending.
+FOLLOW_UP_ACTIONS = {
+    SyncronizationQueue.ACTION_STORY_CREATED: SyncronizationQueue.ACTION_STORY_UPDATED,
+    SyncronizationQueue.ACTION_TASK_CREATED: SyncronizationQueue.ACTION_TASK_UPDATED,
+}
+
+
+# create action -> (link model, field, delete action)
+CREATED_LINKS = {
+    SyncronizationQueue.ACTION_STORY_CREATED: (ExternalStoryMapping, "story", SyncronizationQueue.ACTION_STORY_DELETED),
+    SyncronizationQueue.ACTION_TASK_CREATED: (ExternalTaskMapping, "task", SyncronizationQueue.ACTION_TASK_DELETED),
+}
+
+
+def _runCreate(queueItem):
+    """ Runs a create.  If the story or task was deleted while the extra was creating it, the delete was
+        queued by id (see ExtrasManager._queueDelete) and the link the extra just saved points at a row
+        that's gone.  The create runs in one transaction, so that link can be swapped for the delete's
+        external id before anything is committed. """
+    link_model, field_name, delete_action = CREATED_LINKS[queueItem.action]
+    item_id = getattr(queueItem, "%s_id" % field_name)
+    with transaction.commit_on_success():
+        runAction(queueItem)
+        deletes = SyncronizationQueue.objects.filter(project=queueItem.project_id, extra_slug=queueItem.extra_slug,
+                                                     action=delete_action, deleted_id=item_id)
+        if deletes.exists():
+            links = link_model.objects.filter(extra_slug=queueItem.extra_slug, **{"%s__id" % field_name: item_id})
+            external_ids = list(links.values_list("external_id", flat=True)[:1])
+            links.delete()
+            if len(external_ids) > 0:
+                deletes.update(external_id=external_ids[0], deleted_id=None)
+
+
+def _deleteReady(queueItem):
+    """ For a delete queued by id.  The create it was waiting for ran before it in this project's queue,
+        so by now the external id is filled in, or nothing was created and there's nothing to delete.
+        Returns True if the delete should run. """
+    try:
+        fresh = SyncronizationQueue.objects.get(id=queueItem.id)
+    except SyncronizationQueue.DoesNotExist:
+        return False
+    if fresh.external_id is None:
+        logger.debug("Dropping the delete of an item that was never created")
+        fresh.delete()
+        return False
+    queueItem.external_id = fresh.external_id
+    return True
+
+
+def _finished(queueItem):
+    """ Removes a queue item whose action just ran.  ExtrasManager.queueSyncAction touches queue_date when
+        it folds a new change into a pending item, so if that happened while this one ran, it stays
+        queued to send the change. """
+    SyncronizationQueue.objects.filter(id=queueItem.id, queue_date=queueItem.queue_date).delete()
+    if queueItem.action in FOLLOW_UP_ACTIONS:
+        SyncronizationQueue.objects.filter(id=queueItem.id).update(action=FOLLOW_UP_ACTIONS[queueItem.action])
+
+
+def _deadLetter(queueItem, error):
+    SyncronizationDeadLetter(project_id=queueItem.project_id, story_id=queueItem.story_id, task_id=queueItem.task_id,
+                             extra_slug=queueItem.extra_slug, action=queueItem.action, queue_date=queueItem.queue_date,
+                             external_id=queueItem.external_id, attempts=queueItem.attempts, error=error).save()
+    queueItem.delete()
+
+
+# delete action -> what its deleted_id refers to
+DELETED_KINDS = {
+    SyncronizationQueue.ACTION_STORY_DELETED: "story",
+    SyncronizationQueue.ACTION_TASK_DELETED: "task",
+}
+
+
+def _waitKeys(queueItem):
+    """ What a queue item has to stay in order with.  When an item fails, later items that share any of
+        its keys wait for its retry.  A delete queued by id shares the key of the create it follows, a
+        delete by external id and the project wide actions like SYNC_REMOTE only wait on themselves. """
+    keys = set()
+    if queueItem.story_id is not None:
+        keys.add(("story", queueItem.story_id))
+    if queueItem.task_id is not None:
+        keys.add(("task", queueItem.task_id))
+    if queueItem.deleted_id is not None:
+        keys.add((DELETED_KINDS.get(queueItem.action), queueItem.deleted_id))
+    if len(keys) == 0 and queueItem.external_id is not None:
+        keys.add(("external", queueItem.action, queueItem.external_id))
+    if len(keys) == 0:
+        keys.add(("project", queueItem.action))
+    return keys
+
+
+def processProject(project_id, token):
+    """ Runs the queue for a project this worker has claimed, oldest first.  When an item fails, the
+        later items for the same story, task or project action are left for after its retry, see
+        _waitKeys.  Returns the number of items run. """
+    processed = 0
+    waiting = set()
+    for queueItem in SyncronizationQueue.objects.filter(project=project_id).select_related("project").order_by("id"):
+        keys = _waitKeys(queueItem)
+        if not waiting.isdisjoint(keys):
+            continue
+        if queueItem.next_attempt is not None and queueItem.next_attempt > datetime.now():
+            waiting.update(keys)
+            continue
+        if not queueItem.project.active:
+            queueItem.delete()
+            continue
+        if queueItem.deleted_id is not None and not _deleteReady(queueItem):
+            continue
+
+        logger.info("== Synchronizing %s / %s / %d" % (queueItem.project.slug, queueItem.extra_slug, queueItem.action) )
+        try:
+            if queueItem.action in CREATED_LINKS:
+                _runCreate(queueItem)
+            else:
+                runAction(queueItem)
+            _finished(queueItem)
+            logger.info("Success.")
+        except:
+            error = traceback.format_exc()
+            e = sys.exc_info()[1]
+            if isinstance(e, urllib2.HTTPError):
+                logger.error("HTTP Error %d occured while processing a syncronization queue item." % e.code)
+                logger.error(e.headers)
+            else:
+                logger.error("Error occured while processing a syncronization queue item.")
+            traceback.print_exc(file=sys.stdout)
+
+            queueItem.attempts += 1
+            if queueItem.attempts >= MAX_ATTEMPTS:
+                logger.error("Giving up on syncronization queue item %d after %d attempts." % (queueItem.id, queueItem.attempts))
+                _deadLetter(queueItem, error)
+            else:
+                queueItem.next_attempt = datetime.now() + retryDelay(queueItem.attempts)
+                # Not save(), the row may have been replaced by a delete while this ran.
+                SyncronizationQueue.objects.filter(id=queueItem.id).update(attempts=queueItem.attempts,
+                                                                           next_attempt=queueItem.next_attempt)
+                waiting.update(keys)
+        processed += 1
+        # Lets other workers know we're still alive.
+        SyncronizationClaim.objects.filter(project=project_id, token=token).update(claimed=datetime.now())
+    return processed
+
+
+def runWorker(loop=False, sleep=10, stop=None):
+    "Claims and runs projects until there's nothing left, or forever if loop is set."
+    token = uuid.uuid4().hex
+    try:
+        while stop is None or not stop.is_set():
+            project_id = claimProject(token)
+            if project_id is None:
+                if not loop:
+                    return
+                time.sleep(sleep)
+                continue
+            try:
+                processProject(project_id, token)
+            except:
+                logger.error("Could not process the syncronization queue for project %d" % project_id)
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                releaseProject(project_id, token)
+    finally:
+        # Each thread has its own database connection.
+        connection.close()
+
+
+def processQueue(workers=SYNC_WORKERS, loop=False, sleep=10):
+    "Runs the queue with a pool of worker threads, until it's empty or, with loop, forever."
+    stop = threading.Event()
+    threads = [threading.Thread(target=runWorker, kwargs={"loop": loop, "sleep": sleep, "stop": stop})
+               for i in range(max(1, workers))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        while any(thread.isAlive() for thread in threads):
+            # join() with a timeout so a KeyboardInterrupt still gets through.
+            for thread in threads:
+                thread.join(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping the sync workers after their current project.")
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def requeueDeadLetters(dead_letters):
+    """ Puts dead letters back on the queue for another set of attempts, at the end of their project's
+        queue.  Returns how many were requeued. """
+    count = 0
+    for dead in dead_letters:
+        SyncronizationQueue(project_id=dead.project_id, story_id=dead.story_id, task_id=dead.task_id,
+                            extra_slug=dead.extra_slug, action=dead.action, external_id=dead.external_id,
+                            queue_date=dead.queue_date).save()
+        dead.delete()
+        count += 1
+    return count
@@ -0,0 +1,171 @@
+import BaseHTTPServer
+import json
+import threading
+import time
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from projects.models import Project, Iteration, Story
+from extras.manager import manager
+from extras.models import SyncronizationQueue, SyncronizationClaim, ExternalStoryMapping
+from extras.sync import processProject
+
+from extras.plugins.github_issues.github2.request import GithubRequest, ConnectionPool, ResponseCache, TokenBucket
+from extras.plugins.github_issues.github2.issues import Issues
+
+
+class StubGithubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Answers issues/list with one issue and an ETag, and with a 304 when asked with that ETag."
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"issues": [{"number": 1, "title": "First issue", "body": "", "state": "open"}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GithubClientTest(TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StubGithubHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.pool = ConnectionPool()
+        request = GithubRequest(username="tester", api_token="token", pool=self.pool, response_cache=ResponseCache(),
+                                url_prefix="http://127.0.0.1:%d/api/v2/json" % self.server.server_port)
+        self.issues = Issues(request)
+
+    def tearDown(self):
+        # The stub server handles one connection at a time, so ours has to be closed before it can stop.
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.issues.list("tester/repo")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(set(client for client, path, etag in self.server.requests)), 1)
+
+    def test_conditional_list(self):
+        first = self.issues.list("tester/repo")
+        second = self.issues.list("tester/repo")
+        self.assertEqual(self.server.requests[0][2], None)
+        self.assertEqual(self.server.requests[1][2], '"v1"')
+        self.assertEqual([issue.title for issue in second], [issue.title for issue in first])
+        self.assertEqual(second[0].number, 1)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(50, capacity=1)
+        start = time.time()
+        for i in range(4):
+            bucket.acquire()
+        # The first one is free, the other three wait 1/50s each.
+        self.assertTrue(time.time() - start >= 0.05)
+
+
+class FakeExtra(object):
+    "Creates every story as external item 42, and records deletes."
+
+    def __init__(self):
+        self.deleted = []
+        self.on_create = None
+
+    def storyCreated(self, project, story):
+        if self.on_create is not None:
+            self.on_create(story)
+        ExternalStoryMapping(story_id=story.id, extra_slug="fake", external_id="42").save()
+
+    def storyDeleted(self, project, external_id):
+        self.deleted.append(external_id)
+
+    def pullProject(self, project):
+        raise IOError("The other side is down")
+
+
+class SyncQueueTest(TestCase):
+    "How ExtrasManager.queueSyncAction folds new actions into the pending ones."
+
+    def setUp(self):
+        self.extra = manager.extras["fake"] = FakeExtra()
+        owner = User.objects.create_user("owner", "owner@example.com", "owner")
+        self.project = Project(name="Sync", slug="sync", creator=owner, description="")
+        self.project.save()
+        iteration = Iteration(name="Iteration 1", project=self.project)
+        iteration.save()
+        self.story = Story(project=self.project, iteration=iteration, creator=owner, local_id=1, rank=10, summary="Story")
+        self.story.save()
+
+    def tearDown(self):
+        del manager.extras["fake"]
+
+    def queue(self, action):
+        manager.queueSyncAction("fake", self.project, action, story=self.story)
+
+    def pending(self):
+        return list(SyncronizationQueue.objects.filter(project=self.project).order_by("id").values_list(
+            "action", "external_id", "deleted_id"))
+
+    def test_edits_fold_into_create(self):
+        self.queue(SyncronizationQueue.ACTION_STORY_CREATED)
+        self.queue(SyncronizationQueue.ACTION_STORY_UPDATED)
+        self.queue(SyncronizationQueue.ACTION_STORY_UPDATED)
+        self.assertEqual(self.pending(), [(SyncronizationQueue.ACTION_STORY_CREATED, None, None)])
+
+    def test_edits_fold_together(self):
+        self.queue(SyncronizationQueue.ACTION_STORY_UPDATED)
+        self.queue(SyncronizationQueue.ACTION_STORY_UPDATED)
+        self.assertEqual(self.pending(), [(SyncronizationQueue.ACTION_STORY_UPDATED, None, None)])
+
+    def test_delete_replaces_edits(self):
+        ExternalStoryMapping(story=self.story, extra_slug="fake", external_id="7").save()
+        self.queue(SyncronizationQueue.ACTION_STORY_UPDATED)
+        self.queue(SyncronizationQueue.ACTION_STORY_DELETED)
+        self.assertEqual(self.pending(), [(SyncronizationQueue.ACTION_STORY_DELETED, "7", None)])
+
+    def test_delete_drops_unsent_create(self):
+        self.queue(SyncronizationQueue.ACTION_STORY_CREATED)
+        self.queue(SyncronizationQueue.ACTION_STORY_DELETED)
+        self.assertEqual(self.pending(), [])
+
+    def test_delete_during_create(self):
+        SyncronizationClaim(project=self.project, token="worker").save()
+        self.queue(SyncronizationQueue.ACTION_STORY_CREATED)
+
+        def deleteStory(story):
+            # The user deletes the story while the extra is still creating it.
+            self.queue(SyncronizationQueue.ACTION_STORY_DELETED)
+            self.assertEqual(self.pending(), [(SyncronizationQueue.ACTION_STORY_CREATED, None, None),
+                                              (SyncronizationQueue.ACTION_STORY_DELETED, None, story.id)])
+            Story.objects.filter(id=story.id).delete()
+        self.extra.on_create = deleteStory
+
+        processProject(self.project.id, "worker")
+        processProject(self.project.id, "worker")
+        self.assertEqual(self.extra.deleted, ["42"])
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(ExternalStoryMapping.objects.filter(extra_slug="fake").count(), 0)
+
+    def test_failed_pull_doesnt_hold_deletes(self):
+        SyncronizationQueue(project=self.project, extra_slug="fake", action=SyncronizationQueue.ACTION_SYNC_REMOTE).save()
+        ExternalStoryMapping(story=self.story, extra_slug="fake", external_id="7").save()
+        self.queue(SyncronizationQueue.ACTION_STORY_DELETED)
+        processProject(self.project.id, "worker")
+        self.assertEqual(self.extra.deleted, ["7"])
+        self.assertEqual(self.pending(), [(SyncronizationQueue.ACTION_SYNC_REMOTE, None, None)])
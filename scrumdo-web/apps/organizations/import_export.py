@@ -27,8 +27,8 @@ from django.http import HttpResponse
 import projects.xlwt as xlwt
 ezxf = xlwt.easyxf
 
-from projects.import_export import _getHeaders
-from projects.models import Story
+from projects.import_export import _getHeaders, _iterateStories
+from projects.models import Story, Iteration, IterationStats
 
 import logging
 import re
@@ -44,7 +44,72 @@ def cleanWorksheetName( name ):
     tmp = tmp[:31]
     return tmp
 
+class StoryTotals(object):
+    "Running story and point totals for one row of a summary sheet."
+    __slots__ = ("stories", "stories_claimed", "points", "points_claimed")
+
+    def __init__(self):
+        self.stories = 0
+        self.stories_claimed = 0
+        self.points = 0
+        self.points_claimed = 0
+
+    def add(self, points, done):
+        self.stories += 1
+        self.points += points
+        if done:
+            self.stories_claimed += 1
+            self.points_claimed += points
+
+    def write(self, ws, row, col):
+        ws.write(row, col, self.stories)
+        ws.write(row, col + 1, self.stories_claimed)
+        ws.write(row, col + 2, self.points)
+        ws.write(row, col + 3, self.points_claimed)
+
+
+def _totalsFor(table, key):
+    totals = table.get(key)
+    if totals is None:
+        totals = table[key] = StoryTotals()
+    return totals
+
+
+class ProjectSummary(object):
+    """ Every aggregate the organization export needs for one project, built up one story at a time
+        so the stories only have to be read once. """
+
+    def __init__(self, project, iterations):
+        self.project = project
+        self.iterations = iterations
+        self.totals = StoryTotals()
+        self.tags = {}
+        self.categories = {}
+        self.iteration_totals = dict((iteration.id, StoryTotals()) for iteration in iterations)
+        self.iteration_tags = dict((iteration.id, {}) for iteration in iterations)
+        self.iteration_categories = dict((iteration.id, {}) for iteration in iterations)
+
+    def add(self, story, tag_names):
+        points = story.points_value()
+        done = story.status == Story.STATUS_DONE
+        self.totals.add(points, done)
+        _totalsFor(self.categories, story.category).add(points, done)
+        for tag_name in tag_names:
+            _totalsFor(self.tags, tag_name).add(points, done)
+        if story.iteration_id in self.iteration_totals:
+            self.iteration_totals[story.iteration_id].add(points, done)
+            _totalsFor(self.iteration_categories[story.iteration_id], story.category).add(points, done)
+            for tag_name in tag_names:
+                _totalsFor(self.iteration_tags[story.iteration_id], tag_name).add(points, done)
+
+
 def export_organization( organization, project_ids=None):
+    """ Exports an organization's projects to an Excel workbook, one sheet of stories per project
+        plus summary sheets by project, iteration, tag and category.
+
+        Each project's stories are read once, in chunks with their tags, and written to the project's
+        sheet while the ProjectSummary for the summary sheets is built up.  The summary sheets are
+        then written from those totals. """
     response = HttpResponse( mimetype="Application/vnd.ms-excel")
     response['Content-Disposition'] = 'attachment; filename=organization.xls'
     w = xlwt.Workbook(encoding='utf8')
@@ -57,9 +122,6 @@ def export_organization( organization, project_ids=None):
     tags_ws = w.add_sheet( "Tags" )
     it_ws = w.add_sheet( "Iterations x Tags" )
 
-    date_xf = xlwt.XFStyle()
-    date_xf.num_format_str = 'MM/dd/YYYY'
-
     _write_headers( projects_ws, [("Project",250),("Stories",50),("Stories Claimed",60),("Points",50),("Points Claimed",60) ] )
     _write_headers( tags_ws, [("Project",250),("Tag",100),("Stories",50),("Stories Claimed",60),("Points",50),("Points Claimed",60) ] )
     _write_headers( iterations_ws, [("Project",250),("Iteration",100),("Start",80),("End",80),("Stories",50),("Stories Claimed",60),("Points",50),("Points Claimed",60),("Starting Points", 60), ("Max Points",60) ] )
@@ -67,18 +129,24 @@ def export_organization( organization, project_ids=None):
     _write_headers( category_ws, [("Project",250),("Category",100),("Stories",50),("Stories Claimed",60),("Points",50),("Points Claimed",60)] )
     _write_headers( ic_ws, [("Project",250),("Iteration",100),("Category",110),("Start",80),("End",80),("Stories",50),("Stories Claimed",60),("Points",50),("Points Claimed",60) ] )
 
+    projects = organization.projects.filter(active=True)
+    if project_ids:
+        projects = projects.filter(id__in=project_ids)
+    projects = list(projects)
+
+    iterations = {}
+    for iteration in Iteration.objects.filter(project__in=projects):
+        iterations.setdefault(iteration.project_id, []).append(iteration)
+    iteration_stats = dict((stats.iteration_id, stats) for stats in IterationStats.objects.filter(iteration__project__in=projects))
+    missing_stats = [iteration.id for project_iterations in iterations.values() for iteration in project_iterations if iteration.id not in iteration_stats]
+    if len(missing_stats) > 0:
+        iteration_stats.update(IterationStats.rebuild(missing_stats))
+
+    summaries = []
+    for project in projects:
+        summary = ProjectSummary(project, iterations.get(project.id, []))
+        summaries.append(summary)
 
-    project_row = 1
-    tags_row = 1
-    categories_row = 1
-    iteration_categories_row = 1
-    iterations_row = 1
-    iteration_tags_row = 1
-    for project in organization.projects.filter(active=True):
-        if project_ids:
-            if project.id not in project_ids:
-                continue
-        
         story_headers = _getHeaders( project )
         project_ws = w.add_sheet( cleanWorksheetName(project.name) )
 
@@ -86,171 +154,87 @@ def export_organization( organization, project_ids=None):
             project_ws.write(0,idx,header[1],heading_xf)
             project_ws.col(idx).width = 37*header[0]
 
-        for idx, story in enumerate(project.stories.all().order_by("iteration","rank")):
+        for idx, story in enumerate(_iterateStories(project.stories.all().order_by("iteration","rank"))):
             for hidx, header in enumerate(story_headers):
                 f = header[2]
                 project_ws.write(1+idx,hidx, f(story), header[3] )
+            summary.add(story, story._prefetched_tag_names)
+
+    _writeSummarySheets(summaries, iteration_stats, projects_ws, iterations_ws, category_ws, ic_ws, tags_ws, it_ws)
+
+    w.save(response)
+    return response
+
 
-        stories = project.stories.all()
-        completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-        projects_ws.write(project_row,0, project.name )
-        projects_ws.write(project_row,1, len(stories) )
-        projects_ws.write(project_row,2, len(completed_stories) )
-        projects_ws.write(project_row,3, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        projects_ws.write(project_row,4, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-
-        it_ws.write(iteration_tags_row,0, project.name )
-        it_ws.write(iteration_tags_row,5, len(stories) )
-        it_ws.write(iteration_tags_row,6, len(completed_stories) )
-        it_ws.write(iteration_tags_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        it_ws.write(iteration_tags_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-
-        ic_ws.write(iteration_categories_row,0, project.name )
-        ic_ws.write(iteration_categories_row,5, len(stories) )
-        ic_ws.write(iteration_categories_row,6, len(completed_stories) )
-        ic_ws.write(iteration_categories_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        ic_ws.write(iteration_categories_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-
-        iterations_ws.write(iterations_row,0, project.name )
-        iterations_ws.write(iterations_row,4, len(stories) )
-        iterations_ws.write(iterations_row,5, len(completed_stories) )
-        iterations_ws.write(iterations_row,6, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        iterations_ws.write(iterations_row,7, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-        
-
-        tags_ws.write(tags_row,0, project.name )
-        tags_ws.write(tags_row,2, len(stories) )
-        tags_ws.write(tags_row,3, len(completed_stories) )
-        tags_ws.write(tags_row,4, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        tags_ws.write(tags_row,5, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-
-        category_ws.write(categories_row,0, project.name )
-        category_ws.write(categories_row,2, len(stories) )
-        category_ws.write(categories_row,3, len(completed_stories) )
-        category_ws.write(categories_row,4, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-        category_ws.write(categories_row,5, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
+def _writeSummarySheets(summaries, iteration_stats, projects_ws, iterations_ws, category_ws, ic_ws, tags_ws, it_ws):
+    date_xf = xlwt.XFStyle()
+    date_xf.num_format_str = 'MM/dd/YYYY'
 
+    project_row = 1
+    tags_row = 1
+    categories_row = 1
+    iteration_categories_row = 1
+    iterations_row = 1
+    iteration_tags_row = 1
+    for summary in summaries:
+        name = summary.project.name
+        projects_ws.write(project_row, 0, name)
+        summary.totals.write(projects_ws, project_row, 1)
         project_row += 1
+
+        # Each of the other sheets starts the project with a row of project totals.
+        for ws, row, col in ((it_ws, iteration_tags_row, 5), (ic_ws, iteration_categories_row, 5),
+                             (iterations_ws, iterations_row, 4), (tags_ws, tags_row, 2), (category_ws, categories_row, 2)):
+            ws.write(row, 0, name)
+            summary.totals.write(ws, row, col)
         tags_row += 1
         categories_row += 1
         iteration_categories_row += 1
         iterations_row += 1
         iteration_tags_row += 1
 
-        tags = {}
-        categories = {}
-
-
-        # Summarize the stories in each tag/category
-        for story in stories:
-            if story.category in categories:
-                categories[story.category].append(story)
-            else:
-                categories[story.category] = [story]
-
-            for tag in story.story_tags.all():
-                tagname = tag.name
-                if tagname in tags:
-                    tags[tagname].append( story )
-                else:
-                    tags[tagname] = [story]
-
-        # Write out the tag sheet
-        for tag in tags :
-            stories = tags[tag]
-            completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-            tags_ws.write(tags_row,1,tag)
-            tags_ws.write(tags_row,2, len(stories) )
-            tags_ws.write(tags_row,3, len(completed_stories) )
-            tags_ws.write(tags_row,4, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-            tags_ws.write(tags_row,5, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
+        for tag in sorted(summary.tags):
+            tags_ws.write(tags_row, 1, tag)
+            summary.tags[tag].write(tags_ws, tags_row, 2)
             tags_row += 1
 
-        # Write out the category sheet
-        for category in categories:
-            stories = categories[category]
-            completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-            category_ws.write(categories_row,1,category)
-            category_ws.write(categories_row,2, len(stories) )
-            category_ws.write(categories_row,3, len(completed_stories) )
-            category_ws.write(categories_row,4, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-            category_ws.write(categories_row,5, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
+        for category in sorted(summary.categories):
+            category_ws.write(categories_row, 1, category)
+            summary.categories[category].write(category_ws, categories_row, 2)
             categories_row += 1
 
-        for iteration in project.iterations.all():
-            itags = {}
-            icategories = {}
-            stories = iteration.stories.all()
-
-            # Summarize the stories in categories / tags
-            for story in stories:
-                if story.category in icategories:
-                    icategories[story.category].append(story)
-                else:
-                    icategories[story.category] = [story]
-                for tag in story.story_tags.all():
-                    tagname = tag.name
-                    if tagname in itags:
-                        itags[tagname].append( story )
-                    else:
-                        itags[tagname] = [story]
-            completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-            iterations_ws.write(iterations_row,1, iteration.name)
-            iterations_ws.write(iterations_row,2, iteration.start_date , date_xf)
-            iterations_ws.write(iterations_row,3, iteration.end_date , date_xf)
-            iterations_ws.write(iterations_row,4, len(stories) )
-            iterations_ws.write(iterations_row,5, len(completed_stories) )
-            iterations_ws.write(iterations_row,6, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-            iterations_ws.write(iterations_row,7, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-            iterations_ws.write(iterations_row,8, iteration.starting_points()  )
-            iterations_ws.write(iterations_row,9, iteration.max_points() )
-
-            ic_ws.write(iteration_categories_row,1, iteration.name)
-            ic_ws.write(iteration_categories_row,3, iteration.start_date , date_xf)
-            ic_ws.write(iteration_categories_row,4, iteration.end_date , date_xf)
-            ic_ws.write(iteration_categories_row,5, len(stories) )
-            ic_ws.write(iteration_categories_row,6, len(completed_stories) )
-            ic_ws.write(iteration_categories_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-            ic_ws.write(iteration_categories_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-
-            it_ws.write(iteration_tags_row,1, iteration.name)
-            it_ws.write(iteration_tags_row,3, iteration.start_date , date_xf)
-            it_ws.write(iteration_tags_row,4, iteration.end_date , date_xf)
-            it_ws.write(iteration_tags_row,5, len(stories) )
-            it_ws.write(iteration_tags_row,6, len(completed_stories) )
-            it_ws.write(iteration_tags_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-            it_ws.write(iteration_tags_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
-            
+        for iteration in summary.iterations:
+            totals = summary.iteration_totals[iteration.id]
+            stats = iteration_stats[iteration.id]
+            iterations_ws.write(iterations_row, 1, iteration.name)
+            iterations_ws.write(iterations_row, 2, iteration.start_date, date_xf)
+            iterations_ws.write(iterations_row, 3, iteration.end_date, date_xf)
+            totals.write(iterations_ws, iterations_row, 4)
+            iterations_ws.write(iterations_row, 8, stats.starting_points)
+            iterations_ws.write(iterations_row, 9, stats.max_points)
             iterations_row += 1
-            iteration_tags_row += 1
+
+            for ws, row in ((ic_ws, iteration_categories_row), (it_ws, iteration_tags_row)):
+                ws.write(row, 1, iteration.name)
+                ws.write(row, 3, iteration.start_date, date_xf)
+                ws.write(row, 4, iteration.end_date, date_xf)
+                totals.write(ws, row, 5)
             iteration_categories_row += 1
-            for category in icategories:
-                stories = icategories[category]
-                completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-                ic_ws.write(iteration_categories_row,2,category)
-                ic_ws.write(iteration_categories_row,5, len(stories) )
-                ic_ws.write(iteration_categories_row,6, len(completed_stories) )
-                ic_ws.write(iteration_categories_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-                ic_ws.write(iteration_categories_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
+            iteration_tags_row += 1
+
+            categories = summary.iteration_categories[iteration.id]
+            for category in sorted(categories):
+                ic_ws.write(iteration_categories_row, 2, category)
+                categories[category].write(ic_ws, iteration_categories_row, 5)
                 iteration_categories_row += 1
 
-            for tag in itags :
-                stories = itags[tag]
-                completed_stories = [story for story in stories if story.status==Story.STATUS_DONE ]
-                it_ws.write(iteration_tags_row,2,tag)
-                it_ws.write(iteration_tags_row,5, len(stories) )
-                it_ws.write(iteration_tags_row,6, len(completed_stories) )
-                it_ws.write(iteration_tags_row,7, reduce( lambda total,story: total+story.points_value(), stories, 0 ) )
-                it_ws.write(iteration_tags_row,8, reduce( lambda total,story: total+story.points_value(), completed_stories, 0 ) )
+            tags = summary.iteration_tags[iteration.id]
+            for tag in sorted(tags):
+                it_ws.write(iteration_tags_row, 2, tag)
+                tags[tag].write(it_ws, iteration_tags_row, 5)
                 iteration_tags_row += 1
 
 
-
-
-
-    w.save(response)
-    return response
-
 def _write_headers(ws, headers):
 
     for idx,header in enumerate( headers ):
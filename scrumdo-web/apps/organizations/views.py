@@ -33,7 +33,8 @@ from django.core.exceptions import PermissionDenied
 from organizations.forms import *
 from organizations.models import *
 from activities.models import NewsItem
-from projects.models import Project
+from projects.models import Project, BackgroundJob
+from projects.jobs import queueJob
 from favorites.models import *
 import projects.access as access
 import organizations.signals as signals
@@ -58,6 +59,8 @@ def organization_dashboard(request, organization_slug):
     favorite_projects = Favorite.objects.filter(user=request.user, project__organization=organization).select_related(
         'project').order_by("-project__active", "project__category", "project__name")
     favorite_projects = [fav.project for fav in favorite_projects]
+    # The template checks access for each one.
+    access.access_levels(favorite_projects, request.user)
 
     stories = Story.getAssignedStories(request.user, organization)
 
@@ -135,8 +138,9 @@ def organization_projects(request, organization_slug):
     # members.append("#%d %s (Team %s)" % (member_count,  user, team.name))
     #             member_count+=1
 
-    projects = organization.projects.all().order_by(
-        "-active", "category", "name")
+    projects = list(organization.projects.all().order_by(
+        "-active", "category", "name"))
+    access.access_levels(projects, request.user)
 
     # for project in projects:
     #     for member in project.members.all():
@@ -300,8 +304,13 @@ def export_organization(request, organization_slug):
             if m and value:
                 projects.append(int(m.group(1)))
         logger.debug(projects)
+        if request.POST.get("background"):
+            job = queueJob(BackgroundJob.TYPE_ORGANIZATION_EXPORT, request.user,
+                           organization=organization, project_ids=projects)
+            return HttpResponseRedirect(job.get_absolute_url())
         return import_export.export_organization(organization, project_ids=projects)
 
+    access.access_levels(organization.projects.all(), request.user)
     return render_to_response("organizations/organization_export.html", {
         "organization": organization,
         "organizations": organizations,
@@ -0,0 +1 @@
+import projects.signal_handlers
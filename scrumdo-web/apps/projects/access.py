@@ -16,14 +16,43 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 
-from projects.models import Project
+from projects.models import Project, ProjectMember
 from organizations.models import Organization, Team
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.db import connection
 
 from django.core.cache import cache
 
-CACHE_PERMISSION_SECONDS = 15
+import time
+
+# Cached access results are keyed on a generation counter for the user, the project and the
+# project's organization.  Anything that changes who can see what bumps the matching counter
+# (see the handlers at the bottom of projects/signal_handlers.py), so the old entries are never
+# read again and can live for hours.
+ACCESS_CACHE_SECONDS = getattr(settings, "ACCESS_CACHE_SECONDS", 6 * 60 * 60)
+
+# The counters themselves should outlive the results that use them.  Memcached treats anything
+# over 30 days as a timestamp, so that's the most we can ask for.
+GENERATION_SECONDS = 30 * 24 * 60 * 60
+
+# A user's access level for a project.  Each level includes the ones below it.
+ACCESS_NONE = 0
+ACCESS_READ = 1
+ACCESS_WRITE = 2
+ACCESS_ADMIN = 3
+
+# What each kind of row in ACCESS_SQL grants.  A staff team only gives admin access to the
+# projects of its own organization, if one of its projects is elsewhere that's just read access.
+ACCESS_GRANTS = {
+    "read": ACCESS_READ,
+    "write": ACCESS_WRITE,
+    "admin": ACCESS_ADMIN,
+    "staff": ACCESS_READ,
+    "org_staff": ACCESS_ADMIN,
+    "member": ACCESS_WRITE,
+}
 
 def admin_access_or_403(project,user, ignore_active=False):
     if not has_admin_access(project, user, ignore_active=ignore_active):
@@ -41,11 +70,12 @@ def has_staff_access(organization, user):
     try:
         # if user.is_staff:
         #     return True
-        key = cache_key(organization, user, "staff")
+        generations = _generations([("user", user.id), ("org", organization.id)])
+        key = cache_key(organization, user, "staff", generations[("user", user.id)], generations[("org", organization.id)])
         cached_value = cache.get(key)
         if cached_value is None:
             access = organization.teams.filter(access_type="staff",members = user).count() > 0
-            cache.set(key, access, CACHE_PERMISSION_SECONDS)
+            cache.set(key, access, ACCESS_CACHE_SECONDS)
             return access
         else:
             return cached_value
@@ -57,50 +87,18 @@ def has_admin_access( project, user , ignore_active=False):
         if not ignore_active:
             if not project.active:
                 return False
-        key = cache_key(project, user, "admin")
-        cached_value = cache.get(key)
-        if cached_value is None:
-            access = real_has_admin_access(project,user)
-            cache.set(key, access, CACHE_PERMISSION_SECONDS)
-            return access
-        else:
-            return cached_value
+        return access_level(project, user) >= ACCESS_ADMIN
     except:
         return False
 
-def real_has_admin_access(project, user):
-    if user.is_staff:
-        return True
-    if project.creator == user:
-        return True
-    if has_staff_access(project.organization, user):
-        return True
-    return Organization.objects.filter( teams__members = user , teams__access_type="admin", teams__projects=project).count() > 0
-
 def has_write_access( project, user ):
     try:
         if not project.active:
             return False
-        key = cache_key(project, user, "write")
-        cached_value = cache.get(key)
-        if cached_value is None:
-            access = real_has_write_access(project,user)
-            cache.set(key, access, CACHE_PERMISSION_SECONDS)
-            return access
-        else:
-            return cached_value
+        return access_level(project, user) >= ACCESS_WRITE
     except:
         return False
 
-def real_has_write_access( project, user ):
-    if user.is_staff:
-        return True
-    if has_admin_access( project, user):
-        return True
-    if project.members.filter(user__id=user.id).count() > 0:
-        return True
-    return Organization.objects.filter( teams__members = user , teams__access_type="write", teams__projects=project).count() > 0
-
 def has_read_access( project, user ):
     try:
         if not project.private:
@@ -110,24 +108,149 @@ def has_read_access( project, user ):
         if user.is_staff:
             return True
 
-        key = cache_key(project, user, "read")
-        cached_value = cache.get(key)
-        if cached_value is None:
-            access = real_has_read_access(project,user)
-            cache.set(key, access, CACHE_PERMISSION_SECONDS)
-            return access
-        else:
-            return cached_value
+        return access_level(project, user) >= ACCESS_READ
     except:
         return False
 
+def access_level(project, user):
+    """ Returns the user's ACCESS_* level for a project.  This doesn't look at whether the project is
+        active or private, the has_*_access functions take care of that. """
+    return access_levels([project], user)[project.id]
+
+def access_levels(projects, user):
+    """ Returns a dict of project id -> ACCESS_* level for a list of projects.  Pages that check access
+        for a whole list of projects should call this first, so it's one query instead of several
+        per project.
+
+        Levels are remembered on the user object, which lives as long as the request, and in the cache.
+        The copy on the user is dropped if this process bumps a generation in the meantime. """
+    memo = getattr(user, "_access_levels", None)
+    if memo is None or memo[0] != _local_bumps[0]:
+        memo = user._access_levels = (_local_bumps[0], {})
+    levels = memo[1]
+    wanted = [project for project in projects if project.id not in levels]
+    if len(wanted) > 0 and user.is_authenticated():
+        generations = _generations([("user", user.id)] +
+                                   [("project", project.id) for project in wanted] +
+                                   [("org", project.organization_id) for project in wanted])
+        keys = dict((_levelKey(project, user, generations), project.id) for project in wanted)
+        for key, level in cache.get_many(keys.keys()).items():
+            levels[keys[key]] = level
+        missing = [project for project in wanted if project.id not in levels]
+        if len(missing) > 0:
+            found = _queryAccessLevels(missing, user)
+            levels.update(found)
+            cache.set_many(dict((_levelKey(project, user, generations), found[project.id]) for project in missing), ACCESS_CACHE_SECONDS)
+    return dict((project.id, levels.get(project.id, ACCESS_NONE)) for project in projects)
+
+def _levelKey(project, user, generations):
+    return cache_key(project, user, "level", generations[("user", user.id)],
+                     generations[("project", project.id)], generations[("org", project.organization_id)])
+
+ACCESS_SQL = """
+SELECT tp.%(team_projects_project)s, t.access_type
+FROM %(team)s t
+JOIN %(team_members)s tm ON tm.%(team_members_team)s = t.id
+JOIN %(team_projects)s tp ON tp.%(team_projects_team)s = t.id
+WHERE tm.%(team_members_user)s = %%s AND tp.%(team_projects_project)s IN (%(project_ids)s)
+UNION ALL
+SELECT p.id, 'org_staff'
+FROM %(project)s p
+JOIN %(team)s t ON t.organization_id = p.organization_id
+JOIN %(team_members)s tm ON tm.%(team_members_team)s = t.id
+WHERE tm.%(team_members_user)s = %%s AND t.access_type = 'staff' AND p.id IN (%(project_ids)s)
+UNION ALL
+SELECT pm.project_id, 'member'
+FROM %(project_member)s pm
+WHERE pm.user_id = %%s AND pm.project_id IN (%(project_ids)s)
+"""
+
+def _queryAccessLevels(projects, user):
+    "Works out the access levels for a list of projects with one query."
+    levels = {}
+    for project in projects:
+        if user.is_staff or project.creator_id == user.id:
+            levels[project.id] = ACCESS_ADMIN
+        else:
+            levels[project.id] = ACCESS_NONE
+    project_ids = [project_id for project_id, level in levels.items() if level < ACCESS_ADMIN]
+    if len(project_ids) == 0:
+        return levels
+
+    qn = connection.ops.quote_name
+    members = Team._meta.get_field("members")
+    team_projects = Team._meta.get_field("projects")
+    sql = ACCESS_SQL % {
+        "team": qn(Team._meta.db_table),
+        "team_members": qn(members.m2m_db_table()),
+        "team_members_team": qn(members.m2m_column_name()),
+        "team_members_user": qn(members.m2m_reverse_name()),
+        "team_projects": qn(team_projects.m2m_db_table()),
+        "team_projects_team": qn(team_projects.m2m_column_name()),
+        "team_projects_project": qn(team_projects.m2m_reverse_name()),
+        "project": qn(Project._meta.db_table),
+        "project_member": qn(ProjectMember._meta.db_table),
+        "project_ids": ", ".join(["%s"] * len(project_ids)),
+    }
+    cursor = connection.cursor()
+    cursor.execute(sql, [user.id] + project_ids + [user.id] + project_ids + [user.id] + project_ids)
+    for project_id, grant in cursor.fetchall():
+        levels[project_id] = max(levels[project_id], ACCESS_GRANTS.get(grant, ACCESS_NONE))
+    return levels
+
+def cache_key( obj, user, acc_type, *generations):
+    return "acc_%s_%d_%d_%s" % (acc_type, obj.id, user.id, "_".join([str(generation) for generation in generations]))
+
+# How many times this process has bumped a generation, so access_levels knows when the levels
+# remembered on a user object might be out of date.
+_local_bumps = [0]
+
+def _generationKey(kind, object_id):
+    return "accgen_%s_%s" % (kind, object_id)
+
+def _newGeneration():
+    # Based on the clock, so if a counter falls out of the cache it comes back with a value
+    # none of the existing results were stored under.
+    return int(time.time() * 1000)
+
+def _generations(wanted):
+    """ Returns a dict of (kind, id) -> current generation, for kinds "user", "project" and "org".
+        Counters that aren't in the cache yet are started. """
+    wanted = set(wanted)
+    keys = dict((_generationKey(kind, object_id), (kind, object_id)) for kind, object_id in wanted)
+    found = cache.get_many(keys.keys())
+    generations = {}
+    for key, item in keys.items():
+        if key in found:
+            generations[item] = found[key]
+        else:
+            generation = _newGeneration()
+            if not cache.add(key, generation, GENERATION_SECONDS):
+                # Someone else started it first.
+                generation = cache.get(key, generation)
+            generations[item] = generation
+    return generations
+
+def _bump(kind, object_ids):
+    _local_bumps[0] += 1
+    for object_id in set(object_ids):
+        if object_id is None:
+            continue
+        key = _generationKey(kind, object_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not cached, so nothing was stored under it.  Start it fresh.
+            cache.set(key, _newGeneration(), GENERATION_SECONDS)
+
+def invalidateUsers(user_ids):
+    "Call when something about these users changes what they can access, like a team membership."
+    _bump("user", user_ids)
 
-def real_has_read_access(project,user):
-    if has_admin_access( project, user):
-        return True
-    if has_write_access(project, user):
-        return True
-    return Organization.objects.filter( teams__members = user , teams__projects=project).count() > 0
+def invalidateProjects(project_ids):
+    "Call when something about these projects changes who can access them."
+    _bump("project", project_ids)
 
-def cache_key( project, user, acc_type):
-    return "acc_%s_%s_%d" % (acc_type, project.slug, user.id)
+def invalidateOrganizations(organization_ids):
+    "Call when something changes access across a whole organization, like a team's access type."
+    _bump("org", organization_ids)
@@ -37,3 +37,10 @@ admin.site.register(SiteStats)
 admin.site.register(Epic)
 admin.site.register(StoryTag)
 admin.site.register(Task, TaskAdmin)
+
+
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job_type', 'status', 'progress', 'user', 'created', 'finished')
+    list_filter = ('job_type', 'status')
+
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
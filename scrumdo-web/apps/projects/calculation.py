@@ -1,6 +1,8 @@
 from datetime import date, timedelta
-from apps.projects.models import Project, Iteration, Story, PointsLog
+from apps.projects.models import Project, Iteration, Story, Epic, PointsLog
 from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Sum
 
 from projects.limits import on_demand_velocity
 
@@ -9,6 +11,22 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class ProjectPoints(object):
+    """ The result of a points calculation for a single project.  Both the legacy and the
+        set-based calculations produce one of these so they can be saved or compared the same way.
+        iteration_points maps iteration id -> (points_claimed, points_total) for the iterations
+        that should get a PointsLog entry today. """
+
+    def __init__(self, project):
+        self.project = project
+        self.points_total = 0
+        self.points_claimed = 0
+        self.velocity = 0
+        self.iterations_left = None  # None means "leave the project's value alone"
+        self.iteration_points = {}
+        self.story_count = 0
+
+
 def onDemandCalculateVelocity(project):
     if not on_demand_velocity.increaseAllowed(project=project):
         return
@@ -36,7 +54,8 @@ def calculatePoints(stories, epics):
     return (points_total, points_claimed)
 
 
-def calculateProjectVelocity(project, total_project_points):
+def calculateIterationVelocityPoints(project):
+    "Returns a list of the done points in each completed iteration that counts towards velocity."
     today = date.today()
     # Loop through all completed iterations and gather info
     iteration_points = []
@@ -50,18 +69,24 @@ def calculateProjectVelocity(project, total_project_points):
                     except ValueError:
                         pass  # probably ? or infinity
             iteration_points.append(points)
+    return iteration_points
 
-    velocity = 0
+
+def calculateVelocity(project, iteration_points):
+    "Applies the project's velocity type to a list of per-iteration done points."
     if project.velocity_type == project.VELOCITY_TYPE_AVERAGE:
-        velocity = calculateAverage(iteration_points)
+        return calculateAverage(iteration_points)
     elif project.velocity_type == project.VELOCITY_TYPE_AVERAGE_5:
-        velocity = calculateAverageLastN(iteration_points, 5)
+        return calculateAverageLastN(iteration_points, 5)
     elif project.velocity_type == project.VELOCITY_TYPE_AVERAGE_3:
-        velocity = calculateAverageLastN(iteration_points, 3)
+        return calculateAverageLastN(iteration_points, 3)
     else:
-        velocity = calculateMedian(iteration_points)
+        return calculateMedian(iteration_points)
+
 
-    project.velocity = velocity
+def calculateProjectVelocity(project, total_project_points):
+    iteration_points = calculateIterationVelocityPoints(project)
+    project.velocity = calculateVelocity(project, iteration_points)
     if project.velocity > 0:
         project.iterations_left = int(total_project_points / project.velocity)
 
@@ -106,32 +131,221 @@ def logPoints(related_object, points_claimed, points_total):
         # logger.debug("logPoints created a new record.")
 
 
-def calculateProject(project):
-    if not project.active:
-        return
+def _loggedIterations(project):
+    "The iterations of a project that get a daily PointsLog entry."
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    tomorrow = today + timedelta(days=1)
+    return project.iterations.filter(start_date__lte=tomorrow, end_date__gte=yesterday)
+
+
+def legacyProjectPoints(project):
+    """ Calculates a project's points by looping over every story and epic in python.
+        This is the original algorithm, kept around so the set-based one can be verified against it.
+        Nothing is written to the database. """
+    result = ProjectPoints(project)
     stories = project.stories.all()
     epics = project.epics.all().exclude(archived=True)
-    points = calculatePoints(stories, epics)
+    result.points_total, result.points_claimed = calculatePoints(stories, epics)
 
-    total_project_points = points[0]
+    result.velocity = calculateVelocity(project, calculateIterationVelocityPoints(project))
+    if result.velocity > 0:
+        result.iterations_left = int(result.points_total / result.velocity)
 
-    today = date.today()
+    for iteration in _loggedIterations(project):
+        if(iteration != project.get_default_iteration()):
+            points = calculatePoints(iteration.stories.all(), [])
+            # only logging active iterations with stuff in them
+            if points[0] > 0:
+                result.iteration_points[iteration.id] = (points[1], points[0])
+    return result
 
-    logPoints(project, points[1], points[0])
-    # log = PointsLog( points_claimed=points[1], points_total=points[0], related_object=project)
-    # log.save();
 
+def _normalizedEpicPoints(epic_id, epics, children, epic_story_points, memo, visiting):
+    "Set-based equivalent of Epic.normalized_points_value()"
+    if epic_id in memo:
+        return memo[epic_id]
+    if epic_id in visiting:
+        # A parent loop, the legacy code would recurse forever here.
+        return 0
+    visiting.add(epic_id)
+    pv = epics[epic_id]["numeric_points"]
+    pv -= epic_story_points.get(epic_id, 0)
+    for child_id in children.get(epic_id, []):
+        pv -= _normalizedEpicPoints(child_id, epics, children, epic_story_points, memo, visiting)
+    visiting.discard(epic_id)
+    memo[epic_id] = max(pv, 0)
+    return memo[epic_id]
+
+
+def calculateProjectsPoints(projects):
+    """ Calculates the points for a batch of projects with a handful of grouped queries that cover every
+        project in the batch, instead of loading every story.  The points are added up by the database from
+        the numeric_points columns, which hold the same values as Story.points_value(), so ?, Inf and
+        fractional values come out identical to the legacy calculation.
+
+        Returns a dict of project id -> ProjectPoints.  Nothing is written to the database. """
+    projects = [project for project in projects if project.active]
+    results = dict((project.id, ProjectPoints(project)) for project in projects)
+    if len(results) == 0:
+        return results
+    project_ids = results.keys()
+
+    today = date.today()
     yesterday = today - timedelta(days=1)
     tomorrow = today + timedelta(days=1)
-    points_total = 0
 
-    calculateProjectVelocity(project, total_project_points)
+    # Iterations, in the same order project.iterations.all() would give them.
+    iterations = {}
+    project_iterations = dict((project_id, []) for project_id in project_ids)
+    for iteration in Iteration.objects.filter(project__in=project_ids).values(
+            "id", "project", "start_date", "end_date", "default_iteration", "include_in_velocity").order_by("-default_iteration", "end_date", "id"):
+        iterations[iteration["id"]] = iteration
+        project_iterations[iteration["project"]].append(iteration)
 
-    for iteration in project.iterations.filter(start_date__lte=tomorrow, end_date__gte=yesterday):
-        if(iteration != project.get_default_iteration()):
-            points = calculatePoints(iteration.stories.all(), [])
-            # only logging active iterations with stuff in them
-            if points[0] > 0:
-                logPoints(iteration, points[1], points[0])
-                # log = PointsLog( points_claimed=points[1], points_total=points[0], related_object=iteration)
-                # log.save();
+    # One row per (iteration, status) combination, with the points added up by the database.
+    iteration_totals = {}
+    iteration_claimed = {}
+    story_groups = Story.objects.filter(project__in=project_ids).values(
+        "project", "iteration", "status").annotate(story_count=Count("id"), points_sum=Sum("numeric_points")).order_by()
+    for group in story_groups:
+        result = results[group["project"]]
+        result.story_count += group["story_count"]
+        points = group["points_sum"] or 0
+        result.points_total += points
+        iteration_totals[group["iteration"]] = iteration_totals.get(group["iteration"], 0) + points
+        if group["status"] == Story.STATUS_DONE:
+            result.points_claimed += points
+            iteration_claimed[group["iteration"]] = iteration_claimed.get(group["iteration"], 0) + points
+
+    # Epics only count the points not already accounted for by their stories and sub-epics.
+    epics = {}
+    children = {}
+    for epic in Epic.objects.filter(project__in=project_ids).values("id", "parent", "project", "numeric_points", "archived").order_by():
+        epics[epic["id"]] = epic
+    for epic in epics.values():
+        if epic["parent"] is not None:
+            children.setdefault(epic["parent"], []).append(epic["id"])
+    epic_story_points = {}
+    epic_groups = Story.objects.filter(epic__in=epics.keys()).values("epic").annotate(points_sum=Sum("numeric_points")).order_by()
+    for group in epic_groups:
+        epic_story_points[group["epic"]] = group["points_sum"] or 0
+    memo = {}
+    for epic in epics.values():
+        if not epic["archived"]:
+            results[epic["project"]].points_total += _normalizedEpicPoints(epic["id"], epics, children, epic_story_points, memo, set())
+
+    for project_id, result in results.items():
+        project = result.project
+        its = project_iterations[project_id]
+        velocity_points = [iteration_claimed.get(iteration["id"], 0) for iteration in its
+                           if iteration["end_date"] is not None and iteration["end_date"] <= today
+                           and not iteration["default_iteration"] and iteration["include_in_velocity"]]
+        result.velocity = calculateVelocity(project, velocity_points)
+        if result.velocity > 0:
+            result.iterations_left = int(result.points_total / result.velocity)
+
+        # Project.get_default_iteration() picks the first iteration in this same ordering
+        default_iteration_id = its[0]["id"] if len(its) > 0 else None
+        for iteration in its:
+            if iteration["id"] == default_iteration_id:
+                continue
+            if iteration["start_date"] is None or iteration["end_date"] is None:
+                continue
+            if iteration["start_date"] <= tomorrow and iteration["end_date"] >= yesterday:
+                total = iteration_totals.get(iteration["id"], 0)
+                # only logging active iterations with stuff in them
+                if total > 0:
+                    result.iteration_points[iteration["id"]] = (iteration_claimed.get(iteration["id"], 0), total)
+    return results
+
+
+def calculateProjectPoints(project):
+    return calculateProjectsPoints([project]).get(project.id)
+
+
+def saveProjectPoints(result):
+    "Writes a ProjectPoints result out to the points log and the project's velocity fields."
+    project = result.project
+    logPoints(project, result.points_claimed, result.points_total)
+    project.velocity = result.velocity
+    if result.iterations_left is not None:
+        project.iterations_left = result.iterations_left
+    project.save()
+    if len(result.iteration_points) > 0:
+        for iteration in Iteration.objects.filter(id__in=result.iteration_points.keys()):
+            points_claimed, points_total = result.iteration_points[iteration.id]
+            logPoints(iteration, points_claimed, points_total)
+
+
+def diffProjectPoints(expected, actual):
+    "Returns a list of human readable differences between two ProjectPoints results."
+    def differs(a, b):
+        if a is None or b is None:
+            return a != b
+        return abs(a - b) > 0.0001
+
+    diffs = []
+    for field in ("points_total", "points_claimed", "velocity", "iterations_left"):
+        if differs(getattr(expected, field), getattr(actual, field)):
+            diffs.append("%s: %s != %s" % (field, getattr(expected, field), getattr(actual, field)))
+    for iteration_id in set(expected.iteration_points.keys()) | set(actual.iteration_points.keys()):
+        e = expected.iteration_points.get(iteration_id, (None, None))
+        a = actual.iteration_points.get(iteration_id, (None, None))
+        if differs(e[0], a[0]) or differs(e[1], a[1]):
+            diffs.append("iteration %d: %s != %s" % (iteration_id, e, a))
+    return diffs
+
+
+def reconcileProjects(projects):
+    """ Recalculates a batch of projects and saves the ones whose points log for today, velocity or
+        iterations_left has drifted from the real values, for instance because of story changes made
+        without a signal.
+        Returns the ProjectPoints results that had to be fixed. """
+    results = calculateProjectsPoints(projects)
+    if len(results) == 0:
+        return []
+    today = date.today()
+    logged = {}
+    project_type = ContentType.objects.get_for_model(Project)
+    for log in PointsLog.objects.filter(content_type=project_type, object_id__in=results.keys(), date=today):
+        logged[(project_type.id, log.object_id)] = (log.points_claimed, log.points_total)
+    iteration_ids = []
+    for result in results.values():
+        iteration_ids.extend(result.iteration_points.keys())
+    iteration_type = ContentType.objects.get_for_model(Iteration)
+    if len(iteration_ids) > 0:
+        for log in PointsLog.objects.filter(content_type=iteration_type, object_id__in=iteration_ids, date=today):
+            logged[(iteration_type.id, log.object_id)] = (log.points_claimed, log.points_total)
+
+    def drifted(key, points):
+        # The log columns are integers, so compare against what would have been stored.
+        return logged.get(key) != (int(points[0]), int(points[1]))
+
+    def velocityDrifted(result):
+        # The project columns are integers too.
+        project = result.project
+        if project.velocity != int(result.velocity):
+            return True
+        return result.iterations_left is not None and project.iterations_left != result.iterations_left
+
+    fixed = []
+    for result in results.values():
+        if drifted((project_type.id, result.project.id), (result.points_claimed, result.points_total)) or \
+           velocityDrifted(result) or \
+           len([iteration_id for iteration_id, points in result.iteration_points.items() if drifted((iteration_type.id, iteration_id), points)]) > 0:
+            saveProjectPoints(result)
+            fixed.append(result)
+    return fixed
+
+
+def calculateProjects(projects):
+    "Calculates and saves the points for a batch of projects."
+    for result in calculateProjectsPoints(projects).values():
+        saveProjectPoints(result)
+
+
+def calculateProject(project):
+    if not project.active:
+        return
+    saveProjectPoints(calculateProjectPoints(project))
@@ -1 +1 @@
-SEQUENCE = ['utf8']
+SEQUENCE = ['utf8', 'fractional_ranks', 'numeric_points', 'job_heartbeat']
@@ -0,0 +1,34 @@
+from django_evolution.mutations import *
+from django.db import models
+from django.conf import settings
+
+# Story.rank, Story.board_rank and Epic.order become floats so a reorder can always take the
+# midpoint of its neighbours.  The existing integer values convert as they are.
+# ChangeField can't change a column's type, so this is raw SQL.
+
+if "mysql" in settings.DATABASE_ENGINE:
+    SQL = [
+        "ALTER TABLE projects_story MODIFY `rank` double precision NOT NULL;",
+        "ALTER TABLE projects_story MODIFY `board_rank` double precision NOT NULL;",
+        "ALTER TABLE projects_epic MODIFY `order` double precision NOT NULL;",
+    ]
+else:
+    SQL = [
+        "ALTER TABLE projects_story ALTER COLUMN rank TYPE double precision;",
+        "ALTER TABLE projects_story ALTER COLUMN board_rank TYPE double precision;",
+        "ALTER TABLE projects_epic ALTER COLUMN \"order\" TYPE double precision;",
+    ]
+
+
+def update_signature(app_label, proj_sig):
+    story_fields = proj_sig[app_label]["Story"]["fields"]
+    story_fields["rank"]["field_type"] = models.FloatField
+    story_fields["board_rank"]["field_type"] = models.FloatField
+    epic_order = proj_sig[app_label]["Epic"]["fields"]["order"]
+    epic_order["field_type"] = models.FloatField
+    epic_order.pop("max_length", None)
+
+
+MUTATIONS = [
+    SQLMutation("fractional_ranks", SQL, update_signature),
+]
@@ -0,0 +1,9 @@
+from django_evolution.mutations import *
+from django.db import models
+
+# BackgroundJob.heartbeat is touched as a job runs, so run_jobs can tell a dead worker's job from
+# a long one.  Jobs already running have none, failStaleJobs goes by their start time.
+
+MUTATIONS = [
+    AddField('BackgroundJob', 'heartbeat', models.DateTimeField, null=True),
+]
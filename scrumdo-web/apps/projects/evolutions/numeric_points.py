@@ -0,0 +1,32 @@
+from django_evolution.mutations import *
+from django.db import models
+from django.conf import settings
+
+# Story.numeric_points and Epic.numeric_points hold pointsValue(points) so sorting and the points
+# totals can be done by the database.  The backfill below sets them from points for every row
+# that's a plain number, everything else ('?', 'Inf') stays 0 like pointsValue.  The
+# backfill_points command can re-check the columns afterwards.  The story list and the stats
+# rollups read an iteration's stories by status; Django can't declare an index on two columns, so
+# new databases get it from sql/story.sql.
+
+NUMBER = "^-?([0-9]+[.]?[0-9]*|[.][0-9]+)$"
+
+if "mysql" in settings.DATABASE_ENGINE:
+    BACKFILL = [
+        "UPDATE projects_%s SET numeric_points = points + 0 WHERE points REGEXP '%s';" % (table, NUMBER)
+        for table in ("story", "epic")
+    ]
+else:
+    BACKFILL = [
+        "UPDATE projects_%s SET numeric_points = CAST(points AS double precision) WHERE points ~ '%s';" % (table, NUMBER)
+        for table in ("story", "epic")
+    ]
+
+MUTATIONS = [
+    AddField('Story', 'numeric_points', models.FloatField, initial=0),
+    AddField('Epic', 'numeric_points', models.FloatField, initial=0),
+    SQLMutation("numeric_points_backfill", BACKFILL),
+    SQLMutation("story_iteration_status_index", [
+        "CREATE INDEX projects_story_iteration_status ON projects_story (iteration_id, status);",
+    ]),
+]
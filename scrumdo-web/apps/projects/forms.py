@@ -281,12 +281,20 @@ class FindStoryForm(forms.Form):
 
 class IterationImportForm(forms.Form):
     import_file = forms.FileField(required=False)
+    dry_run = forms.BooleanField(required=False, help_text=_(
+        "Check the file and report what would be imported, without changing any stories."))
+    background = forms.BooleanField(required=False, help_text=_(
+        "Run the import in the background.  Use this for large files."))
 
 
 class IterationImportFormWithUnlock(forms.Form):
     import_file = forms.FileField(required=False)
+    dry_run = forms.BooleanField(required=False, help_text=_(
+        "Check the file and report what would be imported, without changing any stories."))
     unlock_iteration = forms.BooleanField(required=False, help_text=_(
         "Unlocking the iteration allows users with the appropriate access to edit stories in this iteration."))
+    background = forms.BooleanField(required=False, help_text=_(
+        "Run the import in the background.  Use this for large files."))
 
 
 class UnlockForm(forms.Form):
@@ -301,12 +309,16 @@ class ExportForm(forms.Form):
         "Locking the iteration prevents anyone from editing any stories in it until the iteration is unlocked."))
     file_name = forms.CharField(
         required=False, help_text=_("Name of the file when saved to disk."))
+    background = forms.BooleanField(required=False, help_text=_(
+        "Run the export in the background and download it when it's ready.  Use this for large iterations."))
 
 
 class ExportProjectForm(forms.Form):
     #format = forms.ChoiceField(initial="sheet", choices=(("sheet","Export each iteration as a seperate sheet."),("combined","Export one combined sheet.") ) , widget=forms.RadioSelect() )
     file_name = forms.CharField(
         required=False, help_text=_("Name of the file when saved to disk."))
+    background = forms.BooleanField(required=False, help_text=_(
+        "Run the export in the background and download it when it's ready.  Use this for large projects."))
 
 
 class AddUserForm(forms.Form):
@@ -0,0 +1,148 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Caches the rendered story snippets (stories/single_*_story.html) for the story list pages.
+#
+# A snippet is cached under its story's version counter and its project's version counter,
+# along with everything else it depends on: the template, the return type, whether the viewer
+# can write to the project and whether the iteration is locked.  Saving a story, its tasks,
+# tags, links or comments bumps the story's version, and changes to the project, its epics,
+# tags and iterations bump the project's (see the handlers in projects/signal_handlers.py),
+# so old snippets are never read again.  Users' names and avatars aren't tracked, so snippets
+# only live for STORY_FRAGMENT_SECONDS.
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import RequestContext
+from django.template.loader import get_template
+
+from projects.access import has_write_access
+
+import time
+
+STORY_FRAGMENT_SECONDS = getattr(settings, "STORY_FRAGMENT_SECONDS", 2 * 60 * 60)
+
+# See access.GENERATION_SECONDS.
+VERSION_SECONDS = 30 * 24 * 60 * 60
+
+# These show things that depend on who's looking, so they're cached per user.
+PER_USER_TEMPLATES = ("stories/single_queue_story.html",)
+
+HITS_KEY = "storyfrag_hits"
+MISSES_KEY = "storyfrag_misses"
+
+
+def _versionKey(kind, object_id):
+    return "storyver_%s_%s" % (kind, object_id)
+
+
+def _versions(wanted):
+    "Returns a dict of (kind, id) -> version for kinds 'story' and 'project', starting any that are missing."
+    keys = dict((_versionKey(kind, object_id), (kind, object_id)) for kind, object_id in set(wanted))
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, item in keys.items():
+        if key in found:
+            versions[item] = found[key]
+        else:
+            # Based on the clock, so a counter that fell out of the cache doesn't come back at an old value.
+            version = int(time.time() * 1000)
+            if not cache.add(key, version, VERSION_SECONDS):
+                version = cache.get(key, version)
+            versions[item] = version
+    return versions
+
+
+def _bump(kind, object_ids):
+    for object_id in set(object_ids):
+        if object_id is None:
+            continue
+        key = _versionKey(kind, object_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), VERSION_SECONDS)
+
+
+def invalidateStories(story_ids):
+    "Call when something shown in these stories' snippets changes."
+    _bump("story", story_ids)
+
+
+def invalidateProjectStories(project_ids):
+    "Call when something shown in every story snippet of these projects changes, like the point scale."
+    _bump("project", project_ids)
+
+
+def _count(key, amount):
+    if amount == 0:
+        return
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if not cache.add(key, amount):
+            cache.incr(key, amount)
+
+
+def fragmentStats():
+    "Returns (hits, misses) since the counters were last reset."
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    return counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+
+
+def resetFragmentStats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
+
+
+def renderStories(request, stories, template_name, context, iteration=None, tasks=False):
+    """ Returns the rendered template_name for each story, in order.  context is what the template gets
+        besides the story, and must include the project.  Cached snippets are used where they're current,
+        the rest are rendered with their relations prefetched, see prefetchStoryList.  iteration is the
+        one the stories are in, if they're all in one. """
+    # prefetch pulls in extras.models, which can't be imported while projects is loading.
+    from projects.prefetch import prefetchStoryList
+
+    stories = list(stories)
+    project = context["project"]
+    return_type = context.get("return_type", "")
+    can_write = has_write_access(project, request.user)
+    locked = iteration is not None and iteration.locked
+    user_id = request.user.id if template_name in PER_USER_TEMPLATES else 0
+
+    versions = _versions([("story", story.id) for story in stories] + [("project", project.id)])
+    project_version = versions[("project", project.id)]
+    keys = ["storyfrag_%s_%s_%d_%d_%s_%d_%d_%d" % (template_name, return_type, can_write, locked, user_id, story.id,
+                                                  versions[("story", story.id)], project_version)
+            for story in stories]
+    html = cache.get_many(keys)
+    missing = [(story, key) for story, key in zip(stories, keys) if key not in html]
+    _count(HITS_KEY, len(stories) - len(missing))
+    _count(MISSES_KEY, len(missing))
+    if len(missing) == 0:
+        return [html[key] for key in keys]
+
+    prefetchStoryList([story for story, key in missing], project, tasks)
+    template = get_template(template_name)
+    request_context = RequestContext(request, context)
+    rendered = {}
+    for story, key in missing:
+        request_context.update({"story": story})
+        rendered[key] = template.render(request_context)
+        request_context.pop()
+    cache.set_many(rendered, STORY_FRAGMENT_SECONDS)
+    html.update(rendered)
+    return [html[key] for key in keys]
@@ -22,6 +22,9 @@ import csv
 import re
 
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Max
 from xml.dom.minidom import Document, parse
 from django.http import HttpResponse
 import codecs
@@ -29,7 +32,7 @@ import cStringIO
 import xlwt
 from xlrd import open_workbook
 
-from projects.models import Story, STATUS_CHOICES, STATUS_REVERSE
+from projects.models import Story, StoryTagging, IterationStats, STATUS_CHOICES, STATUS_REVERSE
 import logging
 
 logger = logging.getLogger(__name__)
@@ -49,23 +52,44 @@ def exportIteration(iteration, format, file_name=None):
         return _exportCSV(iteration, file_name)
 
 
-def importIteration(request, iteration, file, user):
+def importIteration(request, iteration, file, user, dry_run=False):
     """ Imports data to an iteration.  Both updating and creating stories is supported.
-        file can be either Excel, XML, or CSV """
-    m = re.search('\.(\S+)', file.name)
-
-    if m.group(1).lower() == "xml":
-        return _importXMLIteration(request,iteration, file, user)
-    elif m.group(1).lower() == "xls":
-        return _importExcelIteration(request, iteration, file, user)
-    elif m.group(1).lower() == "xlsx":
-        logger.info("Tried to import xlsx file :(")
+        file can be either Excel, XML, or CSV.  With dry_run, the file is checked but nothing is saved. """
+    import_data = readImportFile(file)
+    if import_data is None:
         messages.info(
             request, "Please save your file as an .xls Excel file before importing.")
         return False
+    return _importData(request, import_data, iteration, user, dry_run)
+
+
+def importIterationFile(iteration, file, user, dry_run=False, progress=None, file_name=None):
+    """ Same as importIteration, but without a request to report back to, for running the import in a
+        background job.  Returns an ImportResult, or None if the file format isn't supported. """
+    import_data = readImportFile(file, file_name)
+    if import_data is None:
+        return None
+    result = importStories(import_data, iteration, user, dry_run=dry_run, progress=progress)
+    logger.info("Imported %d records, failed on %d" % (result.imported, result.failed))
+    return result
+
+
+def readImportFile(file, file_name=None):
+    """ Reads the rows out of an Excel, XML, or CSV file into a list of dicts keyed by column name.
+        The type comes from file_name, or the file's own name.  Returns None for file types we can't read. """
+    m = re.search('\.(\S+)', file_name or file.name)
+    extension = m.group(1).lower() if m else ""
+
+    if extension == "xml":
+        return _readXMLFile(file)
+    elif extension == "xls":
+        return _readExcelFile(file)
+    elif extension == "xlsx":
+        logger.info("Tried to import xlsx file :(")
+        return None
     else:
         # Assume CSV, hope for the best.
-        return _importCSVIteration(request, iteration, file, user)
+        return _readCSVFile(file)
 
 
 def exportProject(project, file_name=None):
@@ -137,21 +161,20 @@ def exportProject(project, file_name=None):
                 idx + 1, 4, reduce(lambda total, story: total + story.points_value(), completed_stories, 0))
 
     # Write data to the iteration sheet, plus create one sheet per iteration.
-    for itIdx, iteration in enumerate(project.iterations.all()):
+    iterations = project.iterations.all()
+    iteration_stats = dict((stats.iteration_id, stats) for stats in IterationStats.objects.filter(iteration__project=project))
+    for itIdx, iteration in enumerate(iterations):
         iteration_stories = iteration.stories.all()
-        completed_stories = [
-            story for story in iteration_stories if story.status == Story.STATUS_DONE]
+        stats = iteration_stats.get(iteration.id) or iteration.getStats()
         iteration_ws.write(itIdx + 1, 0, iteration.name)
         iteration_ws.write(itIdx + 1, 1, iteration.start_date, date_xf)
         iteration_ws.write(itIdx + 1, 2, iteration.end_date, date_xf)
-        iteration_ws.write(itIdx + 1, 3, len(iteration_stories))
-        iteration_ws.write(itIdx + 1, 4, len(completed_stories))
-        iteration_ws.write(
-            itIdx + 1, 5, reduce(lambda total, story: total + story.points_value(), iteration_stories, 0))
-        iteration_ws.write(
-            itIdx + 1, 6, reduce(lambda total, story: total + story.points_value(), completed_stories, 0))
-        iteration_ws.write(itIdx + 1, 7, iteration.starting_points())
-        iteration_ws.write(itIdx + 1, 8, iteration.max_points())
+        iteration_ws.write(itIdx + 1, 3, stats.story_count)
+        iteration_ws.write(itIdx + 1, 4, stats.stories_done)
+        iteration_ws.write(itIdx + 1, 5, stats.points_total)
+        iteration_ws.write(itIdx + 1, 6, stats.points_claimed)
+        iteration_ws.write(itIdx + 1, 7, stats.starting_points)
+        iteration_ws.write(itIdx + 1, 8, stats.max_points)
         ws = w.add_sheet(cleanWorksheetName(iteration.name))
 
         for idx, header in enumerate(headers):
@@ -166,9 +189,11 @@ def exportProject(project, file_name=None):
     return response
 
 
-def _getHeaders(project):
+def _getHeaders(project, members=None, next_rank=None):
     """Returns an array of tupples with info on columns.
         (target width, title, function to get the data from a story, excel output format, function to assign the value to a story)
+        Importers can pass in a dict of username -> member and a function returning the rank for a story
+        without a valid one, so the setters don't need to query for every row.
     """
     # There's some excel-specific data mixed in here that doesn't entirely
     # fit, but I'm leaving it for now.
@@ -210,14 +235,20 @@ def _getHeaders(project):
             pass  # Ignore invalid statuses?
 
     def setAssignee(story, value):
-        member = story.project.get_member_by_username(value)
+        if members is not None:
+            member = members.get(value)
+        else:
+            member = story.project.get_member_by_username(value)
         story.assignee = member
 
     def setRank(story, value):
         try:
-            story.rank = int(value)
+            story.rank = float(value)
         except:
-            story.rank = story.iteration.stories.count()
+            if next_rank is not None:
+                story.rank = next_rank()
+            else:
+                story.rank = story.iteration.stories.count()
 
     def setExtra1(story, value):
         story.extra_1 = unicode(value)
@@ -299,62 +330,90 @@ def _exportExcel(iteration, file_name=None):
 
 
 def _exportXML(iteration, file_name=None):
-    """ Exports the stories in an iteration as XML """
+    """ Exports the stories in an iteration as XML.  The document is written out one story at a time
+        as the response is sent, so it's never held in memory.  The output matches what
+        minidom's toprettyxml() used to produce. """
     if not file_name:
         file_name = "iteration"
     stories = iteration.stories.all().order_by("rank")
-    doc = Document()
-    iteration_node = doc.createElement("iteration")
-    doc.appendChild(iteration_node)
-
     headers = _getHeaders(iteration.project)
-
-    for idx, story in enumerate(stories):
-        row = []
-        story_node = doc.createElement("story")
-        iteration_node.appendChild(story_node)
-        for hidx, header in enumerate(headers):
-            f = header[2]
-            story_node.setAttribute(_toXMLNodeName(header[1]), unicode(
-                f(story)).replace("\n", " ").replace("\r", ""))
-            # TODO (Future Enhancement): There's a bug in the minidom implementation that doesn't convert newlines to their entities inside attributes,
-            #      and there's no good work-around I can find without monkey patching minidom itself.
-            # We should generally recommend people stick to excel or CSV files.
-
-    response = HttpResponse(doc.toprettyxml(indent="  "), mimetype="text/xml")
+    # minidom writes the attributes sorted by name
+    columns = sorted([(_toXMLNodeName(header[1]), header[2]) for header in headers])
+
+    def generate():
+        yield '<?xml version="1.0" ?>\n<iteration>\n'
+        for story in _iterateStories(stories):
+            attributes = []
+            for name, f in columns:
+                # TODO (Future Enhancement): Newlines inside attributes aren't converted to entities, so we strip them.
+                # We should generally recommend people stick to excel or CSV files.
+                value = unicode(f(story)).replace("\n", " ").replace("\r", "")
+                attributes.append(u' %s="%s"' % (name, _escapeXMLAttribute(value)))
+            yield (u"  <story%s/>\n" % "".join(attributes)).encode("utf-8")
+        yield "</iteration>\n"
+
+    response = HttpResponse(generate(), mimetype="text/xml")
     response['Content-Disposition'] = 'attachment; filename=%s.xml' % file_name
     return response
 
 
+def _escapeXMLAttribute(value):
+    "Escapes an attribute value the same way minidom does."
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _iterateStories(stories, chunk_size=500):
+    """ Iterates over a story queryset without caching the results, fetching the assignee with each story
+        and the tag names for each chunk of stories in one query, so exports don't run queries per story. """
+    chunk = []
+    for story in stories.select_related("assignee").iterator():
+        chunk.append(story)
+        if len(chunk) >= chunk_size:
+            for chunk_story in _prefetchTagNames(chunk):
+                yield chunk_story
+            chunk = []
+    for chunk_story in _prefetchTagNames(chunk):
+        yield chunk_story
+
+
+def _prefetchTagNames(stories):
+    "Loads the tag names for a list of stories in one query, so story.tags doesn't need to query."
+    if len(stories) == 0:
+        return stories
+    tag_names = dict((story.id, []) for story in stories)
+    for story_id, name in StoryTagging.objects.filter(story__in=tag_names.keys()).values_list("story", "tag__name").order_by("id"):
+        tag_names[story_id].append(name)
+    for story in stories:
+        story._prefetched_tag_names = tag_names[story.id]
+    return stories
+
+
 def _toXMLNodeName(name):
     return re.sub('[^a-zA-Z0-9_-]', "", name.replace(" ", "_").lower())
 
 
 def _exportCSV(iteration, file_name=None):
-    """ Exports the stories in an iteration as CSV """
+    """ Exports the stories in an iteration as CSV.  Rows are written out as the response is sent,
+        so the whole file is never held in memory. """
     if not file_name:
         file_name = "iteration"
-    response = HttpResponse(mimetype="text/csv")
-    response['Content-Disposition'] = 'attachment; filename=%s.csv' % file_name
     stories = iteration.stories.all().order_by("rank")
-
-    writer = UnicodeWriter(response)
-    #csv.writer(response, delimiter=',' ,  quoting=csv.QUOTE_ALL, escapechar='\\')
-
     headers = _getHeaders(iteration.project)
-    row = []
-    for idx, header in enumerate(headers):
-        row.append(header[1])
-
-    writer.writerow(row)
-
-    for idx, story in enumerate(stories):
-        row = []
-        for hidx, header in enumerate(headers):
-            f = header[2]
-            row.append(f(story))
-        writer.writerow(row)
 
+    def generate():
+        buffer = cStringIO.StringIO()
+        writer = UnicodeWriter(buffer)
+        #csv.writer(response, delimiter=',' ,  quoting=csv.QUOTE_ALL, escapechar='\\')
+        writer.writerow([header[1] for header in headers])
+        for story in _iterateStories(stories):
+            writer.writerow([header[2](story) for header in headers])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    response = HttpResponse(generate(), mimetype="text/csv")
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' % file_name
     return response
 
 
@@ -366,30 +425,39 @@ class UnicodeWriter:
     """
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
+        # The csv module works on byte strings, so encode each cell once and write straight through.
+        # That's fine for any ascii compatible encoding.
+        self.writer = csv.writer(f, dialect=dialect, **kwds)
+        self.encoding = encoding
 
     def writerow(self, row):
-        self.writer.writerow([unicode(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
+        self.writer.writerow([unicode(s).encode(self.encoding) for s in row])
 
     def writerows(self, rows):
         for row in rows:
             self.writerow(row)
 
 
-def _importData(request, data, iteration, user):
+class ImportResult(object):
+    """ What happened during an import.  errors is a list of (row number, message) tuples, with the
+        first data row being row 1. """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    @property
+    def imported(self):
+        return self.created + self.updated
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+
+def _importData(request, data, iteration, user, dry_run=False):
     """ Imports data from a python object to an iteration.
         The idea here is that all the import mechanisms (CSV, XML, XLS) can translate
         their input to a python object hierarchy, and they all can pass that off to
@@ -399,20 +467,27 @@ def _importData(request, data, iteration, user):
         data should be an array of python dict like objects, where the keys are
         the names from the getHeaders call, and the values are the user's input.
         """
-    imported = 0
-    failed = 0
-    for row in data:
-        if _importSingleRow(row, iteration, user):
-            imported += 1
-        else:
-            failed += 1
-    logger.info("Imported %d records, failed on %d" % (imported, failed))
-    if failed == 0:
-        messages.info(request, "Imported %d records." % imported)
+    result = importStories(data, iteration, user, dry_run=dry_run)
+    logger.info("Imported %d records, failed on %d" % (result.imported, result.failed))
+    for line in describeImportResult(result):
+        messages.info(request, line)
+    return (result.imported, result.failed)
+
+
+def describeImportResult(result, max_errors=20):
+    "Returns the lines of text we show the user about an ImportResult."
+    if result.dry_run:
+        lines = ["Dry run: would create %d and update %d records, %d would fail." %
+                 (result.created, result.updated, result.failed)]
+    elif result.failed == 0:
+        lines = ["Imported %d records." % result.imported]
     else:
-        messages.info(request, "Imported %d records, failed on %d" %
-                      (imported, failed))
-    return (imported, failed)
+        lines = ["Imported %d records, failed on %d" % (result.imported, result.failed)]
+    for row_number, error in result.errors[:max_errors]:
+        lines.append("Row %d: %s" % (row_number, error))
+    if len(result.errors) > max_errors:
+        lines.append("... and %d more rows failed." % (len(result.errors) - max_errors))
+    return lines
 
 
 def _getFieldFromImportData(data, field_name):
@@ -430,29 +505,67 @@ def _getFieldFromImportData(data, field_name):
     return rv
 
 
-def _importSingleRow(row, iteration, user):
+def _parseLocalId(value):
     try:
-        local_id = _getFieldFromImportData(row, "Story ID")
-        story = None
-        if local_id is not None:
-            try:
-                story = Story.objects.get(
-                    project=iteration.project, local_id=int(local_id))
-                logger.debug("Found story to update (%d)" % int(local_id))
-            except:
-                # Story didn't exist already, so we'll be making a new one
-                # This is a little dangerous if there was a story id set, since we'll now be ignoring
-                # that and that might not be what the user intended.
-                story = Story(
-                    project=iteration.project, iteration=iteration, local_id=iteration.project.getNextId())
-                story.creator = user
-                logger.debug("Creating new story to import into.")
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def importStories(data, iteration, user, dry_run=False, chunk_size=100, progress=None):
+    """ Imports rows of story data into an iteration, see _importData for the format.
+
+        Everything that used to be looked up per row is done up front: the existing stories are loaded
+        by local id in a few queries, new local ids and ranks are handed out from a block, and assignees
+        come from one member map.  Rows are then saved in chunks, each chunk in its own transaction with
+        a savepoint per row so one bad row doesn't lose the others.
+
+        With dry_run nothing is saved, but every row is still validated and counted.  If given,
+        progress(rows_done, rows_total) is called after each chunk.
+        Returns an ImportResult. """
+    # Imported here, since the signal handlers import the calculation module, which imports the models.
+    from projects.signal_handlers import batchedStatsUpdates
+
+    project = iteration.project
+    result = ImportResult(dry_run)
+
+    local_ids = [_parseLocalId(_getFieldFromImportData(row, "Story ID")) for row in data]
+    wanted_ids = list(set([local_id for local_id in local_ids if local_id is not None]))
+    existing = {}
+    for start in range(0, len(wanted_ids), 500):
+        for story in Story.objects.filter(project=project, local_id__in=wanted_ids[start:start + 500]):
+            existing[story.local_id] = story
+
+    counters = {
+        "local_id": (project.stories.aggregate(Max("local_id"))["local_id__max"] or 0) + 1,
+        "rank": (iteration.stories.aggregate(Max("rank"))["rank__max"] or 0) + 10,
+    }
+
+    def next_rank():
+        counters["rank"] += 10
+        return counters["rank"] - 10
+
+    members = dict((member.username, member) for member in project.all_members())
+    headers = _getHeaders(project, members=members, next_rank=next_rank)
+
+    stories = []
+    for row_number, (row, local_id) in enumerate(zip(data, local_ids)):
+        story = existing.get(local_id)
+        if story is None:
+            # Story didn't exist already, so we'll be making a new one
+            # This is a little dangerous if there was a story id set, since we'll now be ignoring
+            # that and that might not be what the user intended.
+            story = Story(project=project, iteration=iteration, local_id=counters["local_id"], creator=user)
+            story.rank = next_rank()
+            counters["local_id"] += 1
+            created = True
+        else:
+            created = False
 
         # A user could move rows from one iteration export to another, so set
         # it here. It'll probably be rare to actually happen.
         story.iteration = iteration
 
-        headers = _getHeaders(iteration.project)
         for header in headers:
             value = _getFieldFromImportData(row, header[1])
             if value is not None:
@@ -460,19 +573,51 @@ def _importSingleRow(row, iteration, user):
                     # This should be a method capable of setting the property
                     f = header[4]
                     f(story, value)
-                    # logger.debug("Setting %s to %s" % (header[1],value) )
                 except:
                     logger.info("Failed to set %s to %s, ignoring." %
                                 (header[1], unicode(value)))
+        try:
+            story.clean_fields(exclude=["summary", "detail", "creator", "iteration", "project", "epic", "assignee"])
+        except ValidationError as e:
+            result.errors.append((row_number + 1, "; ".join(["%s: %s" % (field, ", ".join(errors)) for field, errors in e.message_dict.items()])))
+            continue
+        stories.append((row_number, story, created))
+
+    if dry_run:
+        for row_number, story, created in stories:
+            if created:
+                result.created += 1
+            else:
+                result.updated += 1
+        return result
 
-        story.save()
-        return True
-    except Exception as e:
-        logger.debug("Failed to import a record. %s" % e)
-        return False
+    with batchedStatsUpdates():
+        for start in range(0, len(stories), chunk_size):
+            _saveImportChunk(stories[start:start + chunk_size], result)
+            if progress is not None:
+                progress(min(start + chunk_size, len(stories)), len(stories))
+    return result
 
 
-def _importExcelIteration(request, iteration, file, user):
+@transaction.commit_on_success
+def _saveImportChunk(stories, result):
+    for row_number, story, created in stories:
+        savepoint = transaction.savepoint()
+        try:
+            story.save()
+            transaction.savepoint_commit(savepoint)
+        except Exception as e:
+            transaction.savepoint_rollback(savepoint)
+            logger.debug("Failed to import a record. %s" % e)
+            result.errors.append((row_number + 1, unicode(e)))
+            continue
+        if created:
+            result.created += 1
+        else:
+            result.updated += 1
+
+
+def _readExcelFile(file):
     try:
         workbook = open_workbook(file_contents=file.read())
     except:
@@ -480,7 +625,6 @@ def _importExcelIteration(request, iteration, file, user):
             file_contents=file.read(), encoding_override="cp1252")
     sheet = workbook.sheets()[0]
     count = 0
-    headers = _getHeaders(iteration.project)
     import_data = []
     for row in range(1, sheet.nrows):
         rowData = {}
@@ -491,10 +635,10 @@ def _importExcelIteration(request, iteration, file, user):
             rowData[header] = val
         import_data.append(rowData)
     logger.info("Found %d rows in an excel sheet " % count)
-    _importData(request, import_data, iteration, user)
+    return import_data
 
 
-def _importXMLIteration(request, iteration, file, user):
+def _readXMLFile(file):
     xml = parse(file)
     import_data = []
     count = 0
@@ -506,10 +650,10 @@ def _importXMLIteration(request, iteration, file, user):
         count += 1
         import_data.append(import_row)
     logger.info("Found %d rows in an XML file" % count)
-    _importData(request, import_data, iteration, user)
+    return import_data
 
 
-def _importCSVIteration(request, iteration, file, user):
+def _readCSVFile(file):
     import_file = csv.reader(
         file, delimiter=',',  quoting=csv.QUOTE_ALL, escapechar='\\')
     try:
@@ -532,7 +676,7 @@ def _importCSVIteration(request, iteration, file, user):
     except:
         logger.info("Failed to import CSV file")
     logger.info("Found %d rows in a CSV file" % count)
-    _importData(request, import_data, iteration, user)
+    return import_data
 
 
 def cleanWorksheetName(name):
@@ -34,7 +34,8 @@ import datetime
 
 from projects.calculation import onDemandCalculateVelocity
 import projects.signals as signals
-from projects.models import Project, ProjectMember, Iteration, Story
+from projects.models import Project, ProjectMember, Iteration, Story, BackgroundJob
+from projects.jobs import queueJob
 from projects.forms import *
 from projects.access import *
 import projects.import_export as import_export
@@ -203,13 +204,19 @@ def iteration_import(request, group_slug, iteration_id):
         form = form_class(request.POST)
         import_file = request.FILES.get("import_file", None)
         if form.is_valid() and import_file is not None:
+            dry_run = form.cleaned_data.get("dry_run", False)
             unlock = form.cleaned_data.get("unlock_iteration", False)
-            if unlock:
+            if unlock and not dry_run:
                 iteration.locked = False
                 iteration.save()
+            if form.cleaned_data.get("background", False):
+                job = queueJob(BackgroundJob.TYPE_ITERATION_IMPORT, request.user, project=project,
+                               iteration=iteration, upload=import_file, dry_run=dry_run)
+                return HttpResponseRedirect(job.get_absolute_url())
             status = import_export.importIteration(request,
-                iteration, import_file, request.user)
-            onDemandCalculateVelocity(project)
+                iteration, import_file, request.user, dry_run=dry_run)
+            if not dry_run:
+                onDemandCalculateVelocity(project)
         return HttpResponseRedirect(reverse('iteration', kwargs={'group_slug': project.slug, 'iteration_id': iteration.id}))
     else:
         form = form_class()
@@ -252,6 +259,10 @@ def iteration_export(request, group_slug, iteration_id):
             if lock:
                 iteration.locked = True
                 iteration.save()
+            if form.cleaned_data.get("background", False):
+                job = queueJob(BackgroundJob.TYPE_ITERATION_EXPORT, request.user, project=project,
+                               iteration=iteration, format=format, file_name=file_name)
+                return HttpResponseRedirect(job.get_absolute_url())
             return import_export.exportIteration(iteration, format, file_name)
     else:
         form = ExportForm(initial={'file_name': u'iteration'})
@@ -0,0 +1,72 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301  USA
+
+import json
+import os
+
+from django.shortcuts import render_to_response, get_object_or_404
+from django.template import RequestContext
+from django.http import HttpResponse, Http404
+from django.core.urlresolvers import reverse
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+
+from projects.models import BackgroundJob
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _getJob(request, job_id):
+    job = get_object_or_404(BackgroundJob, id=job_id)
+    if job.user != request.user:
+        raise PermissionDenied()
+    return job
+
+
+@login_required
+def job_detail(request, job_id):
+    job = _getJob(request, job_id)
+    return render_to_response("projects/job_detail.html", {"job": job, "project": job.project}, context_instance=RequestContext(request))
+
+
+@login_required
+def job_status(request, job_id):
+    "Polled by the job page to show the progress."
+    job = _getJob(request, job_id)
+    result = {"status": job.get_status_display(),
+              "progress": job.progress,
+              "message": job.message,
+              "finished": job.finished_running(),
+              "download_url": None}
+    if job.status == BackgroundJob.STATUS_DONE and job.result_file:
+        result["download_url"] = reverse("job_download", kwargs={"job_id": job.id})
+    return HttpResponse(json.dumps(result))  # , mimetype='application/json'
+
+
+@login_required
+def job_download(request, job_id):
+    job = _getJob(request, job_id)
+    if job.status != BackgroundJob.STATUS_DONE or not job.result_file or not os.path.exists(job.result_file):
+        raise Http404
+    result_file = open(job.result_file, "rb")
+    response = HttpResponse(iter(lambda: result_file.read(65536), ""), mimetype=job.result_mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s' % job.result_name
+    response['Content-Length'] = os.path.getsize(job.result_file)
+    return response
@@ -0,0 +1,192 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Background jobs for imports and exports that take too long to run inside a request.
+#
+# A view queues a BackgroundJob, the run_jobs management command claims queued jobs
+# one at a time and runs the matching import_export function, and the result file is
+# written to JOB_FILE_ROOT for the job_download view to hand back.
+
+from datetime import datetime, timedelta
+import json
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.db.models import Q
+
+from projects.models import BackgroundJob
+from projects.calculation import onDemandCalculateVelocity
+import projects.import_export as import_export
+import organizations.import_export as organization_import_export
+
+import sys
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+
+JOB_FILE_ROOT = getattr(settings, "JOB_FILE_ROOT", os.path.join(tempfile.gettempdir(), "scrumdo_jobs"))
+
+# A running job whose worker hasn't touched it in this long belongs to a worker that died.
+JOB_TIMEOUT = timedelta(seconds=getattr(settings, "JOB_TIMEOUT_SECONDS", 2 * 60 * 60))
+
+
+def _jobFilePath(job, suffix):
+    if not os.path.isdir(JOB_FILE_ROOT):
+        os.makedirs(JOB_FILE_ROOT)
+    return os.path.join(JOB_FILE_ROOT, "job-%d-%s" % (job.id, suffix))
+
+
+def queueJob(job_type, user, project=None, iteration=None, organization=None, upload=None, **parameters):
+    """ Creates a queued job.  An uploaded file is copied to disk so the worker can read it later.
+        Any extra keyword arguments are stored as the job's parameters. """
+    job = BackgroundJob(job_type=job_type, user=user, project=project, iteration=iteration,
+                        organization=organization, parameters=json.dumps(parameters))
+    job.save()
+    if upload is not None:
+        job.input_file = _jobFilePath(job, "input")
+        destination = open(job.input_file, "wb")
+        try:
+            for chunk in upload.chunks():
+                destination.write(chunk)
+        finally:
+            destination.close()
+        parameters["input_name"] = upload.name
+        job.parameters = json.dumps(parameters)
+        job.save()
+    return job
+
+
+def claimNextJob():
+    """ Returns the oldest queued job after marking it as running, or None if there's nothing to do.
+        The status check in the update means two workers can't claim the same job. """
+    for job_id in BackgroundJob.objects.filter(status=BackgroundJob.STATUS_QUEUED).order_by("created").values_list("id", flat=True)[:10]:
+        now = datetime.now()
+        claimed = BackgroundJob.objects.filter(id=job_id, status=BackgroundJob.STATUS_QUEUED).update(
+            status=BackgroundJob.STATUS_RUNNING, started=now, heartbeat=now)
+        if claimed == 1:
+            return BackgroundJob.objects.get(id=job_id)
+    return None
+
+
+def failStaleJobs():
+    """ Marks running jobs whose heartbeat is more than JOB_TIMEOUT old as failed, so their job pages
+        stop waiting.  Jobs claimed before there was a heartbeat go by when they started.  They aren't
+        requeued since an import may have got part way.  Returns how many were failed. """
+    cutoff = datetime.now() - JOB_TIMEOUT
+    stale = Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True, started__lt=cutoff)
+    return BackgroundJob.objects.filter(stale, status=BackgroundJob.STATUS_RUNNING).update(
+        status=BackgroundJob.STATUS_FAILED, finished=datetime.now(),
+        message="Sorry, this job stopped before it finished.  Please try again.")
+
+
+def setProgress(job, percent, message=None):
+    job.progress = int(percent)
+    fields = {"progress": job.progress, "heartbeat": datetime.now()}
+    if message is not None:
+        job.message = fields["message"] = message
+    BackgroundJob.objects.filter(id=job.id).update(**fields)
+
+
+def runJob(job):
+    "Runs a job that's already been claimed, and records how it went."
+    try:
+        parameters = json.loads(job.parameters or "{}")
+        JOB_HANDLERS[job.job_type](job, parameters)
+        job.status = BackgroundJob.STATUS_DONE
+        job.progress = 100
+    except:
+        logger.error("Background job %d failed" % job.id)
+        traceback.print_exc(file=sys.stdout)
+        job.status = BackgroundJob.STATUS_FAILED
+        job.message = "Sorry, something went wrong while running this job."
+    job.finished = datetime.now()
+    # Not save(), failStaleJobs may have given up on this job while it ran, and that should stand.
+    finished = BackgroundJob.objects.filter(id=job.id, status=BackgroundJob.STATUS_RUNNING).update(
+        status=job.status, progress=job.progress, message=job.message, finished=job.finished,
+        result_file=job.result_file, result_name=job.result_name, result_mimetype=job.result_mimetype)
+    if finished == 0:
+        logger.error("Background job %d was marked as failed before it finished" % job.id)
+    if job.input_file and os.path.exists(job.input_file):
+        os.remove(job.input_file)
+
+
+def _saveResponse(job, response):
+    "Writes an export's HttpResponse to the job's result file."
+    job.result_file = _jobFilePath(job, "result")
+    output = open(job.result_file, "wb")
+    try:
+        for chunk in response:
+            output.write(chunk)
+    finally:
+        output.close()
+    m = re.search("filename=(.+)", response.get("Content-Disposition", ""))
+    job.result_name = m.group(1) if m else "export"
+    job.result_mimetype = response.get("Content-Type", "application/octet-stream")
+
+
+def _runIterationImport(job, parameters):
+    input_file = open(job.input_file, "rb")
+    try:
+        result = import_export.importIterationFile(
+            job.iteration, input_file, job.user, dry_run=parameters.get("dry_run", False),
+            progress=lambda done, total: setProgress(job, 100 * done / max(total, 1)),
+            file_name=parameters.get("input_name"))
+    finally:
+        input_file.close()
+    if result is None:
+        job.message = "Please save your file as an .xls Excel file before importing."
+        return
+    job.message = "\n".join(import_export.describeImportResult(result))
+    if not result.dry_run:
+        onDemandCalculateVelocity(job.project)
+
+
+def _runIterationExport(job, parameters):
+    _saveResponse(job, import_export.exportIteration(job.iteration, parameters.get("format", "xls"), parameters.get("file_name")))
+
+
+def _runProjectExport(job, parameters):
+    _saveResponse(job, import_export.exportProject(job.project, parameters.get("file_name")))
+
+
+def _runOrganizationExport(job, parameters):
+    _saveResponse(job, organization_import_export.export_organization(job.organization, project_ids=parameters.get("project_ids")))
+
+
+JOB_HANDLERS = {
+    BackgroundJob.TYPE_ITERATION_IMPORT: _runIterationImport,
+    BackgroundJob.TYPE_ITERATION_EXPORT: _runIterationExport,
+    BackgroundJob.TYPE_PROJECT_EXPORT: _runProjectExport,
+    BackgroundJob.TYPE_ORGANIZATION_EXPORT: _runOrganizationExport,
+}
+
+
+def purgeOldJobs(days):
+    "Deletes finished jobs older than the given number of days, along with their files."
+    count = 0
+    old_jobs = BackgroundJob.objects.filter(created__lt=datetime.now() - timedelta(days=days),
+                                            status__in=(BackgroundJob.STATUS_DONE, BackgroundJob.STATUS_FAILED))
+    for job in old_jobs:
+        for path in (job.input_file, job.result_file):
+            if path and os.path.exists(path):
+                os.remove(path)
+        job.delete()
+        count += 1
+    return count
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+import time
+
+from apps.projects.models import Story, Epic, pointsValue
+from django.core.management.base import BaseCommand
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def backfillPoints(model):
+    """ Sets numeric_points from points for every row of model that's out of date.  There are only a
+        handful of distinct points strings, so this is one update per string.  Returns the rows written. """
+    written = 0
+    for points in model.objects.values_list("points", flat=True).distinct().order_by():
+        value = pointsValue(points)
+        written += model.objects.filter(points=points).exclude(numeric_points=value).update(numeric_points=value)
+    return written
+
+
+class Command(BaseCommand):
+    help = 'Sets the numeric_points columns of stories and epics from their points, wherever they are out of date.'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        for model in (Story, Epic):
+            written = backfillPoints(model)
+            print "Updated %d %s rows in %.1fs." % (written, model._meta.object_name, time.time() - start)
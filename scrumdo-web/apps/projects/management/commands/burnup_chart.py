@@ -1,21 +1,173 @@
 #!/usr/bin/env python
+from optparse import make_option
 from datetime import date, timedelta
+import glob
+import multiprocessing
+import os
+import tempfile
+import time
+
 from apps.projects.models import Project, Iteration, Story, PointsLog
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 
-from projects.calculation import calculateProject
+from projects.calculation import calculateProjectsPoints, saveProjectPoints, legacyProjectPoints, diffProjectPoints
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_DIR = getattr(settings, "BURNUP_CHECKPOINT_DIR", tempfile.gettempdir())
+
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--verify', action='store_true', dest='verify', default=False,
+            help='Compare the set-based calculation against the legacy one without saving anything.'),
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=100,
+            help='How many projects to calculate per batch of queries.'),
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=1,
+            help='Number of worker processes, each one takes a slice of the project ids.'),
+        make_option(
+            '--resume', action='store_true', dest='resume', default=False,
+            help="Skip projects already recorded in today's checkpoint files."),
+        make_option(
+            '--checkpoint-dir', action='store', dest='checkpoint_dir', default=CHECKPOINT_DIR,
+            help='Directory to keep the per-worker checkpoint files in.'),
+        make_option(
+            '--slowest', action='store', type='int', dest='slowest', default=10,
+            help='How many of the slowest projects to report at the end.'),
+    )
+
+    help = 'Calculates velocity and logs burnup chart points for every active project.'
 
     def handle(self, *args, **options):
-        projects = Project.objects.filter(active=True)
-        for project in projects:
+        batch_size = max(1, options.get("batch_size", 100))
+        project_ids = list(Project.objects.filter(active=True).values_list("id", flat=True).order_by("id"))
+
+        if options.get("verify", False):
+            self.verify(project_ids, batch_size)
+            return
+
+        workers = max(1, options.get("workers", 1))
+        checkpoint_dir = options.get("checkpoint_dir", CHECKPOINT_DIR)
+        run_date = date.today()
+
+        if options.get("resume", False):
+            done = readCheckpoints(checkpoint_dir, run_date)
+            logger.info("Resuming, %d projects already calculated today." % len(done))
+        else:
+            clearCheckpoints(checkpoint_dir, run_date)
+            done = {}
+        remaining = [project_id for project_id in project_ids if project_id not in done]
+
+        start = time.time()
+        if workers == 1 or len(remaining) <= batch_size:
+            calculateProjectIds(remaining, batch_size, checkpointPath(checkpoint_dir, run_date, 0))
+        else:
+            # Each child needs its own database connection, so don't let them inherit ours.
+            connection.close()
+            processes = []
+            for worker in range(workers):
+                process = multiprocessing.Process(target=calculateProjectIds,
+                                                  args=(remaining[worker::workers], batch_size,
+                                                        checkpointPath(checkpoint_dir, run_date, worker)))
+                process.start()
+                processes.append(process)
+            for process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    logger.error("Burnup worker %d exited with code %s, run again with --resume" % (process.pid, process.exitcode))
+        elapsed = time.time() - start
+
+        timings = readCheckpoints(checkpoint_dir, run_date)
+        calculated = len([project_id for project_id in remaining if project_id in timings])
+        print "Calculated %d of %d projects in %.1fs (%.1f projects/sec), %d failed." % (
+            calculated, len(remaining), elapsed, calculated / max(elapsed, 0.001), len(remaining) - calculated)
+
+        slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:options.get("slowest", 10)]
+        if len(slowest) > 0:
+            slugs = dict(Project.objects.filter(id__in=[item[0] for item in slowest]).values_list("id", "slug"))
+            print "Slowest projects:"
+            for project_id, seconds in slowest:
+                print "  %8.3fs %s" % (seconds, slugs.get(project_id, project_id))
+
+    def verify(self, project_ids, batch_size):
+        mismatched = 0
+        failed = 0
+        for start in range(0, len(project_ids), batch_size):
+            batch_ids = project_ids[start:start + batch_size]
+            try:
+                results = calculateProjectsPoints(Project.objects.filter(id__in=batch_ids)).values()
+            except:
+                logger.error("Could not calculate projects %s" % batch_ids)
+                failed += len(batch_ids)
+                continue
+            for result in results:
+                try:
+                    diffs = diffProjectPoints(legacyProjectPoints(result.project), result)
+                except:
+                    logger.error("Could not calculate project %s" % result.project.slug)
+                    failed += 1
+                    continue
+                if len(diffs) > 0:
+                    mismatched += 1
+                    print "%s: %s" % (result.project.slug, "; ".join(diffs))
+        print "Verified %d projects, %d differed from the legacy calculation, %d failed." % (
+            len(project_ids), mismatched, failed)
+
+
+def checkpointPath(checkpoint_dir, run_date, worker):
+    return os.path.join(checkpoint_dir, "burnup-%s-w%d.checkpoint" % (run_date.isoformat(), worker))
+
+
+def readCheckpoints(checkpoint_dir, run_date):
+    "Returns a dict of project id -> seconds for every project recorded in a run's checkpoint files."
+    done = {}
+    for path in glob.glob(os.path.join(checkpoint_dir, "burnup-%s-w*.checkpoint" % run_date.isoformat())):
+        for line in open(path):
+            try:
+                project_id, seconds = line.split()
+                done[int(project_id)] = float(seconds)
+            except ValueError:
+                pass  # a partially written last line from a crashed worker
+    return done
+
+
+def clearCheckpoints(checkpoint_dir, run_date):
+    for path in glob.glob(os.path.join(checkpoint_dir, "burnup-%s-w*.checkpoint" % run_date.isoformat())):
+        os.remove(path)
+
+
+def calculateProjectIds(project_ids, batch_size, checkpoint_path):
+    """ Calculates and saves a list of projects, appending each finished project to the checkpoint file
+        along with how long it took.  A project's time is its own save time plus a share of its batch's
+        query time proportional to its number of stories. """
+    checkpoint = open(checkpoint_path, "a")
+    try:
+        for start in range(0, len(project_ids), batch_size):
+            batch_ids = project_ids[start:start + batch_size]
+            batch_start = time.time()
             try:
-                calculateProject(project)
+                results = calculateProjectsPoints(Project.objects.filter(id__in=batch_ids))
             except:
-                logger.error("Could not calculate project %s" % project.slug)
+                logger.error("Could not calculate projects %s" % batch_ids)
+                continue
+            query_time = time.time() - batch_start
+            story_count = max(1, sum([result.story_count for result in results.values()]))
+            for result in results.values():
+                save_start = time.time()
+                try:
+                    saveProjectPoints(result)
+                except:
+                    logger.error("Could not calculate project %s" % result.project.slug)
+                    continue
+                seconds = time.time() - save_start + query_time * result.story_count / story_count
+                checkpoint.write("%d %f\n" % (result.project.id, seconds))
+                checkpoint.flush()
+    finally:
+        checkpoint.close()
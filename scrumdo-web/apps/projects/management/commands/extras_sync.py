@@ -21,19 +21,15 @@
 
 # This script handles running the extra's syncronization logic.
 # You should set this up on some sort of scheduled basis.  The
-# scrumdo.com website runs it once a minute.
+# scrumdo.com website runs it once a minute.  With --loop it keeps
+# running instead, and picks up new queue items as they come in.
 
-import sys
-from datetime import date, timedelta
+from optparse import make_option
 
-from apps.projects.models import Project, Iteration, Story, PointsLog
-from apps.extras.models import ProjectExtraMapping, SyncronizationQueue
-from apps.extras.manager import manager
+from apps.extras.models import ProjectExtraMapping, SyncronizationQueue, SyncronizationDeadLetter
+from extras.sync import processQueue, requeueDeadLetters, SYNC_WORKERS
 
 import logging
-import sys, traceback
-import getopt
-import urllib2
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -41,18 +37,34 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    args = "pull"
-    def handle(self, *args, **options):
-        options, remainder = getopt.getopt(sys.argv[1:], 'p', ['pull'])
+    args = "[pull [project_slug]]"
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=SYNC_WORKERS,
+            help='How many projects to syncronize at once.'),
+        make_option(
+            '--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, waiting for new queue items.'),
+        make_option(
+            '--sleep', action='store', type='int', dest='sleep', default=10,
+            help='With --loop, seconds to wait when the queue is empty.'),
+        make_option(
+            '--retry-dead', action='store_true', dest='retry_dead', default=False,
+            help='Put the items that kept failing back on the queue.'),
+    )
 
-        for arg in args:
-            if arg == "pull":
-                if len(remainder) == 3:
-                    setUpPullQueue( project_slug=remainder[2] )
-                else:
-                    setUpPullQueue()
-                    return
-        processQueue()
+    def handle(self, *args, **options):
+        if len(args) > 0 and args[0] == "pull":
+            if len(args) > 1:
+                setUpPullQueue( project_slug=args[1] )
+            else:
+                setUpPullQueue()
+                return
+        if options.get("retry_dead"):
+            count = requeueDeadLetters(SyncronizationDeadLetter.objects.all().order_by("id"))
+            logger.info("Requeued %d failed items." % count)
+        processQueue(workers=options.get("workers", SYNC_WORKERS), loop=options.get("loop", False),
+                     sleep=options.get("sleep", 10))
 
 
 def setUpPullQueue( **kwargs ):
@@ -63,70 +75,3 @@ def setUpPullQueue( **kwargs ):
         if project_slug==None or project_slug==mapping.project.slug:
             qItem = SyncronizationQueue(project=mapping.project, extra_slug=mapping.extra_slug, action=SyncronizationQueue.ACTION_SYNC_REMOTE)
             qItem.save()
-
-
-def processQueue():
-    queue = SyncronizationQueue.objects.all()
-    for queueItem in queue:
-    # In case a second invocation of this script occurs while it's running, we don't want
-    # to re-process any items...
-        queueItem.delete()
-        pass
-
-    for queueItem in queue:
-        try:
-            project = queueItem.project
-            if not project.active:
-                continue
-
-            logger.info("== Synchronizing %s / %s / %d" % (project.slug, queueItem.extra_slug, queueItem.action) )
-            story = queueItem.story
-            task = queueItem.task
-            action = queueItem.action
-            extra_slug = queueItem.extra_slug
-            action = queueItem.action
-            external_id = queueItem.external_id
-
-            extra = manager.getExtra( extra_slug )
-
-            if action == SyncronizationQueue.ACTION_SYNC_REMOTE:
-                extra.pullProject(project)
-            elif action == SyncronizationQueue.ACTION_STORY_UPDATED:
-                extra.storyUpdated(project,story)
-            elif action == SyncronizationQueue.ACTION_STORY_DELETED:
-                extra.storyDeleted(project,external_id)
-            elif action == SyncronizationQueue.ACTION_STORY_CREATED:
-                extra.storyCreated(project,story)
-            elif action == SyncronizationQueue.ACTION_STORY_STATUS_CHANGED:
-                extra.storyStatusChange(project, story)
-            elif action == SyncronizationQueue.ACTION_INITIAL_SYNC:
-                extra.initialSync( project )
-            elif action == SyncronizationQueue.ACTION_TASK_UPDATED:
-                extra.taskUpdated(project, task)
-            elif action == SyncronizationQueue.ACTION_TASK_DELETED:
-                extra.taskDeleted(project, external_id)
-            elif action == SyncronizationQueue.ACTION_TASK_CREATED:
-                extra.taskCreated(project, task)
-            elif action == SyncronizationQueue.ACTION_TASK_STATUS_CHANGED:
-                extra.taskStatusChange(project, task)
-            elif action == SyncronizationQueue.ACTION_STORY_IMPORTED:
-                extra.storyImported(project, story)
-
-            logger.info("Success.")
-        except RuntimeError:
-            logger.error("RuntimeError occured while processing a syncronization queue item.")
-            traceback.print_exc(file=sys.stdout)
-        except urllib2.HTTPError as e:
-            logger.error("HTTP Error %d occured while processing a syncronization queue item." % e.code)
-            logger.error(e.headers)
-            logger.error(e.read())
-            traceback.print_exc(file=sys.stdout)
-        except:
-            logger.error("Error occured while processing a syncronization queue item.")
-            traceback.print_exc(file=sys.stdout)
-
-
-
-
-if __name__ == "__main__":
-    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from projects.search_queue import processQueue, rebuildIndex, INDEX_BATCH_SIZE, INDEX_WORKERS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Send every story to the search index, not just the queued ones.'),
+        make_option(
+            '--clear', action='store_true', dest='clear', default=False,
+            help='With --rebuild, empty the story index first.'),
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=INDEX_WORKERS,
+            help='How many threads send stories to the search backend during a rebuild.'),
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=INDEX_BATCH_SIZE,
+            help='How many stories go to the search backend in each update.'),
+        make_option(
+            '--loop', action='store_true', dest='loop', default=False,
+            help='Keep checking the queue instead of stopping once it is empty.'),
+    )
+
+    help = 'Sends queued story changes to the search index.'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        batch_size = options.get("batch_size", INDEX_BATCH_SIZE)
+        if options.get("rebuild", False):
+            count = rebuildIndex(options.get("workers", INDEX_WORKERS), batch_size, options.get("clear", False))
+        else:
+            count = processQueue(batch_size, options.get("loop", False))
+        print "Indexed %d stories in %.1fs." % (count, time.time() - start)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+from optparse import make_option
+from datetime import datetime
+import time
+
+from apps.projects.models import Project, Iteration, RankRebalance
+from django.core.management.base import BaseCommand, CommandError
+
+from projects.ranking import runQueuedRebalances, rebalanceIteration, rebalanceProjectEpics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--all', action='store_true', dest='all', default=False,
+            help='Rebalance every iteration and project, not just the ones reorders have queued up.'),
+    )
+
+    help = 'Spreads out story ranks and epic orders that have been squeezed together by reordering.'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        started = datetime.now()
+        if options.get("all", False):
+            written = 0
+            for iteration in Iteration.objects.all().iterator():
+                for field_name in ("rank", "board_rank"):
+                    written += rebalanceIteration(iteration, field_name)
+            for project in Project.objects.all().iterator():
+                written += rebalanceProjectEpics(project)
+            RankRebalance.objects.filter(created__lt=started).delete()
+        else:
+            written = runQueuedRebalances()
+        print "Rewrote %d ranks in %.1fs." % (written, time.time() - start)
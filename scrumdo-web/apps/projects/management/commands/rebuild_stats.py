@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+from optparse import make_option
+from apps.projects.models import Project, Iteration, IterationStats, ProjectStats
+from django.core.management.base import BaseCommand, CommandError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=100,
+            help='How many projects to rebuild per batch of queries.'),
+    )
+
+    help = 'Rebuilds the denormalized IterationStats and ProjectStats rows.'
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options.get("batch_size", 100))
+        project_ids = list(Project.objects.values_list("id", flat=True).order_by("id"))
+        for start in range(0, len(project_ids), batch_size):
+            batch_ids = project_ids[start:start + batch_size]
+            try:
+                ProjectStats.rebuild(batch_ids)
+                IterationStats.rebuild(Iteration.objects.filter(project__in=batch_ids).values_list("id", flat=True))
+            except:
+                logger.error("Could not rebuild stats for projects %s" % batch_ids)
+        print "Rebuilt stats for %d projects." % len(project_ids)
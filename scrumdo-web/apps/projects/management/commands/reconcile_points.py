@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+from optparse import make_option
+from apps.projects.models import Project
+from django.core.management.base import BaseCommand, CommandError
+
+from projects.calculation import reconcileProjects
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=100,
+            help='How many projects to check per batch of queries.'),
+    )
+
+    help = "Fixes today's points log rows that drifted from the incremental story signal updates."
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options.get("batch_size", 100))
+        project_ids = list(Project.objects.filter(active=True).values_list("id", flat=True).order_by("id"))
+        fixed = 0
+        for start in range(0, len(project_ids), batch_size):
+            try:
+                results = reconcileProjects(Project.objects.filter(id__in=project_ids[start:start + batch_size]))
+            except:
+                logger.error("Could not reconcile projects %s" % project_ids[start:start + batch_size])
+                continue
+            for result in results:
+                logger.info("Reconciled points for %s" % result.project.slug)
+            fixed += len(results)
+        print "Checked %d projects, fixed %d." % (len(project_ids), fixed)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+
+from projects.jobs import claimNextJob, runJob, purgeOldJobs, failStaleJobs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--loop', action='store_true', dest='loop', default=False,
+            help='Keep waiting for new jobs instead of exiting once the queue is empty.'),
+        make_option(
+            '--sleep', action='store', type='int', dest='sleep', default=5,
+            help='Seconds to wait between checks for new jobs when looping.'),
+        make_option(
+            '--purge-days', action='store', type='int', dest='purge_days', default=7,
+            help='Delete finished jobs and their files after this many days.'),
+    )
+
+    help = 'Runs queued background import and export jobs.  Several of these can run at once.'
+
+    def handle(self, *args, **options):
+        purged = purgeOldJobs(options.get("purge_days", 7))
+        if purged > 0:
+            logger.info("Purged %d old jobs." % purged)
+
+        while True:
+            stale = failStaleJobs()
+            if stale > 0:
+                logger.error("Failed %d jobs whose workers stopped responding." % stale)
+            job = claimNextJob()
+            if job is not None:
+                logger.info("Running %s" % job)
+                start = time.time()
+                runJob(job)
+                logger.info("%s finished in %.1fs" % (job, time.time() - start))
+                reset_queries()
+                continue
+            if not options.get("loop", False):
+                return
+            # Don't hold a connection (and a stale transaction) open while we wait.
+            connection.close()
+            time.sleep(options.get("sleep", 5))
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from projects.fragments import fragmentStats, resetFragmentStats
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--reset', action='store_true', dest='reset', default=False,
+            help='Start the counts over after printing them.'),
+    )
+
+    help = 'Prints the hit ratio of the story snippet cache, for monitoring.'
+
+    def handle(self, *args, **options):
+        hits, misses = fragmentStats()
+        total = hits + misses
+        ratio = float(hits) / total if total > 0 else 0.0
+        print "hits=%d misses=%d ratio=%.3f" % (hits, misses, ratio)
+        if options.get("reset", False):
+            resetFragmentStats()
@@ -31,6 +31,7 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
+from django.db.models import Count, Max, Min, Sum
 from groups.base import Group
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
@@ -55,6 +56,17 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def pointsValue(points):
+    "Converts a points string (like '?', '0.5', 'Inf') to the number used in point calculations."
+    # the float() method understands inf!
+    if points is None or points.lower() == "inf":
+        return 0
+    try:
+        return float(points)
+    except:
+        return 0
+
+
 class SiteStats(models.Model):
     user_count = models.IntegerField()
     project_count = models.IntegerField()
@@ -157,6 +169,9 @@ class Project(Group):
         return choices
 
     def all_members(self):
+        if hasattr(self, "_prefetched_members"):
+            # Set by prefetchStoryList, the tasks section asks for this once per story.
+            return self._prefetched_members
         members = []
         for membership in self.members.all():
             members.append(membership.user)
@@ -218,6 +233,14 @@ class Project(Group):
     def get_num_stories(self):
         return Story.objects.filter(project=self).count()
 
+    def getStats(self):
+        "Returns the ProjectStats rollup for this project, building it if it doesn't exist yet."
+        try:
+            return self.stats_rollup
+        except ProjectStats.DoesNotExist:
+            self.stats_rollup = ProjectStats.rebuild([self.id])[self.id]
+            return self.stats_rollup
+
     def get_num_iterations(self):
         return Iteration.objects.filter(project=self).count()
 
@@ -276,23 +299,25 @@ class Iteration(models.Model):
         today = date.today()
         return self.start_date <= today and self.end_date >= today
 
+    def getStats(self):
+        "Returns the IterationStats rollup for this iteration, building it if it doesn't exist yet."
+        try:
+            return self.stats_rollup
+        except IterationStats.DoesNotExist:
+            self.stats_rollup = IterationStats.rebuild([self.id])[self.id]
+            return self.stats_rollup
+
     def total_points(self):
-        return sum(map(lambda story: story.points_value(), self.stories.all()))
+        return self.getStats().points_total
 
     def completed_points(self):
-        return sum(map(lambda story: (story.points_value() if story.status == Story.STATUS_DONE else 0), self.stories.all()))
+        return self.getStats().points_claimed
 
     def max_points(self):
-        logs = self.points_log.all()
-        if len(logs) == 0:
-            return None
-        return reduce(lambda x, y: max(x, y.points_total), logs, 0)
+        return self.getStats().max_points
 
     def starting_points(self):
-        for p in self.points_log.all():
-            if p.date == self.start_date:
-                return p.points_total
-        return None
+        return self.getStats().starting_points
 
     def daysLeft(self):
         try:
@@ -331,16 +356,19 @@ class Epic(models.Model):
     detail = models.TextField(blank=True)
     points = models.CharField('points', max_length=4, default="?", blank=True,
                               help_text="Rough size of this epic (including size of sub-epics or stories).  Enter ? to specify no sizing.")
+    # pointsValue(points), kept up to date by save() so the database can sort and add up points.
+    numeric_points = models.FloatField(default=0, editable=False)
     project = models.ForeignKey(Project, related_name="epics")
     status = models.IntegerField(
         max_length=2, choices=STATUS_CHOICES, default=1)
-    order = models.IntegerField(max_length=5, default=5000)
+    order = models.FloatField(default=5000)
     archived = models.BooleanField(
         default=False, help_text="Archived epics are generally hidden and their points don't count towards the project.")
 
     def save(self, *args, **kwargs):
         if self.parent == self:
             self.parent = None
+        self.numeric_points = pointsValue(self.points)
         super(Epic, self).save(*args, **kwargs)
 
     def stories_by_rank(self):
@@ -366,12 +394,7 @@ class Epic(models.Model):
         return max(pv, 0)
 
     def points_value(self):
-        if self.points.lower() == "inf":
-            return 0
-        try:
-            return float(self.points)
-        except:
-            return 0
+        return pointsValue(self.points)
 
     def getPointsLabel(self):
         result = filter(
@@ -396,8 +419,8 @@ class Story(models.Model):
     STATUS_DOING = 2
     STATUS_REVIEWING = 3
     STATUS_DONE = 4
-    rank = models.IntegerField()
-    board_rank = models.IntegerField(default=0)
+    rank = models.FloatField()
+    board_rank = models.FloatField(default=0)
     summary = models.TextField()
     local_id = models.IntegerField()
     detail = models.TextField(blank=True)
@@ -408,6 +431,8 @@ class Story(models.Model):
     assignee = models.ForeignKey(
         User, related_name="assigned_stories", verbose_name=_('assignee'), null=True, blank=True)
     points = models.CharField('points', max_length=3, default="?", blank=True)
+    # pointsValue(points), kept up to date by save() so the database can sort and add up points.
+    numeric_points = models.FloatField(default=0, editable=False)
     iteration = models.ForeignKey(Iteration, related_name="stories")
     project = models.ForeignKey(Project, related_name="stories")
     status = models.IntegerField(
@@ -422,6 +447,10 @@ class Story(models.Model):
     tags_to_delete = []
     tags_to_add = []
 
+    def save(self, *args, **kwargs):
+        self.numeric_points = pointsValue(self.points)
+        super(Story, self).save(*args, **kwargs)
+
     @staticmethod
     def getAssignedStories(user, organization):
         projects = ProjectMember.getProjectsForUser(
@@ -445,8 +474,21 @@ class Story(models.Model):
 
     def story_tags_full(self):
         "Helper function to return queryset of taggings with the tag object preloaded"
+        if hasattr(self, "_prefetched_taggings"):
+            return self._prefetched_taggings
         return self.story_tags.all().select_related("tag")
 
+    def external_links_full(self):
+        if hasattr(self, "_prefetched_external_links"):
+            return self._prefetched_external_links
+        return self.external_links.all()
+
+    def tasks_full(self):
+        "The story's tasks with their assignees loaded."
+        if hasattr(self, "_prefetched_tasks"):
+            return self._prefetched_tasks
+        return self.tasks.all().select_related("assignee")
+
     def statusText(self):
         return STATUS_CHOICES[self.status - 1][1]
 
@@ -460,14 +502,7 @@ class Story(models.Model):
         return Project.POINT_RANGES[self.project.point_scale_type]
 
     def points_value(self):
-        # the float() method understands inf!
-        if self.points.lower() == "inf":
-            return 0
-
-        try:
-            return float(self.points)
-        except:
-            return 0
+        return pointsValue(self.points)
 
     def getExternalLink(self, extra_slug):
         try:
@@ -478,6 +513,9 @@ class Story(models.Model):
 
     @property
     def tags(self):
+        if hasattr(self, "_prefetched_tag_names"):
+            # Set by loaders that fetch the tags for a whole list of stories at once.
+            return ", ".join(self._prefetched_tag_names)
         r = ""
         for tag in self.story_tags.all():
             if len(r) > 0:
@@ -555,6 +593,11 @@ class Task(models.Model):
     complete = models.BooleanField(default=False)
     order = models.PositiveIntegerField(default=0)
 
+    def external_links_full(self):
+        if hasattr(self, "_prefetched_external_links"):
+            return self._prefetched_external_links
+        return self.external_links.all()
+
     def getExternalLink(self, extra_slug):
         try:
             link = self.external_links.get(extra_slug="basecamp")
@@ -615,3 +658,186 @@ class ProjectMember(models.Model):
         for project_list in team_projects:
             user_projects = user_projects + list(project_list)
         return list(set(user_projects))
+
+
+def _storyGroupStats(stats, groups, key):
+    "Adds grouped (status, story_count, points_sum) story rows to the matching stats objects."
+    for group in groups:
+        row = stats.get(group[key])
+        if row is None:
+            continue
+        points = group["points_sum"] or 0
+        row.story_count += group["story_count"]
+        row.points_total += points
+        if group["status"] == Story.STATUS_DONE:
+            row.stories_done += group["story_count"]
+            row.points_claimed += points
+
+
+class IterationStats(models.Model):
+    """ Denormalized totals for one iteration so pages and exports can read a single row instead of
+        scanning every story.  Kept up to date by projects.signal_handlers, and the rebuild_stats
+        command recalculates all of them. """
+    iteration = models.OneToOneField(Iteration, related_name="stats_rollup")
+    story_count = models.IntegerField(default=0)
+    stories_done = models.IntegerField(default=0)
+    points_total = models.FloatField(default=0)
+    points_claimed = models.FloatField(default=0)
+    starting_points = models.IntegerField(null=True, blank=True)
+    max_points = models.IntegerField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def rebuild(iteration_ids):
+        "Recalculates the stats for the given iteration ids using grouped queries.  Returns a dict of iteration id -> IterationStats"
+        start_dates = dict(Iteration.objects.filter(id__in=list(iteration_ids)).values_list("id", "start_date"))
+        if len(start_dates) == 0:
+            return {}
+        stats = dict((row.iteration_id, row) for row in IterationStats.objects.filter(iteration__in=start_dates.keys()))
+        for iteration_id in start_dates:
+            row = stats.setdefault(iteration_id, IterationStats(iteration_id=iteration_id))
+            row.story_count = row.stories_done = 0
+            row.points_total = row.points_claimed = 0
+            row.starting_points = row.max_points = None
+
+        _storyGroupStats(stats, Story.objects.filter(iteration__in=start_dates.keys()).values(
+            "iteration", "status").annotate(story_count=Count("id"), points_sum=Sum("numeric_points")).order_by(), "iteration")
+
+        logs = PointsLog.objects.filter(content_type=ContentType.objects.get_for_model(Iteration), object_id__in=start_dates.keys())
+        for log in logs.values("object_id").annotate(max_total=Max("points_total")).order_by():
+            stats[log["object_id"]].max_points = max(log["max_total"], 0)
+        dates = [start_date for start_date in start_dates.values() if start_date is not None]
+        if len(dates) > 0:
+            for log in logs.filter(date__in=dates).values("object_id", "date", "points_total"):
+                if start_dates[log["object_id"]] == log["date"]:
+                    stats[log["object_id"]].starting_points = log["points_total"]
+
+        for row in stats.values():
+            row.save()
+        return stats
+
+    def __unicode__(self):
+        return "Stats for %s" % self.iteration_id
+
+
+class ProjectStats(models.Model):
+    """ Denormalized totals for one project, the project level equivalent of IterationStats.
+        Points only count stories, not epics.  starting_points is the first points log entry
+        for the project. """
+    project = models.OneToOneField(Project, related_name="stats_rollup")
+    story_count = models.IntegerField(default=0)
+    stories_done = models.IntegerField(default=0)
+    points_total = models.FloatField(default=0)
+    points_claimed = models.FloatField(default=0)
+    starting_points = models.IntegerField(null=True, blank=True)
+    max_points = models.IntegerField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def rebuild(project_ids):
+        "Recalculates the stats for the given project ids using grouped queries.  Returns a dict of project id -> ProjectStats"
+        project_ids = list(Project.objects.filter(id__in=list(project_ids)).values_list("id", flat=True))
+        if len(project_ids) == 0:
+            return {}
+        stats = dict((row.project_id, row) for row in ProjectStats.objects.filter(project__in=project_ids))
+        for project_id in project_ids:
+            row = stats.setdefault(project_id, ProjectStats(project_id=project_id))
+            row.story_count = row.stories_done = 0
+            row.points_total = row.points_claimed = 0
+            row.starting_points = row.max_points = None
+
+        _storyGroupStats(stats, Story.objects.filter(project__in=project_ids).values(
+            "project", "status").annotate(story_count=Count("id"), points_sum=Sum("numeric_points")).order_by(), "project")
+
+        logs = PointsLog.objects.filter(content_type=ContentType.objects.get_for_model(Project), object_id__in=project_ids)
+        first_dates = {}
+        for log in logs.values("object_id").annotate(max_total=Max("points_total"), first_date=Min("date")).order_by():
+            stats[log["object_id"]].max_points = max(log["max_total"], 0)
+            first_dates[log["object_id"]] = log["first_date"]
+        if len(first_dates) > 0:
+            for log in logs.filter(date__in=set(first_dates.values())).values("object_id", "date", "points_total"):
+                if first_dates[log["object_id"]] == log["date"]:
+                    stats[log["object_id"]].starting_points = log["points_total"]
+
+        for row in stats.values():
+            row.save()
+        return stats
+
+    def __unicode__(self):
+        return "Stats for %s" % self.project_id
+
+
+class BackgroundJob(models.Model):
+    """ An import or export that's too big to run inside a request.  The view queues one of these,
+        the run_jobs command picks it up and stores the result file on disk, and the job page
+        polls its status until the file can be downloaded.  See projects.jobs """
+    TYPE_ITERATION_IMPORT = 1
+    TYPE_ITERATION_EXPORT = 2
+    TYPE_PROJECT_EXPORT = 3
+    TYPE_ORGANIZATION_EXPORT = 4
+    TYPE_CHOICES = ((TYPE_ITERATION_IMPORT, "Iteration import"),
+                    (TYPE_ITERATION_EXPORT, "Iteration export"),
+                    (TYPE_PROJECT_EXPORT, "Project export"),
+                    (TYPE_ORGANIZATION_EXPORT, "Organization export"))
+
+    STATUS_QUEUED = 1
+    STATUS_RUNNING = 2
+    STATUS_DONE = 3
+    STATUS_FAILED = 4
+    STATUS_CHOICES = ((STATUS_QUEUED, "Queued"),
+                      (STATUS_RUNNING, "Running"),
+                      (STATUS_DONE, "Done"),
+                      (STATUS_FAILED, "Failed"))
+
+    job_type = models.IntegerField(choices=TYPE_CHOICES)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    progress = models.IntegerField(default=0)  # percent
+    message = models.TextField(blank=True, default="")
+    user = models.ForeignKey(User, related_name="background_jobs")
+    project = models.ForeignKey(Project, null=True, blank=True)
+    iteration = models.ForeignKey(Iteration, null=True, blank=True)
+    organization = models.ForeignKey(Organization, null=True, blank=True)
+    parameters = models.TextField(blank=True, default="")  # json encoded
+    input_file = models.CharField(max_length=255, blank=True, default="")
+    result_file = models.CharField(max_length=255, blank=True, default="")
+    result_name = models.CharField(max_length=255, blank=True, default="")
+    result_mimetype = models.CharField(max_length=100, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # Touched by the worker as the job makes progress, see projects.jobs.failStaleJobs
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    def finished_running(self):
+        return self.status in (BackgroundJob.STATUS_DONE, BackgroundJob.STATUS_FAILED)
+
+    def get_absolute_url(self):
+        return reverse("job_detail", kwargs={"job_id": self.id})
+
+    def __unicode__(self):
+        return "%s %d (%s)" % (self.get_job_type_display(), self.id, self.get_status_display())
+
+    class Meta:
+        ordering = ["-created"]
+
+
+class RankRebalance(models.Model):
+    """ An iteration whose story ranks (or a project whose epic orders) have got too close together
+        and should be spread out again by the rebalance_ranks command.  See projects.ranking """
+    field_name = models.CharField(max_length=20)
+    iteration = models.ForeignKey(Iteration, null=True, blank=True)
+    project = models.ForeignKey(Project, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "Rebalance %s of %s" % (self.field_name, self.iteration or self.project)
+
+
+class StoryIndexQueue(models.Model):
+    """ A story that has changed since it was last sent to the search index.  Not a foreign key,
+        since deleted stories have to be taken out of the index too.  See projects.search_queue """
+    story_id = models.IntegerField(db_index=True)
+    queued = models.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return "Index story %d" % self.story_id
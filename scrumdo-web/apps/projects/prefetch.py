@@ -0,0 +1,107 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Loads everything the story list templates show for a page of stories up front, so a page
+# costs the same number of queries whether it has 5 stories or 50.  There's no
+# prefetch_related in this Django, so each relation is one query and the results are put on
+# the objects as _prefetched_* attributes.  Story.story_tags_full, Story.tasks_full,
+# external_links_full, Project.all_members, the task_counts tag and the avatar tag use them
+# when they're there.
+
+from django.contrib.auth.models import User
+
+from avatar.models import prefetch_avatars
+from extras.models import ExternalStoryMapping, ExternalTaskMapping
+from projects.models import Epic, StoryTagging, Task
+
+
+def prefetchStoryList(stories, project=None, tasks=False):
+    """ Loads the tags, assignees and their avatars, epics, task counts and external links for a list
+        of stories.  With tasks, the tasks themselves too, for templates that include tasks_section.html.
+        If project is given, stories in it share that one object.  Returns the stories as a list. """
+    stories = list(stories)
+    if len(stories) == 0:
+        return stories
+    by_id = dict((story.id, story) for story in stories)
+    ids = by_id.keys()
+
+    for story in stories:
+        story._prefetched_taggings = []
+        story._prefetched_external_links = []
+        story._prefetched_task_counts = (0, 0)
+        if project is not None and story.project_id == project.id:
+            story._project_cache = project
+
+    for tagging in StoryTagging.objects.filter(story__in=ids).select_related("tag"):
+        by_id[tagging.story_id]._prefetched_taggings.append(tagging)
+    for story in stories:
+        story._prefetched_tag_names = [tagging.name for tagging in story._prefetched_taggings]
+
+    for link in ExternalStoryMapping.objects.filter(story__in=ids):
+        by_id[link.story_id]._prefetched_external_links.append(link)
+
+    epics = Epic.objects.in_bulk(set([story.epic_id for story in stories if story.epic_id is not None]))
+    for story in stories:
+        if story.epic_id in epics:
+            story._epic_cache = epics[story.epic_id]
+
+    # Assignees of the stories and, below, of their tasks.
+    user_ids = set([story.assignee_id for story in stories if story.assignee_id is not None])
+    if tasks:
+        _prefetchTasks(stories, by_id, user_ids)
+        if project is not None:
+            project._prefetched_members = project.all_members()
+    else:
+        counts = {}
+        for story_id, complete in Task.objects.filter(story__in=ids).values_list("story_id", "complete"):
+            total, completed = counts.get(story_id, (0, 0))
+            counts[story_id] = (total + 1, completed + (1 if complete else 0))
+        for story_id, count in counts.iteritems():
+            by_id[story_id]._prefetched_task_counts = count
+
+    users = User.objects.in_bulk(user_ids)
+    prefetch_avatars(users.values())
+    for item in _withTasks(stories, tasks):
+        if item.assignee_id in users:
+            item._assignee_cache = users[item.assignee_id]
+    return stories
+
+
+def _prefetchTasks(stories, by_id, user_ids):
+    for story in stories:
+        story._prefetched_tasks = []
+    task_list = list(Task.objects.filter(story__in=by_id.keys()))
+    for task in task_list:
+        task._prefetched_external_links = []
+        by_id[task.story_id]._prefetched_tasks.append(task)
+        task._story_cache = by_id[task.story_id]
+        if task.assignee_id is not None:
+            user_ids.add(task.assignee_id)
+    tasks_by_id = dict((task.id, task) for task in task_list)
+    for link in ExternalTaskMapping.objects.filter(task__in=tasks_by_id.keys()):
+        tasks_by_id[link.task_id]._prefetched_external_links.append(link)
+    for story in stories:
+        complete = len([task for task in story._prefetched_tasks if task.complete])
+        story._prefetched_task_counts = (len(story._prefetched_tasks), complete)
+
+
+def _withTasks(stories, tasks):
+    for story in stories:
+        yield story
+        if tasks:
+            for task in story._prefetched_tasks:
+                yield task
@@ -0,0 +1,186 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Story ranks, story board ranks and epic orders are floats, so there's always room to put
+# something between two neighbours by taking the midpoint, and a reorder only writes the row
+# that moved.  After enough inserts at the same spot the gap gets very small, so those spots
+# are queued in RankRebalance and the rebalance_ranks command spreads the ranks out again.
+# Neighbours that are tied or the wrong way round (old data has plenty of ties) leave no
+# midpoint at all, so placeBetween spreads those ranks out right away.
+
+from django.db import connection, transaction
+
+from projects.models import Story, Epic, RankRebalance
+from projects.fragments import invalidateStories
+from projects.search_queue import queueStoryIndex
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+RANK_STEP = 10
+
+# Below this gap we queue a rebalance.  Doubles can still split it many more times, so the
+# rebalance can happen later without affecting the reorder that's going on now.
+MIN_RANK_GAP = 1e-6
+
+
+def rankBetween(rank_before, rank_after):
+    """ Returns a rank that sorts between two others.  Either can be None, meaning the item goes
+        at the start or the end. """
+    if rank_before is None and rank_after is None:
+        return RANK_STEP
+    if rank_before is None:
+        return rank_after - RANK_STEP
+    if rank_after is None:
+        return rank_before + RANK_STEP
+    return (rank_before + rank_after) / 2.0
+
+
+def needsRebalance(rank_before, rank, rank_after):
+    "True if the gap around a new rank is too small, or it didn't fit at all."
+    if rank_before is not None and (rank <= rank_before or rank - rank_before < MIN_RANK_GAP):
+        return True
+    if rank_after is not None and (rank >= rank_after or rank_after - rank < MIN_RANK_GAP):
+        return True
+    return False
+
+
+def outOfOrder(rank_before, rank_after):
+    "True if there's no rank between two neighbours, because they're tied or the wrong way round."
+    return rank_before is not None and rank_after is not None and rank_before >= rank_after
+
+
+def respaceAround(ranks, before_id, after_id):
+    """ Spreads out ranks to multiples of RANK_STEP and finds a place for an item next to its neighbours.
+        ranks is a list of (id, rank) tuples in order, without the item being placed.  The item goes
+        right after before_id, or right before after_id if before_id isn't in the list.  Returns a dict
+        of id -> rank for the rows whose rank changes, and the item's rank. """
+    ids = [item_id for item_id, old_rank in ranks]
+    spaced = {}
+    changed = {}
+    for idx, (item_id, old_rank) in enumerate(ranks):
+        spaced[item_id] = (idx + 1) * RANK_STEP
+        if old_rank != spaced[item_id]:
+            changed[item_id] = spaced[item_id]
+    if before_id in spaced:
+        idx = ids.index(before_id)
+        rank = rankBetween(spaced[before_id], spaced[ids[idx + 1]] if idx + 1 < len(ids) else None)
+    elif after_id in spaced:
+        idx = ids.index(after_id)
+        rank = rankBetween(spaced[ids[idx - 1]] if idx > 0 else None, spaced[after_id])
+    else:
+        rank = rankBetween(spaced[ids[-1]] if len(ids) > 0 else None, None)
+    return changed, rank
+
+
+def neighbourRank(model, item_id, field_name):
+    "The rank of the item a story or epic was dropped next to, or None if there isn't one."
+    try:
+        return model.objects.filter(id=item_id).values_list(field_name, flat=True)[0]
+    except (IndexError, ValueError, TypeError):
+        return None
+
+
+def placeBetween(siblings, item_id, before_id, after_id, field_name):
+    """ Returns (rank, crowded) for putting item_id between the items before_id and after_id, either of
+        which can be missing.  siblings is a queryset of everything ranked alongside it, like an
+        iteration's stories.  If the neighbours are tied or the wrong way round, the siblings' ranks are
+        spread out now.  crowded means the gap was small and a rebalance should be queued. """
+    model = siblings.model
+    rank_before = neighbourRank(model, before_id, field_name)
+    rank_after = neighbourRank(model, after_id, field_name)
+    if not outOfOrder(rank_before, rank_after):
+        rank = rankBetween(rank_before, rank_after)
+        return rank, needsRebalance(rank_before, rank, rank_after)
+    ranks = list(siblings.exclude(id=item_id).order_by(field_name, "id").values_list("id", field_name))
+    changed, rank = respaceAround(ranks, _intOrNone(before_id), _intOrNone(after_id))
+    writeRanks(model, field_name, changed)
+    return rank, False
+
+
+def _intOrNone(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def queueRebalance(field_name, iteration=None, project=None):
+    if not RankRebalance.objects.filter(field_name=field_name, iteration=iteration, project=project).exists():
+        RankRebalance(field_name=field_name, iteration=iteration, project=project).save()
+
+
+def rebalance(model, ranks, field_name):
+    """ Spreads out ranks to multiples of RANK_STEP.  ranks is a list of (id, rank) tuples for stories
+        or epics, already in order.  Only rows whose rank changes are written, see writeRanks.
+        Returns the number of rows written. """
+    changed = {}
+    for idx, (item_id, old_rank) in enumerate(ranks):
+        rank = (idx + 1) * RANK_STEP
+        if old_rank != rank:
+            changed[item_id] = rank
+    writeRanks(model, field_name, changed)
+    return len(changed)
+
+
+def writeRanks(model, field_name, ranks, chunk_size=500):
+    """ Writes a dict of id -> rank in one UPDATE statement per chunk, instead of a save() per row.
+        No signals go out, so only use this for rows where nothing but the rank changed. """
+    qn = connection.ops.quote_name
+    ids = ranks.keys()
+    cursor = connection.cursor()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+            qn(model._meta.db_table), qn(field_name), qn("id"),
+            " ".join(["WHEN %s THEN %s"] * len(chunk)), qn("id"), ", ".join(["%s"] * len(chunk)))
+        params = []
+        for item_id in chunk:
+            params.extend([item_id, ranks[item_id]])
+        cursor.execute(sql, params + chunk)
+    transaction.commit_unless_managed()
+    if model is Story:
+        # The story snippets show the rank.
+        invalidateStories(ids)
+        if field_name == "rank":
+            # So does the search index.
+            queueStoryIndex(ids)
+
+
+def rebalanceIteration(iteration, field_name="rank"):
+    return rebalance(Story, list(iteration.stories.order_by(field_name, "id").values_list("id", field_name)), field_name)
+
+
+def rebalanceProjectEpics(project):
+    return rebalance(Epic, list(project.epics.order_by("order", "id").values_list("id", "order")), "order")
+
+
+def runQueuedRebalances():
+    "Rebalances everything the reorders have queued up.  Returns the number of rows written."
+    written = 0
+    for item in RankRebalance.objects.all():
+        try:
+            if item.iteration_id is not None:
+                written += rebalanceIteration(item.iteration, item.field_name)
+            elif item.project_id is not None:
+                written += rebalanceProjectEpics(item.project)
+        except:
+            logger.error("Could not rebalance %s" % item)
+            continue
+        item.delete()
+    return written
@@ -1,24 +1,45 @@
 import datetime
 from haystack.indexes import *
 from haystack import site
-from projects.models import Story
+from django.db.models import signals
+from projects.models import Story, StoryTagging
+from projects.search_queue import queueStoryIndex
 import traceback
 import logging
 
 logger = logging.getLogger(__name__)
 
-class StoryIndex(RealTimeSearchIndex):
+def onStoryChanged(sender, instance, **kwargs):
+    queueStoryIndex([instance.id])
+
+
+def onStoryTaggingChanged(sender, instance, **kwargs):
+    queueStoryIndex([instance.story_id])
+
+
+class StoryIndex(SearchIndex):
+    """ Changed stories are queued and sent to the backend in batches by the index_stories command,
+        rather than on every save.  See projects.search_queue """
     text = CharField(document=True, use_template=True)
     project_id = IntegerField( model_attr='project_id' )
     iteration_id = IntegerField( model_attr='iteration_id' )
     local_id = IntegerField( model_attr='local_id' )
     user_id = IntegerField( model_attr='assignee_id' , null=True)
-    numeric_points = IntegerField( model_attr='points_value' )
+    numeric_points = IntegerField( model_attr='numeric_points' )
     created = DateField(model_attr='created')
     status = IntegerField(model_attr='status')
-    rank = IntegerField(model_attr='rank')
+    rank = FloatField(model_attr='rank')
     tags = CharField(model_attr='tags')
     category = CharField(model_attr='category', null=True)
+
+    def _setup_save(self, model):
+        signals.post_save.connect(onStoryChanged, sender=model, dispatch_uid="story_index_queue")
+        signals.post_save.connect(onStoryTaggingChanged, sender=StoryTagging, dispatch_uid="story_index_queue")
+
+    def _setup_delete(self, model):
+        signals.post_delete.connect(onStoryChanged, sender=model, dispatch_uid="story_index_queue")
+        signals.post_delete.connect(onStoryTaggingChanged, sender=StoryTagging, dispatch_uid="story_index_queue")
+
     def prepare(self, object):
         try:
             self.prepared_data = super(StoryIndex, self).prepare(object)
@@ -0,0 +1,174 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Keeps the story search index up to date without talking to the search backend during requests.
+#
+# Saving or deleting a story (or its tags) only queues the story's id in StoryIndexQueue, see
+# StoryIndex in search_indexes.py.  The index_stories command calls flushQueue, which sends a
+# batch of queued stories to the backend in one update, with their tags and assignees loaded
+# for the whole batch.  rebuildIndex re-sends every story using a few worker threads.
+
+from datetime import datetime
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from haystack import site
+
+from projects.models import Story, StoryTagging, StoryIndexQueue
+
+import sys
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX_BATCH_SIZE = getattr(settings, "STORY_INDEX_BATCH_SIZE", 200)
+INDEX_WORKERS = getattr(settings, "STORY_INDEX_WORKERS", 4)
+
+
+def queueStoryIndex(story_ids, chunk_size=400):
+    "Queues stories to be sent to the search index, with one insert per chunk."
+    story_ids = [story_id for story_id in set(story_ids) if story_id is not None]
+    if len(story_ids) == 0:
+        return
+    qn = connection.ops.quote_name
+    now = datetime.now()
+    cursor = connection.cursor()
+    for start in range(0, len(story_ids), chunk_size):
+        chunk = story_ids[start:start + chunk_size]
+        sql = "INSERT INTO %s (%s, %s) VALUES %s" % (
+            qn(StoryIndexQueue._meta.db_table), qn("story_id"), qn("queued"), ", ".join(["(%s, %s)"] * len(chunk)))
+        params = []
+        for story_id in chunk:
+            params.extend([story_id, now])
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+
+def _storyIndex():
+    return site.get_index(Story)
+
+
+def _prefetchTags(stories):
+    "Loads the tag names for a batch of stories with one query, for Story.tags."
+    by_id = dict((story.id, story) for story in stories)
+    for story in stories:
+        story._prefetched_tag_names = []
+    for story_id, name in StoryTagging.objects.filter(story__in=by_id.keys()).order_by("id").values_list("story", "tag__name"):
+        by_id[story_id]._prefetched_tag_names.append(name)
+
+
+def indexStories(stories, index=None):
+    "Sends a batch of stories to the search index in one update."
+    if len(stories) == 0:
+        return
+    index = index or _storyIndex()
+    _prefetchTags(stories)
+    index.backend.update(index, stories)
+
+
+def flushQueue(batch_size=INDEX_BATCH_SIZE):
+    """ Sends the oldest batch of queued stories to the search index, and takes out the ones that
+        have been deleted.  Returns how many stories were handled.  Only run one of these at a time. """
+    rows = list(StoryIndexQueue.objects.order_by("id").values_list("id", "story_id")[:batch_size])
+    if len(rows) == 0:
+        return 0
+    last_id = rows[-1][0]
+    story_ids = set([story_id for row_id, story_id in rows])
+    index = _storyIndex()
+    stories = list(Story.objects.filter(id__in=story_ids).select_related("assignee"))
+    indexStories(stories, index)
+    for story_id in story_ids - set([story.id for story in stories]):
+        index.backend.remove("%s.%d" % (Story._meta, story_id))
+    # A story saved again while this ran was queued after last_id, so it stays queued.
+    StoryIndexQueue.objects.filter(story_id__in=story_ids, id__lte=last_id).delete()
+    return len(story_ids)
+
+
+def processQueue(batch_size=INDEX_BATCH_SIZE, loop=False, sleep=10):
+    "Flushes the queue until it's empty, or forever with loop.  Returns how many stories were handled."
+    handled = 0
+    while True:
+        try:
+            count = flushQueue(batch_size)
+        except:
+            # The queue is left as it is, so these go again next time.
+            logger.error("Could not update the story search index.")
+            traceback.print_exc(file=sys.stdout)
+            count = 0
+            if not loop:
+                return handled
+        handled += count
+        if count == 0:
+            if not loop:
+                return handled
+            time.sleep(sleep)
+
+
+def rebuildIndex(workers=INDEX_WORKERS, batch_size=INDEX_BATCH_SIZE, clear=False):
+    """ Sends every story to the search index.  The stories are streamed from one query, their tags are
+        loaded a batch at a time, and the batches are handed out to worker threads that send them to the
+        backend, so the workers don't need the database.  Anything queued before the rebuild started is
+        covered by it, so it's taken off the queue.  Returns how many stories were indexed. """
+    started = datetime.now()
+    index = _storyIndex()
+    if clear:
+        index.backend.clear(models=[Story])
+    if not getattr(index.backend, "setup_complete", True):
+        # The whoosh backend keeps its RAM storage per thread, so it has to be set up on this one.
+        index.backend.setup()
+
+    batches = Queue.Queue(maxsize=max(1, workers) * 2)
+
+    def work():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                index.backend.update(index, batch)
+            except:
+                logger.error("Could not index stories %d to %d" % (batch[0].id, batch[-1].id))
+                traceback.print_exc(file=sys.stdout)
+
+    threads = [threading.Thread(target=work) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    count = 0
+    batch = []
+    try:
+        for story in Story.objects.select_related("assignee").order_by("id").iterator():
+            batch.append(story)
+            count += 1
+            if len(batch) == batch_size:
+                _prefetchTags(batch)
+                batches.put(batch)
+                batch = []
+        if len(batch) > 0:
+            _prefetchTags(batch)
+            batches.put(batch)
+    finally:
+        for thread in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+    StoryIndexQueue.objects.filter(queued__lt=started).delete()
+    return count
@@ -0,0 +1,418 @@
+# ScrumDo - Agile/Scrum story management web application
+# Copyright (C) 2011 ScrumDo LLC
+#
+# This software is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy (See file COPYING) of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Keeps today's PointsLog rows up to date as stories change, by applying the
+# difference between a story's old and new points instead of recalculating
+# the whole project.  The project's velocity and iterations_left are refreshed
+# along with it.  The nightly burnup_chart run and the reconcile_points
+# command fix any drift.
+#
+# It also keeps the IterationStats / ProjectStats rollup rows current, and bumps
+# the access cache generations when something changes who can see a project.
+
+from datetime import date, timedelta
+import threading
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models import F
+
+from projects.models import Project, ProjectMember, Story, Iteration, PointsLog, IterationStats, ProjectStats, pointsValue, \
+    Task, Epic, StoryTag, StoryTagging
+from threadedcomments.models import ThreadedComment
+from organizations.models import Team
+from projects.calculation import onDemandCalculateVelocity
+import projects.signals as signals
+import projects.access as access
+import projects.fragments as fragments
+
+import sys
+import traceback
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _storyState(story):
+    "The parts of a story that affect the points log."
+    return (pointsValue(story.points), story.status == Story.STATUS_DONE, story.iteration_id, story.epic_id)
+
+
+def onStoryInit(sender, instance, **kwargs):
+    # Remember what the story looked like when it was loaded, so we can work out the deltas later.
+    # The stats rollup tracks its own copy since it's updated on save, before the story signals go out.
+    instance._points_state = instance._stats_state = _storyState(instance)
+models.signals.post_init.connect(onStoryInit, sender=Story)
+
+
+_batched = threading.local()
+
+
+class batchedStatsUpdates(object):
+    """ Use in a with statement around code that changes a lot of stories.  The stats rollup rows
+        that need rebuilding are collected and rebuilt once at the end, instead of after every save. """
+
+    def __enter__(self):
+        _batched.depth = getattr(_batched, "depth", 0) + 1
+        if _batched.depth == 1:
+            _batched.iteration_ids = set()
+            _batched.project_ids = set()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _batched.depth -= 1
+        if _batched.depth == 0:
+            _rebuildStats(_batched.iteration_ids, _batched.project_ids)
+        return False
+
+
+def _rebuildStats(iteration_ids, project_ids):
+    if getattr(_batched, "depth", 0) > 0:
+        _batched.iteration_ids.update(iteration_ids)
+        _batched.project_ids.update(project_ids)
+        return
+    try:
+        iteration_ids = [iteration_id for iteration_id in iteration_ids if iteration_id is not None]
+        if len(iteration_ids) > 0:
+            IterationStats.rebuild(iteration_ids)
+        if len(project_ids) > 0:
+            ProjectStats.rebuild(project_ids)
+    except:
+        logger.error("Could not rebuild stats for iterations %s projects %s" % (iteration_ids, project_ids))
+        traceback.print_exc(file=sys.stdout)
+
+
+def onStorySaved(sender, instance, created, **kwargs):
+    old_state = getattr(instance, "_stats_state", None)
+    new_state = _storyState(instance)
+    if created or old_state != new_state:
+        _rebuildStats(set([new_state[2], old_state and old_state[2]]), [instance.project_id])
+    instance._stats_state = new_state
+models.signals.post_save.connect(onStorySaved, sender=Story)
+
+
+def onStoryRemoved(sender, instance, **kwargs):
+    # This may be part of deleting the whole iteration or project, so just drop the rows
+    # and let getStats() rebuild them the next time they're needed.
+    IterationStats.objects.filter(iteration=instance.iteration_id).delete()
+    ProjectStats.objects.filter(project=instance.project_id).delete()
+models.signals.post_delete.connect(onStoryRemoved, sender=Story)
+
+
+def onIterationSaved(sender, instance, created, **kwargs):
+    # The starting points depend on the start date.
+    _rebuildStats([instance.id], [])
+models.signals.post_save.connect(onIterationSaved, sender=Iteration)
+
+
+def _pointsLogChanged(content_type_id, object_id):
+    "A points log row changed, which can change the max / starting points."
+    if content_type_id == ContentType.objects.get_for_model(Iteration).id:
+        _rebuildStats([object_id], [])
+    elif content_type_id == ContentType.objects.get_for_model(Project).id:
+        _rebuildStats([], [object_id])
+
+
+def onPointsLogSaved(sender, instance, **kwargs):
+    _pointsLogChanged(instance.content_type_id, instance.object_id)
+models.signals.post_save.connect(onPointsLogSaved, sender=PointsLog)
+
+
+def _isLoggedIteration(iteration):
+    "Mirrors the iterations that calculateProject logs points for."
+    if iteration.default_iteration or iteration.start_date is None or iteration.end_date is None:
+        return False
+    today = date.today()
+    return iteration.start_date <= today + timedelta(days=1) and iteration.end_date >= today - timedelta(days=1)
+
+
+def _isVelocityIteration(iteration):
+    "Mirrors the iterations whose done points calculateProjectsPoints uses for the velocity."
+    return not iteration.default_iteration and iteration.include_in_velocity and \
+           iteration.end_date is not None and iteration.end_date <= date.today()
+
+
+def _refreshIterationsLeft(project):
+    "The points left changed but the velocity didn't, so iterations_left can be worked out from today's log."
+    if not project.velocity:
+        return
+    totals = list(project.points_log.filter(date=date.today()).values_list("points_total", flat=True)[:1])
+    if len(totals) == 0:
+        return
+    project.iterations_left = int(totals[0] / project.velocity)
+    Project.objects.filter(id=project.id).update(iterations_left=project.iterations_left)
+
+
+def _applyDelta(related_object, claimed_delta, total_delta):
+    """ Adds the deltas to today's PointsLog row for the object.  If there isn't one yet today, we start
+        one from the most recent row.  If there's never been one, we leave it for the nightly calculation. """
+    if claimed_delta == 0 and total_delta == 0:
+        return
+    content_type = ContentType.objects.get_for_model(related_object)
+    today_logs = PointsLog.objects.filter(content_type=content_type, object_id=related_object.id, date=date.today())
+    updated = today_logs.update(points_claimed=F("points_claimed") + claimed_delta,
+                                points_total=F("points_total") + total_delta)
+    if updated > 0:
+        # update() doesn't send post_save
+        _pointsLogChanged(content_type.id, related_object.id)
+        return
+    try:
+        previous = PointsLog.objects.filter(content_type=content_type, object_id=related_object.id).order_by("-date")[0]
+    except IndexError:
+        return
+    log = PointsLog(points_claimed=previous.points_claimed + claimed_delta,
+                    points_total=previous.points_total + total_delta, related_object=related_object)
+    log.save()
+
+
+def updatePointsLog(story, old_state, new_state):
+    """ Applies the difference between two story states to the project's and iterations' points logs.
+        A state of None means the story didn't exist (created) or no longer exists (deleted). """
+    if old_state == new_state:
+        return
+    project = story.project
+    if not project.active:
+        return
+
+    old_points, old_done, old_iteration_id, old_epic_id = old_state or (0, False, None, None)
+    new_points, new_done, new_iteration_id, new_epic_id = new_state or (0, False, None, None)
+
+    if (old_epic_id or new_epic_id) and (old_points != new_points or old_epic_id != new_epic_id):
+        # The epic's normalized points depend on the points of its stories, so the
+        # delta isn't just this story's points.  Do it the long way.
+        onDemandCalculateVelocity(project)
+        return
+
+    if old_points != int(old_points) or new_points != int(new_points):
+        # The log columns are integers, so a fractional delta can't be applied to them, and adding it
+        # would drift away from the int(total) the full calculation writes.  Recalculate the project.
+        onDemandCalculateVelocity(project)
+        return
+
+    _applyDelta(project, (new_points if new_done else 0) - (old_points if old_done else 0), new_points - old_points)
+
+    deltas = {}
+    if old_iteration_id is not None:
+        deltas[old_iteration_id] = [-(old_points if old_done else 0), -old_points]
+    if new_iteration_id is not None:
+        claimed, total = deltas.get(new_iteration_id, [0, 0])
+        deltas[new_iteration_id] = [claimed + (new_points if new_done else 0), total + new_points]
+    velocity_changed = False
+    for iteration in Iteration.objects.filter(id__in=deltas.keys()):
+        if _isLoggedIteration(iteration):
+            _applyDelta(iteration, deltas[iteration.id][0], deltas[iteration.id][1])
+        if deltas[iteration.id][0] != 0 and _isVelocityIteration(iteration):
+            velocity_changed = True
+
+    if velocity_changed:
+        # Done points changed in a finished iteration, which is rare enough to recalculate for.
+        onDemandCalculateVelocity(project)
+    elif new_points != old_points:
+        _refreshIterationsLeft(project)
+
+
+class batchedPointsLogUpdates(object):
+    """ Use in a with statement around code that sends story signals for a lot of stories at once.
+        Instead of applying each story's points delta, every project touched is recalculated once
+        at the end. """
+
+    def __enter__(self):
+        _batched.points_depth = getattr(_batched, "points_depth", 0) + 1
+        if _batched.points_depth == 1:
+            _batched.points_projects = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _batched.points_depth -= 1
+        if _batched.points_depth == 0:
+            for project in _batched.points_projects.values():
+                try:
+                    onDemandCalculateVelocity(project)
+                except:
+                    logger.error("Could not recalculate project %s" % project.slug)
+                    traceback.print_exc(file=sys.stdout)
+        return False
+
+
+def _storyChanged(story, created=False, deleted=False):
+    if getattr(_batched, "points_depth", 0) > 0:
+        _batched.points_projects[story.project_id] = story.project
+        story._points_state = None if deleted else _storyState(story)
+        return
+    try:
+        old_state = None if created else getattr(story, "_points_state", None)
+        new_state = None if deleted else _storyState(story)
+        if old_state is None and not created:
+            # We don't know what it looked like before, so we can't work out a delta.
+            onDemandCalculateVelocity(story.project)
+        else:
+            updatePointsLog(story, old_state, new_state)
+        story._points_state = new_state
+    except:
+        logger.error("Could not update points log for story %d" % story.id)
+        traceback.print_exc(file=sys.stdout)
+
+
+def onStoryCreated(sender, **kwargs):
+    _storyChanged(kwargs["story"], created=True)
+signals.story_created.connect(onStoryCreated, dispatch_uid="points_log_signal_hookup")
+
+
+def onStoryUpdated(sender, **kwargs):
+    _storyChanged(kwargs["story"])
+signals.story_updated.connect(onStoryUpdated, dispatch_uid="points_log_signal_hookup")
+
+
+def onStoryStatusChanged(sender, **kwargs):
+    _storyChanged(kwargs["story"])
+signals.story_status_changed.connect(onStoryStatusChanged, dispatch_uid="points_log_signal_hookup")
+
+
+def onStoryDeleted(sender, **kwargs):
+    story = kwargs["story"]
+    # This is sent before the story is actually deleted, so a story in an epic can't be
+    # recalculated here.  delete_story recalculates those after the delete.
+    if story.epic_id is None:
+        _storyChanged(story, deleted=True)
+signals.story_deleted.connect(onStoryDeleted, dispatch_uid="points_log_signal_hookup")
+
+
+# Access cache invalidation.  Django doesn't send m2m_changed when a delete cascades to the
+# m2m rows, so deleting a team is handled in pre_delete while the rows are still there.
+
+def onTeamMembersChanged(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # user.teams.add(...) and friends
+        if action in ("post_add", "post_remove", "pre_clear"):
+            access.invalidateUsers([instance.id])
+    elif action in ("post_add", "post_remove"):
+        access.invalidateUsers(pk_set)
+    elif action == "pre_clear":
+        access.invalidateUsers(instance.members.values_list("id", flat=True))
+models.signals.m2m_changed.connect(onTeamMembersChanged, sender=Team.members.through, dispatch_uid="access_cache_hookup")
+
+
+def onTeamProjectsChanged(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # project.teams.add(...) and friends
+        if action in ("post_add", "post_remove", "pre_clear"):
+            access.invalidateProjects([instance.id])
+    elif action in ("post_add", "post_remove"):
+        access.invalidateProjects(pk_set)
+    elif action == "pre_clear":
+        access.invalidateProjects(instance.projects.values_list("id", flat=True))
+models.signals.m2m_changed.connect(onTeamProjectsChanged, sender=Team.projects.through, dispatch_uid="access_cache_hookup")
+
+
+def _teamState(team):
+    return (team.access_type, team.organization_id)
+
+
+def onTeamInit(sender, instance, **kwargs):
+    instance._access_state = _teamState(instance)
+models.signals.post_init.connect(onTeamInit, sender=Team, dispatch_uid="access_cache_hookup")
+
+
+def onTeamSaved(sender, instance, created, **kwargs):
+    # A new team doesn't have any members or projects yet.
+    old_state = getattr(instance, "_access_state", None)
+    if not created and old_state != _teamState(instance):
+        access.invalidateOrganizations([instance.organization_id, old_state and old_state[1]])
+    instance._access_state = _teamState(instance)
+models.signals.post_save.connect(onTeamSaved, sender=Team, dispatch_uid="access_cache_hookup")
+
+
+def onTeamDeleted(sender, instance, **kwargs):
+    access.invalidateOrganizations([instance.organization_id])
+models.signals.pre_delete.connect(onTeamDeleted, sender=Team, dispatch_uid="access_cache_hookup")
+
+
+def onProjectMemberChanged(sender, instance, **kwargs):
+    access.invalidateUsers([instance.user_id])
+models.signals.post_save.connect(onProjectMemberChanged, sender=ProjectMember, dispatch_uid="access_cache_hookup")
+models.signals.post_delete.connect(onProjectMemberChanged, sender=ProjectMember, dispatch_uid="access_cache_hookup")
+
+
+def _projectAccessState(project):
+    return (project.active, project.private, project.organization_id, project.creator_id)
+
+
+def onProjectInit(sender, instance, **kwargs):
+    instance._access_state = _projectAccessState(instance)
+models.signals.post_init.connect(onProjectInit, sender=Project, dispatch_uid="access_cache_hookup")
+
+
+def onProjectSaved(sender, instance, created, **kwargs):
+    if not created and getattr(instance, "_access_state", None) != _projectAccessState(instance):
+        access.invalidateProjects([instance.id])
+    instance._access_state = _projectAccessState(instance)
+models.signals.post_save.connect(onProjectSaved, sender=Project, dispatch_uid="access_cache_hookup")
+
+
+def onProjectDeleted(sender, instance, **kwargs):
+    access.invalidateProjects([instance.id])
+models.signals.post_delete.connect(onProjectDeleted, sender=Project, dispatch_uid="access_cache_hookup")
+
+
+def onUserInit(sender, instance, **kwargs):
+    instance._access_state = instance.is_staff
+models.signals.post_init.connect(onUserInit, sender=User, dispatch_uid="access_cache_hookup")
+
+
+def onUserSaved(sender, instance, created, **kwargs):
+    if not created and getattr(instance, "_access_state", None) != instance.is_staff:
+        access.invalidateUsers([instance.id])
+    instance._access_state = instance.is_staff
+models.signals.post_save.connect(onUserSaved, sender=User, dispatch_uid="access_cache_hookup")
+
+
+# Story snippet cache invalidation, see projects/fragments.py.
+
+def onStorySnippetChanged(sender, instance, **kwargs):
+    fragments.invalidateStories([instance.id])
+models.signals.post_save.connect(onStorySnippetChanged, sender=Story, dispatch_uid="story_fragment_hookup")
+models.signals.post_delete.connect(onStorySnippetChanged, sender=Story, dispatch_uid="story_fragment_hookup")
+
+
+def onStoryPartChanged(sender, instance, **kwargs):
+    "Tasks and taggings are shown in their story's snippet."
+    fragments.invalidateStories([instance.story_id])
+for part in (Task, StoryTagging):
+    models.signals.post_save.connect(onStoryPartChanged, sender=part, dispatch_uid="story_fragment_hookup")
+    models.signals.post_delete.connect(onStoryPartChanged, sender=part, dispatch_uid="story_fragment_hookup")
+
+
+def onStoryCommentChanged(sender, instance, **kwargs):
+    # The block snippet shows the comment count.
+    if instance.content_type_id == ContentType.objects.get_for_model(Story).id:
+        fragments.invalidateStories([instance.object_id])
+models.signals.post_save.connect(onStoryCommentChanged, sender=ThreadedComment, dispatch_uid="story_fragment_hookup")
+models.signals.post_delete.connect(onStoryCommentChanged, sender=ThreadedComment, dispatch_uid="story_fragment_hookup")
+
+
+def onProjectSnippetChanged(sender, instance, **kwargs):
+    fragments.invalidateProjectStories([instance.id])
+models.signals.post_save.connect(onProjectSnippetChanged, sender=Project, dispatch_uid="story_fragment_hookup")
+
+
+def onProjectPartChanged(sender, instance, **kwargs):
+    "Epic names, tag names and iteration names show up in any of the project's snippets."
+    fragments.invalidateProjectStories([instance.project_id])
+for part in (Epic, StoryTag, Iteration):
+    models.signals.post_save.connect(onProjectPartChanged, sender=part, dispatch_uid="story_fragment_hookup")
+    models.signals.post_delete.connect(onProjectPartChanged, sender=part, dispatch_uid="story_fragment_hookup")
@@ -0,0 +1,3 @@
+-- The story list and the stats rollups read an iteration's stories by status.  Existing
+-- databases get this from the numeric_points evolution.
+CREATE INDEX projects_story_iteration_status ON projects_story (iteration_id, status);
@@ -15,6 +15,9 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301  USA
+import base64
+from datetime import datetime
+import json
 import sys
 import urllib
 import re
@@ -28,7 +31,8 @@ from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.core import serializers
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db import transaction
+from django.db.models import Max, Min, Q
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
@@ -42,6 +46,10 @@ from projects.models import Project, ProjectMember, Iteration, Story, STATUS_REV
 from projects.forms import *
 from projects.access import *
 from projects.calculation import onDemandCalculateVelocity
+from projects.signal_handlers import batchedStatsUpdates, batchedPointsLogUpdates
+from projects.ranking import rankBetween, needsRebalance, queueRebalance, writeRanks, RANK_STEP, outOfOrder, \
+    respaceAround, placeBetween
+from projects.fragments import renderStories
 import activities.utils as utils
 import projects.signals as signals
 
@@ -73,7 +81,6 @@ def set_story_status(request, group_slug, story_id, status):
             sender=request, story=story, user=request.user)
         # statuses = [None, "TODO", "In Progress", "Reviewing", "Done"]
         # story.activity_signal.send(sender=story, user=request.user, story=story, action="changed status", status=statuses[status], project=story.project)
-        onDemandCalculateVelocity(story.project)
 
     organization = _organizationOrNone(story.project)
 
@@ -125,7 +132,9 @@ def delete_story(request, group_slug, story_id):
         # story.activity_signal.send(sender=story, user=request.user, story=story, action="deleted", project=story.project)
         story.sync_queue.clear()
         story.delete()
-        onDemandCalculateVelocity(story.project)
+        if story.epic_id is not None:
+            # The points log can't be updated incrementally for stories in an epic.
+            onDemandCalculateVelocity(story.project)
 
         redirTo = request.GET.get("redirectTo", "")
         if redirTo:
@@ -135,19 +144,21 @@ def delete_story(request, group_slug, story_id):
     else:
         return HttpResponse("FAIL")
 
+
+BOARD_STATUSES = {"todo": Story.STATUS_TODO, "doing": Story.STATUS_DOING,
+                  "reviewing": Story.STATUS_REVIEWING, "done": Story.STATUS_DONE}
+
 # Request handler for the scrum board ajax calls
 
 
 @login_required
 def scrum_board(request, group_slug, story_id):
-    status_map = {"todo": Story.STATUS_TODO, "doing": Story.STATUS_DOING,
-                  "reviewing": Story.STATUS_REVIEWING, "done": Story.STATUS_DONE}
     story = get_object_or_404(Story, id=story_id)
     project = get_object_or_404(Project, slug=group_slug)
     if request.method == 'POST':
         if request.POST.get("status", None) is None:
             return HttpResponse("FAILED")
-        target_status = status_map[request.POST.get("status")]
+        target_status = BOARD_STATUSES[request.POST.get("status")]
         reorderStory(story, request.POST.get("before"), request.POST.get(
             "after"), story.iteration, field_name="board_rank")
         if story.status != target_status:
@@ -155,7 +166,6 @@ def scrum_board(request, group_slug, story_id):
             story.save()
             signals.story_status_changed.send(
                 sender=request, story=story, user=request.user)
-            onDemandCalculateVelocity(story.project)
         else:
             story.save()
     return HttpResponse("OK")
@@ -251,13 +261,8 @@ def reorder_story(request, group_slug, story_id):
             iteration = story.iteration
 
         if request.POST.get("action", "") == "reorder":
-            old_story = story.__dict__.copy()
             reorderStory(story, request.POST.get(
                 "before"), request.POST.get("after"), iteration)
-            diffs = utils.model_differences(
-                old_story, story.__dict__, dicts=True)
-            signals.story_updated.send(
-                sender=request, story=story, user=request.user, diffs=diffs)
             # story.activity_signal.send(sender=story, user=request.user, story=story, action="reordered", project=project)
 
         if request.POST.get("epic", "-1") != "-1":
@@ -272,101 +277,151 @@ def reorder_story(request, group_slug, story_id):
         story.iteration = iteration
         story.save()
         diffs = utils.model_differences(old_story, story.__dict__, dicts=True)
+        if len(diffs) > 0:
+            # Sent after the save so listeners see the story's new iteration and epic too.
+            signals.story_updated.send(
+                sender=request, story=story, user=request.user, diffs=diffs)
 
         return HttpResponse("OK")
     return HttpResponse("Fail")
 
 
-def reorderEpic(epic, before_id, after_id, iteration, field_name="order"):
-    "Reorders an epic between two others."
-    epic_rank_before = 0
-    epic_rank_after = 999999  # max value of the DB field
+@login_required
+def move_stories(request, group_slug):
+    """ Applies a list of story moves in one request, so dragging a lot of stories at once doesn't
+        need a request per story.  The moves POST variable is a JSON list of objects like:
 
-    # If there is a epic that should be before this one, grab it's rank
-    try:
-        epic_before = Epic.objects.get(id=before_id)
-        epic_rank_before = epic_before.__dict__[field_name]
-    except:
-        pass
+            {"story": 12, "iteration": 3, "before": 10, "after": 11, "status": "doing", "board": false}
 
-    # If  there is a epic that should be after this one, grab it's rank.
+        Only story is required.  With board set, before/after set the scrum board rank instead of the
+        backlog rank.  Moves are applied in order, so a move can be placed next to a story moved earlier
+        in the list.  Each story gets at most one story_updated / story_status_changed signal, and the
+        project's points are recalculated once at the end. """
+    project = get_object_or_404(Project, slug=group_slug)
+    write_access_or_403(project, request.user)
+    if request.method != 'POST':
+        return HttpResponse("Fail")
     try:
-        epic_after = Epic.objects.get(id=after_id)
-        epic_rank_after = epic_after.__dict__[field_name]
-    except:
-        pass
-
-    diff = abs(epic_rank_after - epic_rank_before)
+        moves = json.loads(request.POST.get("moves", "[]"))
+        story_ids = set([int(move["story"]) for move in moves])
+    except (ValueError, KeyError, TypeError):
+        return HttpResponse("Fail")
+
+    with batchedStatsUpdates():
+        stories = _applyStoryMoves(project, moves, story_ids)
+        with batchedPointsLogUpdates():
+            for story, old_story in stories:
+                diffs = utils.model_differences(old_story, story.__dict__, dicts=True)
+                status_changed = diffs.pop("status", None) is not None
+                # Like the scrum board, board moves only send the status change.
+                diffs.pop("board_rank", None)
+                if len(diffs) > 0:
+                    signals.story_updated.send(sender=request, story=story, user=request.user, diffs=diffs)
+                if status_changed:
+                    signals.story_status_changed.send(sender=request, story=story, user=request.user)
+
+    return HttpResponse(json.dumps({"moved": len(stories),
+                                    "missing": list(story_ids - set([story.id for story, old_story in stories]))}))
+
+
+@transaction.commit_on_success
+def _applyStoryMoves(project, moves, story_ids):
+    """ Does the work for move_stories.  Returns a list of (story, story.__dict__ before the moves)
+        for every story that was found. """
+    stories = dict((story.id, story) for story in Story.objects.filter(project=project, id__in=story_ids))
+    old_stories = dict((story.id, story.__dict__.copy()) for story in stories.values())
+
+    neighbour_ids = set()
+    iteration_ids = set()
+    for move in moves:
+        neighbour_ids.update([_parseId(move.get("before")), _parseId(move.get("after"))])
+        iteration_ids.add(_parseId(move.get("iteration")))
+    ranks = dict((story_id, {"rank": rank, "board_rank": board_rank}) for story_id, rank, board_rank in
+                 Story.objects.filter(project=project, id__in=neighbour_ids - set([None])).values_list("id", "rank", "board_rank"))
+    iterations = Iteration.objects.in_bulk(list(iteration_ids - set([None])))
+
+    for move in moves:
+        story = stories.get(int(move["story"]))
+        if story is None:
+            continue
+        iteration = iterations.get(_parseId(move.get("iteration")))
+        if iteration is not None and iteration.project_id == project.id:
+            story.iteration = iteration
+        field_name = "board_rank" if move.get("board") else "rank"
+        if move.get("before") or move.get("after"):
+            rank_before = ranks.get(_parseId(move.get("before")), {}).get(field_name)
+            rank_after = ranks.get(_parseId(move.get("after")), {}).get(field_name)
+            if outOfOrder(rank_before, rank_after):
+                story.__dict__[field_name] = _respaceIteration(story, field_name, stories, ranks,
+                                                               _parseId(move.get("before")), _parseId(move.get("after")))
+            else:
+                rank = rankBetween(rank_before, rank_after)
+                story.__dict__[field_name] = rank
+                if needsRebalance(rank_before, rank, rank_after):
+                    queueRebalance(field_name, iteration=story.iteration)
+        ranks[story.id] = {"rank": story.rank, "board_rank": story.board_rank}
+        if move.get("status") in BOARD_STATUSES:
+            story.status = BOARD_STATUSES[move["status"]]
+
+    # Stories where only the ranks changed are written with one statement per rank field, everything
+    # else goes through save() so the model signals still fire.
+    rank_only = {"rank": {}, "board_rank": {}}
+    for story in stories.values():
+        diffs = utils.model_differences(old_stories[story.id], story.__dict__, dicts=True)
+        if len(diffs) == 0:
+            continue
+        if set(diffs.keys()) <= set(["rank", "board_rank"]):
+            for field_name in diffs:
+                rank_only[field_name][story.id] = story.__dict__[field_name]
+        else:
+            story.save()
+    for field_name, field_ranks in rank_only.items():
+        writeRanks(Story, field_name, field_ranks)
+
+    return [(story, old_stories[story.id]) for story in stories.values()]
+
+
+def _respaceIteration(story, field_name, stories, ranks, before_id, after_id):
+    """ For _applyStoryMoves, when a story's new neighbours are tied or the wrong way round: spreads out
+        the ranks in the story's iteration, counting the moves made so far, and returns the story's rank.
+        Stories in the batch get their new ranks in memory, the rest are written now. """
+    iteration_id = story.iteration_id
+    ordered = list(Story.objects.filter(iteration=iteration_id).exclude(id__in=stories.keys()).values_list("id", field_name))
+    ordered += [(other.id, other.__dict__[field_name]) for other in stories.values()
+                if other.iteration_id == iteration_id and other.id != story.id]
+    ordered.sort(key=lambda item: (item[1], item[0]))
+    changed, rank = respaceAround(ordered, before_id, after_id)
+    writeRanks(Story, field_name, dict((item_id, item_rank) for item_id, item_rank in changed.items() if item_id not in stories))
+    for item_id, item_rank in changed.items():
+        if item_id in stories:
+            stories[item_id].__dict__[field_name] = item_rank
+        ranks.setdefault(item_id, {})[field_name] = item_rank
+    return rank
+
+
+def _parseId(value):
     try:
-        if diff > 1:
-            # It fits between them
-            epic.__dict__[field_name] = round(diff / 2) + epic_rank_before
-            logger.debug("Reordering epic fit %d %d %d" %
-                         (epic_rank_before, epic.__dict__[field_name], epic_rank_after))
-            return
-    except:
-        # do an emergency re-order below if things are falling out of bounds.
-        pass
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-    # It doesn't fit!  reorder everything!
-    epics = iteration.epics.all().order_by(field_name)
 
-    rank = 10
-    for other_epic in epics:
-        if other_epic.__dict__[field_name] == epic_rank_after:
-            # We should always have a epic_rank_after if we get here.
-            epic.__dict__[field_name] = rank
-            rank += 20
-        other_epic.__dict__[field_name] = rank
-        other_epic.save()
-        rank += 20
+def reorderEpic(epic, before_id, after_id, iteration, field_name="order"):
+    "Reorders an epic between two others.  Usually only the epic's own order changes, see projects.ranking"
+    rank, crowded = placeBetween(epic.project.epics.all(), epic.id, before_id, after_id, field_name)
+    epic.__dict__[field_name] = rank
+    logger.debug("Reordering epic %s to %s" % (epic.id, rank))
+    if crowded:
+        queueRebalance(field_name, project=epic.project)
 
 
 def reorderStory(story, before_id, after_id, iteration, field_name="rank"):
-    "Reorders a story between two others."
-    story_rank_before = 0
-    story_rank_after = 999999  # max value of the DB field
-
-    # If there is a story that should be before this one, grab it's rank
-    try:
-        story_before = Story.objects.get(id=before_id)
-        story_rank_before = story_before.__dict__[field_name]
-    except:
-        pass
-
-    # If  there is a story that should be after this one, grab it's rank.
-    try:
-        story_after = Story.objects.get(id=after_id)
-        story_rank_after = story_after.__dict__[field_name]
-    except:
-        pass
-
-    diff = abs(story_rank_after - story_rank_before)
-    # logger.debug("Before %d , after %d, diff %d" % (story_rank_after, story_rank_before, diff) )
-    try:
-        if diff > 1:
-            # It fits between them
-            # logger.debug(round(diff/2) )
-            story.__dict__[field_name] = round(diff / 2) + story_rank_before
-            logger.debug("Reordering fit %d %d %d" %
-                         (story_rank_before, story.__dict__[field_name], story_rank_after))
-            return
-    except:
-        # do an emergency re-order below if things are falling out of bounds.
-        pass
-
-    # It doesn't fit!  reorder everything!
-    stories = iteration.stories.all().order_by(field_name)
-
-    rank = 10
-    for other_story in stories:
-        if other_story.__dict__[field_name] == story_rank_after:
-            # We should always have a story_rank_after if we get here.
-            story.__dict__[field_name] = rank
-            rank += 20
-        other_story.__dict__[field_name] = rank
-        other_story.save()
-        rank += 20
+    "Reorders a story between two others.  Usually only the story's own rank changes, see projects.ranking"
+    rank, crowded = placeBetween(iteration.stories.all(), story.id, before_id, after_id, field_name)
+    story.__dict__[field_name] = rank
+    logger.debug("Reordering %s to %s" % (story.id, rank))
+    if crowded:
+        queueRebalance(field_name, iteration=iteration)
 
 
 # On the iteration planning page, this renders one story view.  Generally called
@@ -383,28 +438,22 @@ def mini_story(request, group_slug, story_id):
 def _calculate_rank(iteration, general_rank):
     """ calculates the rank a new story should have for a project based off of 3 general rankings.
     0=top, 1=middle, 2=bottom
-    TODO (Improvement) - I'd like to re-think how ranking is done for both initial and adjustments of ranks.
     """
     try:
-        stories = iteration.stories.all().order_by("rank")
-        story_count = len(stories)
-        print "%d %s" % (story_count, [story.rank for story in stories])
-        if story_count == 0:
-            return 10
-
-        if(general_rank == 0):  # top
-            return int(stories[0].rank / 2)
+        stories = iteration.stories.all()
+        if general_rank == 0:  # top
+            return rankBetween(None, stories.aggregate(Min("rank"))["rank__min"])
 
-        if(general_rank == 1):  # middle
+        if general_rank == 1:  # middle
+            story_count = stories.count()
             if story_count < 2:
-                return 10
-            s1_rank = stories[int(story_count / 2) - 1].rank
-            s2_rank = stories[int(story_count / 2)].rank
-            return int((s1_rank + s2_rank) / 2)
+                return rankBetween(None, stories.aggregate(Min("rank"))["rank__min"])
+            ranks = list(stories.order_by("rank").values_list("rank", flat=True)[int(story_count / 2) - 1:int(story_count / 2) + 1])
+            return rankBetween(ranks[0], ranks[1])
 
-        return stories[story_count - 1].rank + 10
+        return rankBetween(stories.aggregate(Max("rank"))["rank__max"], None)
     except:
-        return 10
+        return RANK_STEP
 
 
 @login_required
@@ -467,7 +516,6 @@ def story_edit(request, group_slug, story_id):
 
             signals.story_updated.send(
                 sender=request, story=story, diffs=diffs, user=request.user)
-            onDemandCalculateVelocity(project)
 
         organization = _organizationOrNone(project)
         if(request.POST['return_type'] == 'mini'):
@@ -519,9 +567,11 @@ def stories_scrum_board(request, group_slug, iteration_id, status):
 
     stories = iteration.stories.select_related('project', 'project__organization', 'project__organization__subscription',  'iteration', 'iteration__project',).filter(
         status=STATUS_REVERSE[status]).order_by("board_rank")
+    story_html = renderStories(request, stories, "stories/single_scrum_board_story.html", {"project": project},
+                               iteration, tasks=True)
 
     return render_to_response("stories/scrum_board_story_list.html", {
-                              "stories": stories,
+                              "story_html": story_html,
                               "project": project
                               }, context_instance=RequestContext(request))
 
@@ -551,7 +601,8 @@ def stories_iteration(request, group_slug, iteration_id, page=1):
     iteration = get_object_or_404(Iteration, id=iteration_id, project=project)
 
     order_by = request.GET.get("order_by", "rank")
-    display_type = request.GET.get("display_type", "mini")
+    # Only the two display types we render, it ends up in the fragment cache keys.
+    display_type = "block" if request.GET.get("display_type") == "block" else "mini"
     text_search = request.GET.get("search", "").strip()
     tags_search = request.GET.get("tags", "").strip()
     category = request.GET.get("category", "").strip()
@@ -568,34 +619,45 @@ def stories_iteration(request, group_slug, iteration_id, page=1):
     if only_assigned == "False":
         only_assigned = False
 
+    next_cursor = None
+    if text_search == "":
+        # Don't need to consult our solr search engine.
+        next_cursor, stories = _getStoriesNoTextSearch(
+            iteration, order_by, tags_search, category, only_assigned, request.user, paged, page, backlog_mode,
+            request.GET.get("cursor"))
+    else:
+        # we need some fancy-schmancy searching
+        stories = _getStoriesWithTextSearch(
+            iteration, text_search, order_by, tags_search, category, only_assigned, request.user, backlog_mode)
+    organization = _organizationOrNone(project)
+
+    if display_type == "block":
+        template_name = "stories/single_block_story.html"
+    else:
+        template_name = "stories/single_mini_story.html"
+    # The block display includes each story's tasks.
+    story_html = renderStories(request, stories, template_name, {"project": project, "return_type": display_type,
+                               "display_type": display_type, "organization": organization},
+                               iteration, tasks=(display_type == "block"))
+
     # Store the query string, so it can be passed back for subsequent page
-    # requests.
+    # requests.  The cursor marks where the next page starts.
     query_string = urllib.urlencode({'order_by': order_by,
                                      'display_type': display_type,
                                      'search': text_search.encode('utf-8'),
                                      'tags': tags_search.encode('utf-8'),
                                      'category': category.encode('utf-8'),
                                      'only_assigned': only_assigned,
-                                     'clearButton': clrbtn
+                                     'clearButton': clrbtn,
+                                     'cursor': next_cursor or "",
                                          })
-    has_next = False
-    if text_search == "":
-        # Don't need to consult our solr search engine.
-        has_next, stories = _getStoriesNoTextSearch(
-            iteration, order_by, tags_search, category, only_assigned, request.user, paged, page, backlog_mode)
-    else:
-        # we need some fancy-schmancy searching
-        stories = _getStoriesWithTextSearch(
-            iteration, text_search, order_by, tags_search, category, only_assigned, request.user, backlog_mode)
-
-    organization = _organizationOrNone(project)
 
     return render_to_response("stories/mini_story_list.html", {
-                              "stories": stories,
+                              "story_html": story_html,
                               "project": project,
                               "return_type": display_type,
                               "display_type": display_type,
-                              "load_next_page": has_next,
+                              "load_next_page": next_cursor is not None,
                               "next_page_num": page + 1,
                               "next_page_query_string": query_string,
                               "iteration_id": iteration.id,
@@ -624,23 +686,48 @@ def _getStoriesWithTextSearch(iteration, text_search, order_by, tags_search, cat
     return stories
 
 
-def _getStoriesNoTextSearch(iteration, order_by, tags_search, category, only_assigned, user, paged, page, backlog_mode):
+STORIES_PER_PAGE = 50
+
+# The orderings the story list offers.  Anything else falls back to rank.
+STORY_ORDERINGS = ("rank", "local_id", "numeric_points", "created", "status")
+
+
+def _encodeCursor(order_by, story):
+    "An opaque marker for the position after a story, for the next page to start from."
+    value = getattr(story, order_by)
+    if order_by == "created":
+        value = value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    elif order_by == "numeric_points":
+        value = float(value)
+    return base64.urlsafe_b64encode(json.dumps([order_by, value, story.id]))
+
+
+def _decodeCursor(order_by, cursor):
+    "Returns the (value, id) a cursor points after, or None if it's not a cursor for this ordering."
+    try:
+        field, value, story_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if field != order_by:
+            return None
+        if order_by == "created":
+            value = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+        return value, int(story_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _getStoriesNoTextSearch(iteration, order_by, tags_search, category, only_assigned, user, paged, page, backlog_mode, cursor=None):
+    """ Returns (cursor for the next page or None, stories).  Pages are found by where the last one ended
+        in (order_by, id) order rather than by offset, so there's no count query, a page deep in a big
+        backlog costs the same as the first, and reordering while someone scrolls doesn't skip or
+        repeat stories. """
     tags_list = re.split('[, ]+', tags_search)
+    if order_by not in STORY_ORDERINGS:
+        order_by = "rank"
 
     stories = iteration.stories
 
-    if order_by != "numeric_points":
-        stories = stories.order_by(order_by)
-    else:
-        # Tried a few things here... CAST(points as SIGNED) in the order_by clause would have been preferred, but I couldn't get that through
-        # the ORM.  Secondary, I tried craeting a custom column assigned to that, but it caused the query to fail.  The 0+string is a bit
-        # of a mysql specific hack to convert a string to a number.
-        stories = stories.extra(
-            select={'numeric_points': '0+points'}).order_by(order_by)
-
     if tags_search:
-        stories = stories.filter(
-            story_tags__tag__name__in=tags_list).distinct().order_by(order_by)
+        stories = stories.filter(story_tags__tag__name__in=tags_list).distinct()
     if only_assigned:
         stories = stories.filter(assignee=user)
     if category:
@@ -649,17 +736,26 @@ def _getStoriesNoTextSearch(iteration, order_by, tags_search, category, only_ass
         stories = stories.filter(epic=None)
 
     stories = stories.select_related(
-        'project', 'project__organization', 'project__organization__subscription', 'iteration',)
+        'project', 'project__organization', 'project__organization__subscription', 'iteration',).order_by(order_by, "id")
+
+    if not paged:
+        return (None, stories)
 
-    if paged:
-        paginator = Paginator(stories, 50)
-        page_obj = paginator.page(page)
-        has_next = page_obj.has_next()
-        stories = page_obj.object_list
+    position = _decodeCursor(order_by, cursor) if cursor else None
+    if position is not None:
+        value, last_id = position
+        stories = stories.filter(Q(**{"%s__gt" % order_by: value}) | Q(**{order_by: value, "id__gt": last_id}))
+        stories = list(stories[:STORIES_PER_PAGE + 1])
     else:
-        has_next = False
+        # Page 1, or a client from before the cursors.
+        start = (max(page, 1) - 1) * STORIES_PER_PAGE
+        stories = list(stories[start:start + STORIES_PER_PAGE + 1])
 
-    return (has_next, stories)
+    # One extra row says whether there's a next page.
+    if len(stories) > STORIES_PER_PAGE:
+        stories = stories[:STORIES_PER_PAGE]
+        return (_encodeCursor(order_by, stories[-1]), stories)
+    return (None, stories)
 
 
 @login_required
@@ -719,8 +815,6 @@ def _handleAddStoryInternal(form, project, request):
     story.rank = _calculate_rank(story.iteration, general_rank)
     # logger.info("New Story %s" % story.summary)
     story.save()
-    if story.points_value() > 0:
-        onDemandCalculateVelocity(project)
     signals.story_created.send(sender=request, story=story, user=request.user)
     # story.activity_signal.send(sender=story, user=request.user, story=story, action="created", project=project)
     messages.info(request, "Story #%d created." % story.local_id)
@@ -23,8 +23,12 @@ register = template.Library()
 
 @register.simple_tag
 def task_counts( story):
-    total_tasks = story.tasks.count()
-    complete_tasks = story.tasks.filter(complete=True).count()
+    if hasattr(story, "_prefetched_task_counts"):
+        # Set by prefetchStoryList.
+        total_tasks, complete_tasks = story._prefetched_task_counts
+    else:
+        total_tasks = story.tasks.count()
+        complete_tasks = story.tasks.filter(complete=True).count()
     if complete_tasks > 0:
         return "%d/%d" % (complete_tasks, total_tasks)
     elif total_tasks > 0:
@@ -1,6 +1,10 @@
 from django.test import TestCase
 
 from projects.models import Project
+from projects.tests.access_tests import AccessCacheTest
+from projects.tests.story_list_tests import StoryListQueryTest
+from projects.tests.search_tests import StoryIndexQueueTest
+from projects.tests.ranking_tests import RankTiesTest
 
 class ProjectsTest(TestCase):
     fixtures = ["projects_auth.json"]
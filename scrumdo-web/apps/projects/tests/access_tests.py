@@ -0,0 +1,202 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from projects.models import Project, ProjectMember
+from projects.access import access_level, has_read_access, has_write_access, has_admin_access, has_staff_access, \
+    ACCESS_NONE, ACCESS_READ, ACCESS_WRITE, ACCESS_ADMIN
+from organizations.models import Organization, Team, TeamInvite
+
+
+class AccessCacheTest(TestCase):
+    """ Access levels are cached for hours, so every view that changes who can see a project has to
+        invalidate them.  Each test primes the cache, makes the change through the view, and checks
+        that the very next lookup sees it. """
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner", "owner@example.com", "owner")
+        self.alice = User.objects.create_user("alice", "alice@example.com", "alice")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "bob")
+
+        self.organization = Organization(name="Access Org", slug="access-org", creator=self.owner)
+        self.organization.save()
+        self.other_organization = Organization(name="Other Org", slug="other-org", creator=self.owner)
+        self.other_organization.save()
+
+        self.project = self._createProject("access-project", self.organization)
+        self.other_project = self._createProject("other-project", self.organization)
+
+        self.staff = self._createTeam(self.organization, "Staff", "staff", [self.owner], [self.project, self.other_project])
+        self.developers = self._createTeam(self.organization, "Developers", "write", [self.alice], [self.project])
+        self.other_staff = self._createTeam(self.other_organization, "Staff", "staff", [self.owner], [])
+        self.other_owners = self._createTeam(self.other_organization, "Owners", "admin", [self.bob], [])
+
+        self.client.login(username="owner", password="owner")
+
+    def _createProject(self, slug, organization):
+        project = Project(name=slug, slug=slug, creator=self.owner, organization=organization, description="")
+        project.save()
+        return project
+
+    def _createTeam(self, organization, name, access_type, members, projects):
+        team = Team(organization=organization, name=name, access_type=access_type)
+        team.save()
+        for member in members:
+            team.members.add(member)
+        for project in projects:
+            team.projects.add(project)
+        return team
+
+    def _fresh(self, project, user):
+        "Fresh copies, like the next request would load, so nothing remembered on the objects is used."
+        return (Project.objects.get(id=project.id), User.objects.get(id=user.id))
+
+    def level(self, project, user):
+        return access_level(*self._fresh(project, user))
+
+    def teamUrl(self, team, action=""):
+        return "/organization/%s/team/%d%s" % (team.organization.slug, team.id, action)
+
+    # organizations/team_views.py
+
+    def test_team_add_project(self):
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_NONE)
+        self.client.post(self.teamUrl(self.developers, "/add_project"), {"project": self.other_project.id})
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_WRITE)
+
+    def test_team_remove_project(self):
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post(self.teamUrl(self.developers, "/remove_project/%d" % self.project.id))
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_NONE)
+
+    def test_team_invite_existing_user(self):
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+        self.client.post(self.teamUrl(self.developers, "/invite"), {"invitee": "bob"})
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_WRITE)
+
+    def test_team_invite_accept(self):
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+        TeamInvite(email_address="bob@example.com", team=self.developers, key="abcd1234").save()
+        self.client.login(username="bob", password="bob")
+        self.client.get("/organization/accept/abcd1234")
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_WRITE)
+
+    def test_team_remove_member(self):
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post(self.teamUrl(self.developers, "/remove/%d" % self.alice.id))
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_NONE)
+
+    def test_team_delete(self):
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post(self.teamUrl(self.developers, "/delete"))
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_NONE)
+
+    def test_team_create(self):
+        # A new team has nobody in it, so nothing should change.
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post("/organization/access-org/team/create", {"name": "Readers", "access_type": "read"})
+        self.assertEqual(Team.objects.filter(organization=self.organization, name="Readers").count(), 1)
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+
+    def test_team_access_type_change(self):
+        # There's no view for this yet, but the admin can do it.
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        team = Team.objects.get(id=self.developers.id)
+        team.access_type = "read"
+        team.save()
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_READ)
+
+    def test_staff_team_membership(self):
+        self.assertFalse(has_staff_access(self.organization, User.objects.get(id=self.alice.id)))
+        self.client.post(self.teamUrl(self.staff, "/invite"), {"invitee": "alice"})
+        self.assertTrue(has_staff_access(self.organization, User.objects.get(id=self.alice.id)))
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_ADMIN)
+
+    # The organization page's team forms, which replaced some of the team_views
+
+    def test_organization_add_and_remove_member(self):
+        url = "/organization/access-org/projects"
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+        self.client.post(url, {"action": "addMember", "team_id": self.developers.id, "recipient": "bob"})
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_WRITE)
+        self.client.post(url, {"action": "removeUser", "team_id": self.developers.id, "user_id": self.bob.id})
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+
+    def test_organization_add_and_remove_project(self):
+        url = "/organization/access-org/projects"
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_NONE)
+        self.client.post(url, {"action": "addProject", "team_id": self.developers.id, "project": self.other_project.id})
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_WRITE)
+        self.client.post(url, {"action": "removeProject", "team_id": self.developers.id, "project_id": self.other_project.id})
+        self.assertEqual(self.level(self.other_project, self.alice), ACCESS_NONE)
+
+    # projects/views.py
+
+    def test_create_in_organization(self):
+        self.client.login(username="alice", password="alice")
+        self.client.post("/projects/create/", {"slug": "alices", "name": "Alice's Project", "description": "A test project.",
+                                               "organization": self.organization.id})
+        project = Project.objects.get(slug="alices")
+        self.assertEqual(self.level(project, self.alice), ACCESS_ADMIN)
+        self.assertEqual(self.level(project, self.owner), ACCESS_ADMIN)
+        self.assertEqual(self.level(project, self.bob), ACCESS_NONE)
+
+    def test_project_admin_add_user(self):
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+        self.client.post("/projects/project/access-project/admin", {"action": "add", "recipient": "bob"})
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_WRITE)
+
+    def test_remove_user(self):
+        ProjectMember(project=self.project, user=self.bob).save()
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_WRITE)
+        self.client.post("/projects/project/access-project/remove_user", {"user_id": self.bob.id})
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+
+    def test_move_to_organization(self):
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_NONE)
+        self.client.post("/projects/project/access-project/admin",
+                         {"action": "moveToOrganization", "organization_id": self.other_organization.id})
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_NONE)
+        self.assertEqual(self.level(self.project, self.bob), ACCESS_ADMIN)
+
+    def test_archive_and_activate(self):
+        self.assertTrue(has_write_access(*self._fresh(self.project, self.alice)))
+        self.client.post("/projects/project/access-project/admin", {"action": "archiveProject"})
+        self.assertFalse(has_write_access(*self._fresh(self.project, self.alice)))
+        self.assertFalse(has_admin_access(*self._fresh(self.project, self.owner)))
+        self.client.get("/projects/project/access-project/activate/")
+        self.assertTrue(has_write_access(*self._fresh(self.project, self.alice)))
+
+    def test_project_options_and_update(self):
+        # Neither form changes access, the cached levels should still be right afterwards.
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post("/projects/project/access-project/admin", {"action": "updateProject", "name": "Renamed",
+                         "description": "A test project.", "velocity_type": 1, "point_scale_type": 0})
+        self.client.post("/projects/project/access-project/", {"action": "update", "name": "Renamed Again",
+                         "description": "A test project."})
+        self.assertEqual(Project.objects.get(id=self.project.id).name, "Renamed Again")
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+
+    def test_private_flag(self):
+        self.assertFalse(has_read_access(*self._fresh(self.project, self.bob)))
+        project = Project.objects.get(id=self.project.id)
+        project.private = False
+        project.save()
+        self.assertTrue(has_read_access(*self._fresh(self.project, self.bob)))
+
+    def test_delete(self):
+        self.assertEqual(self.level(self.project, self.alice), ACCESS_WRITE)
+        self.client.post("/projects/project/access-project/delete/")
+        self.assertEqual(Project.objects.filter(slug="access-project").count(), 0)
+        # A new project with the same slug mustn't pick up the old project's levels.
+        project = self._createProject("access-project", self.organization)
+        self.assertEqual(self.level(project, self.alice), ACCESS_NONE)
+
+    def test_change_within_request(self):
+        # Levels remembered on the user object are dropped when something changes.
+        project, alice = self._fresh(self.project, self.alice)
+        self.assertEqual(access_level(project, alice), ACCESS_WRITE)
+        self.developers.members.remove(self.alice)
+        self.assertEqual(access_level(project, alice), ACCESS_NONE)
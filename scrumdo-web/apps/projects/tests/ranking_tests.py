@@ -0,0 +1,46 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from projects.models import Project, Iteration, Story
+from projects.ranking import placeBetween, respaceAround
+
+
+class RankTiesTest(TestCase):
+    "Reordering between neighbours that are tied or the wrong way round, which older rank data has plenty of."
+
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", "owner@example.com", "owner")
+        self.project = Project(name="Ranks", slug="ranks", creator=self.owner, description="")
+        self.project.save()
+        self.iteration = Iteration(name="Iteration 1", project=self.project)
+        self.iteration.save()
+        self.stories = []
+        for i in range(4):
+            story = Story(project=self.project, iteration=self.iteration, creator=self.owner, local_id=i + 1,
+                          rank=i, summary="Story %d" % i)
+            story.save()
+            self.stories.append(story)
+
+    def rank(self, story):
+        return Story.objects.get(id=story.id).rank
+
+    def test_tied_neighbours(self):
+        first, second, third, moving = self.stories
+        Story.objects.filter(id__in=[first.id, second.id, third.id]).update(rank=0)
+        rank, crowded = placeBetween(self.iteration.stories.all(), moving.id, first.id, second.id, "rank")
+        self.assertTrue(self.rank(first) < rank < self.rank(second))
+        self.assertTrue(rank < self.rank(third))
+
+    def test_inverted_neighbours(self):
+        first, second, third, moving = self.stories
+        # The page was out of date, so the story goes right after the "before" one.
+        rank, crowded = placeBetween(self.iteration.stories.all(), moving.id, second.id, first.id, "rank")
+        self.assertTrue(self.rank(second) < rank < self.rank(third))
+
+    def test_respace(self):
+        changed, rank = respaceAround([(1, 0), (2, 0), (3, 5)], 1, 2)
+        self.assertEqual(changed, {1: 10, 2: 20, 3: 30})
+        self.assertEqual(rank, 15)
+        changed, rank = respaceAround([(1, 10), (2, 20)], None, 1)
+        self.assertEqual(changed, {})
+        self.assertEqual(rank, 0)
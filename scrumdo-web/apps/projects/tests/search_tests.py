@@ -0,0 +1,70 @@
+import threading
+
+from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from haystack import site
+import whoosh_backend
+
+from projects.models import Project, Iteration, Story, StoryTag, StoryTagging, StoryIndexQueue
+from projects.search_queue import flushQueue, rebuildIndex
+
+
+class StoryIndexQueueTest(TestCase):
+    "Story changes are queued and sent to the search index in batches.  Uses the whoosh backend in memory."
+
+    def setUp(self):
+        self.old_storage = getattr(settings, "HAYSTACK_WHOOSH_STORAGE", None)
+        settings.HAYSTACK_WHOOSH_STORAGE = "ram"
+        whoosh_backend.LOCALS.RAM_STORE = None
+        self.index = site.get_index(Story)
+        self.old_backend = self.index.backend
+        self.backend = self.index.backend = whoosh_backend.SearchBackend(site=site)
+
+        self.owner = User.objects.create_user("owner", "owner@example.com", "owner")
+        self.project = Project(name="Search", slug="search", creator=self.owner, description="")
+        self.project.save()
+        self.iteration = Iteration(name="Iteration 1", project=self.project)
+        self.iteration.save()
+        self.tag = StoryTag(project=self.project, name="frontend")
+        self.tag.save()
+
+    def tearDown(self):
+        self.index.backend = self.old_backend
+        if self.old_storage is None:
+            del settings.HAYSTACK_WHOOSH_STORAGE
+        else:
+            settings.HAYSTACK_WHOOSH_STORAGE = self.old_storage
+
+    def addStory(self, local_id, summary):
+        story = Story(project=self.project, iteration=self.iteration, creator=self.owner, local_id=local_id,
+                      rank=local_id, summary=summary)
+        story.save()
+        return story
+
+    def hits(self, query):
+        return self.backend.search(query)["hits"]
+
+    def test_queued_changes(self):
+        story = self.addStory(1, "Zebra crossing")
+        StoryTagging(story=story, tag=self.tag).save()
+        self.assertEqual(self.hits(u"zebra"), 0)
+        self.assertEqual(flushQueue(), 1)
+        self.assertEqual(StoryIndexQueue.objects.count(), 0)
+        self.assertEqual(self.hits(u"zebra"), 1)
+        self.assertEqual(self.hits(u"frontend"), 1)
+        story.delete()
+        self.assertEqual(flushQueue(), 1)
+        self.assertEqual(self.hits(u"zebra"), 0)
+
+    def test_rebuild(self):
+        for i in range(30):
+            self.addStory(i + 1, "Giraffe %d" % i)
+        self.assertEqual(rebuildIndex(workers=3, batch_size=7), 30)
+        # Whoosh has one writer at a time, the others hand their documents to a thread that waits for the lock.
+        for thread in threading.enumerate():
+            if isinstance(thread, whoosh_backend.AsyncWriter):
+                thread.join()
+        self.assertEqual(StoryIndexQueue.objects.count(), 0)
+        self.assertEqual(self.hits(u"giraffe"), 30)
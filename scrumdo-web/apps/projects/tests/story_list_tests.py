@@ -0,0 +1,109 @@
+import re
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+
+from projects.models import Project, Iteration, Story, StoryTag, StoryTagging, Task
+from projects.fragments import fragmentStats
+from projects.management.commands.backfill_points import backfillPoints
+
+
+class StoryListQueryTest(TestCase):
+    """ The story list pages load everything for a page of stories with prefetchStoryList, so the
+        number of queries mustn't grow with the number of stories.  The rendered stories are cached
+        until something in them changes. """
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner", "owner@example.com", "owner")
+        self.alice = User.objects.create_user("alice", "alice@example.com", "alice")
+        self.project = Project(name="Story List", slug="story-list", creator=self.owner, description="",
+                               use_assignee=True, use_tasks=True)
+        self.project.save()
+        self.iteration = Iteration(name="Iteration 1", project=self.project)
+        self.iteration.save()
+        self.tag = StoryTag(project=self.project, name="frontend")
+        self.tag.save()
+        self.story_count = 0
+        self.client.login(username="owner", password="owner")
+
+    def addStories(self, count):
+        for i in range(count):
+            self.story_count += 1
+            story = Story(project=self.project, iteration=self.iteration, creator=self.owner, local_id=self.story_count,
+                          rank=self.story_count, summary="Story %d" % self.story_count, assignee=self.alice)
+            story.save()
+            StoryTagging(story=story, tag=self.tag).save()
+            Task(story=story, summary="Task", assignee=self.alice).save()
+            Task(story=story, summary="Done task", complete=True).save()
+
+    def countQueries(self, url):
+        # Nothing cached, so every story is rendered.
+        cache.clear()
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = False
+
+    def assertFixedQueries(self, url):
+        self.addStories(3)
+        few = self.countQueries(url)
+        self.addStories(6)
+        self.assertEqual(self.countQueries(url), few)
+
+    def test_iteration_mini(self):
+        self.assertFixedQueries("/projects/project/story-list/stories/%d/1" % self.iteration.id)
+
+    def test_scrum_board(self):
+        self.assertFixedQueries("/projects/project/story-list/stories/%d/board/TODO" % self.iteration.id)
+
+    def test_fragment_cache(self):
+        url = "/projects/project/story-list/stories/%d/1" % self.iteration.id
+        self.addStories(3)
+        self.client.get(url)
+        self.assertEqual(fragmentStats(), (0, 3))
+        story = Story.objects.get(project=self.project, local_id=2)
+        story.summary = "Renamed story"
+        story.save()
+        response = self.client.get(url)
+        self.assertContains(response, "Renamed story")
+        self.assertEqual(fragmentStats(), (2, 4))
+        Task(story=Story.objects.get(project=self.project, local_id=3), summary="Another task").save()
+        self.client.get(url)
+        self.assertEqual(fragmentStats(), (4, 5))
+
+    def test_cursor_pages(self):
+        self.addStories(120)
+        seen = []
+        page, query = 1, ""
+        while True:
+            response = self.client.get("/projects/project/story-list/stories/%d/%d?%s" % (self.iteration.id, page, query))
+            seen.extend([int(story_id) for story_id in re.findall(r'id="story_(\d+)"', response.content)])
+            if page == 1:
+                # Deleting a story the user has already seen mustn't make the next page skip one.
+                Story.objects.get(id=seen[0]).delete()
+            if not response.context["load_next_page"]:
+                break
+            page += 1
+            query = response.context["next_page_query_string"]
+        self.assertEqual(page, 3)
+        self.assertEqual(len(seen), 120)
+        self.assertEqual(len(set(seen)), 120)
+
+    def test_points_order(self):
+        self.addStories(5)
+        for local_id, points in ((1, "8"), (2, "?"), (3, "0.5"), (4, "Inf"), (5, "13")):
+            story = Story.objects.get(project=self.project, local_id=local_id)
+            story.points = points
+            story.save()
+        Story.objects.filter(project=self.project, local_id=5).update(numeric_points=0)
+        self.assertEqual(backfillPoints(Story), 1)
+        response = self.client.get("/projects/project/story-list/stories/%d/1?order_by=numeric_points" % self.iteration.id)
+        ids = [int(story_id) for story_id in re.findall(r'id="story_(\d+)"', response.content)]
+        self.assertEqual([Story.objects.get(id=story_id).points for story_id in ids], ["?", "Inf", "0.5", "8", "13"])
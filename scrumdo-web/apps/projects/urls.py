@@ -74,6 +74,7 @@ urlpatterns += patterns('projects.story_views',
     url(r'^story_permalink/(?P<story_id>[0-9]+)$', 'story_permalink', name="story_permalink"),
     url(r'^project/(?P<group_slug>[-\w]+)/stories/$', 'stories', name="stories"),
     url(r'^project/(?P<group_slug>[-\w]+)/stories/createAsync$', 'ajax_add_story', name="ajax_add_story"),
+    url(r'^project/(?P<group_slug>[-\w]+)/stories/move$', 'move_stories', name="move_stories"),
     url(r'^project/(?P<group_slug>[-\w]+)/epics/createAsync$', 'ajax_add_epic', name="ajax_add_epic"),
     url(r'^epic/(?P<epic_id>[0-9]+)$', 'epic', name="epic"),
     url(r'^epic/(?P<epic_id>[0-9]+)/edit', 'edit_epic', name="edit_epic"),
@@ -95,6 +96,12 @@ urlpatterns += patterns('projects.story_views',
     url(r'^project/(?P<group_slug>[-\w]+)/mini_story/(?P<story_id>[0-9]+)', 'mini_story'),
 )
 
+urlpatterns += patterns('projects.job_views',
+    url(r'^job/(?P<job_id>[0-9]+)$', 'job_detail', name="job_detail"),
+    url(r'^job/(?P<job_id>[0-9]+)/status$', 'job_status', name="job_status"),
+    url(r'^job/(?P<job_id>[0-9]+)/download$', 'job_download', name="job_download"),
+)
+
 urlpatterns += patterns('projects.task_views',
     url(r'^task/create$', 'create_task', name="create_task"),
     url(r'^task/(?P<task_id>[0-9]+)/set_status$', 'set_task_status', name="set_task_status"),
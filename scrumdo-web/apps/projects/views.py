@@ -56,9 +56,10 @@ else:
     notification = None
 
 from projects.access import *
-from projects.models import Project, ProjectMember, Iteration, Story
+from projects.models import Project, ProjectMember, Iteration, Story, BackgroundJob
 from projects.forms import *
 from projects.import_export import exportProject
+from projects.jobs import queueJob
 from organizations.models import Organization
 
 import datetime
@@ -660,6 +661,10 @@ def export_project(request, group_slug):
     if request.method == "POST":
         form = ExportProjectForm(request.POST)
         if form.is_valid():
+            if form.cleaned_data.get("background", False):
+                job = queueJob(BackgroundJob.TYPE_PROJECT_EXPORT, request.user, project=project,
+                               file_name=form.cleaned_data["file_name"])
+                return HttpResponseRedirect(job.get_absolute_url())
             return exportProject(project, form.cleaned_data["file_name"])
         else:
             return HttpResponseRedirect(reverse("project_detail", kwargs={'group_slug': project.slug}))
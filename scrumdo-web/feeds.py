@@ -4,6 +4,7 @@ from django.contrib.syndication.feeds import Feed
 from django.shortcuts import get_object_or_404
 from projects.models import Project, ProjectMember, Iteration, Story
 from activities.models import NewsItem
+from activities.templatetags.activity_tags import rendered_news
 
 import activities.feedgenerator as feedgenerator
 
@@ -127,8 +128,9 @@ class ProjectStories(Feed):
     def items(self, obj):
         if not obj.active:
             return []
-        activities = NewsItem.objects.filter(project=obj)
-        return activities[:60]
+        activities = NewsItem.objects.filter(project=obj).select_related("user")
+        # Renders the whole feed with one cache lookup, the template shows rendered_text.
+        return rendered_news(activities[:60], absolute=True)
 
 
 def getIterationsStories(iterations):